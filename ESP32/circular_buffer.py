@@ -1,41 +1,143 @@
-from ucollections import deque
+from array import array
 
 
 class CircularBuffer(object):
-    ''' Very simple implementation of a circular buffer based on deque '''
+    ''' Fixed-capacity ring of ints over a preallocated array('i').
+
+    append() overwrites the oldest reading when full and counts it in
+    `dropped`; pop() takes the oldest, pop_head()/peek_latest() the newest,
+    extend()/drain() copy a batch in/out. All O(1) per item and allocation-free. '''
     def __init__(self, max_size):
-        self.data = deque((), max_size, True)
         self.max_size = max_size
+        self._buf = array('i', bytes(4 * max_size))
+        self._head = 0   # next write
+        self._tail = 0   # oldest reading
+        self._count = 0
+        self.dropped = 0
 
     def __len__(self):
-        return len(self.data)
+        return self._count
 
     def is_empty(self):
-        return not bool(self.data)
+        return self._count == 0
 
     def append(self, item):
-        try:
-            self.data.append(item)
-        except IndexError:
-            # deque full, popping 1st item out
-            self.data.popleft()
-            self.data.append(item)
+        self._buf[self._head] = item
+        self._head += 1
+        if self._head == self.max_size:
+            self._head = 0
+        if self._count == self.max_size:
+            # full: the oldest reading was just overwritten
+            self._tail = self._head
+            self.dropped += 1
+        else:
+            self._count += 1
+
+    def extend(self, src, n):
+        # append() for src[0:n] in one pass
+        buf = self._buf
+        cap = self.max_size
+        head = self._head
+        for i in range(n):
+            buf[head] = src[i]
+            head += 1
+            if head == cap:
+                head = 0
+        self._head = head
+        count = self._count + n
+        if count > cap:
+            self.dropped += count - cap
+            count = cap
+            self._tail = head
+        self._count = count
 
     def pop(self):
-        return self.data.popleft()
+        # Oldest reading
+        if self._count == 0:
+            raise IndexError('pop from empty buffer')
+        item = self._buf[self._tail]
+        self._tail += 1
+        if self._tail == self.max_size:
+            self._tail = 0
+        self._count -= 1
+        return item
 
-    def clear(self):
-        self.data = deque((), self.max_size, True)
+    def peek_latest(self):
+        # Newest reading without removing it (0 if empty)
+        if self._count == 0:
+            return 0
+        i = self._head - 1
+        if i < 0:
+            i = self.max_size - 1
+        return self._buf[i]
 
     def pop_head(self):
-        buffer_size = len(self.data)
-        temp = self.data
-        if buffer_size == 1:
-            pass
-        elif buffer_size > 1:
-            self.data.clear()
-            for x in range(buffer_size - 1):
-                self.data = temp.popleft()
-        else:
+        # Newest reading (0 if empty)
+        if self._count == 0:
             return 0
-        return temp.popleft()
\ No newline at end of file
+        self._head -= 1
+        if self._head < 0:
+            self._head = self.max_size - 1
+        self._count -= 1
+        return self._buf[self._head]
+
+    def drain(self, out, max_n=-1):
+        # Copy up to len(out) (or max_n) readings into out, oldest first;
+        # returns the count
+        n = self._count if self._count < len(out) else len(out)
+        if 0 <= max_n < n:
+            n = max_n
+        buf = self._buf
+        cap = self.max_size
+        tail = self._tail
+        for i in range(n):
+            out[i] = buf[tail]
+            tail += 1
+            if tail == cap:
+                tail = 0
+        self._tail = tail
+        self._count -= n
+        return n
+
+    def clear(self):
+        self._head = 0
+        self._tail = 0
+        self._count = 0
+
+
+# ==================== 測試代碼 ====================
+if __name__ == '__main__':
+    import random
+    from collections import deque
+
+    random.seed(1)
+    ring = CircularBuffer(5)
+    ref = deque()
+    out = array('i', bytes(4 * 3))
+    dropped = 0
+    for i in range(1, 2000):
+        op = random.randrange(10)
+        if op < 5:
+            ring.append(i)
+            ref.append(i)
+            if len(ref) > 5:
+                ref.popleft()
+                dropped += 1
+        elif op == 5:
+            src = array('i', [i, -i, i + 1000000, i, i, i, i][:i % 8])
+            ring.extend(src, len(src))
+            for v in src:
+                ref.append(v)
+                if len(ref) > 5:
+                    ref.popleft()
+                    dropped += 1
+        elif op < 8 and ref:
+            assert ring.pop() == ref.popleft()
+        elif op == 8:
+            assert ring.peek_latest() == (ref[-1] if ref else 0)
+            assert ring.pop_head() == (ref.pop() if ref else 0)
+        else:
+            n = ring.drain(out)
+            assert list(out[:n]) == [ref.popleft() for _ in range(n)]
+        assert len(ring) == len(ref) and ring.dropped == dropped
+    print("CircularBuffer == deque model: OK | dropped:", ring.dropped)
@@ -0,0 +1,241 @@
+# dsp.py - 定點數濾波器（ECG 與 PPG 共用）
+#
+# Q15 single-pole and Q14 biquad filters whose state lives in preallocated
+# array('i') buffers. Everything is integer math, so a step() allocates
+# nothing on MicroPython as long as values stay small ints (|v| < 2**30).
+#
+# Scaling is the caller's choice: feed samples shifted left by a few
+# fractional bits (e.g. ecg << 8) and the output comes back in the same
+# scale. Headroom rules of thumb:
+#   OnePole: |x - y| * k < 2**30, k = (1 - alpha) in Q15
+#   Biquad:  |x|, |y| < 2**14 with the Q14 coefficients below
+#
+# The *_block() functions filter a whole array in place; on MicroPython they
+# use @micropython.viper kernels (native 32-bit ints), elsewhere a pure
+# Python loop with identical integer semantics.
+
+import sys
+from array import array
+
+# viper annotations (ptr32) only exist in the MicroPython compiler
+HAVE_VIPER = sys.implementation.name == 'micropython'
+if HAVE_VIPER:
+    import micropython
+
+Q15_ONE = 1 << 15
+Q14_ONE = 1 << 14
+
+
+def to_q15(value):
+    return int(round(value * Q15_ONE))
+
+
+def to_q14(value):
+    return int(round(value * Q14_ONE))
+
+
+class OnePole(object):
+    '''
+    Fixed-point version of the old IIR_filter:
+        y = alpha * y + (1 - alpha) * x   ->   y += (x - y) * k >> 15
+    '''
+    def __init__(self, alpha, init=0):
+        self.alpha = alpha
+        self.k = to_q15(1 - alpha)
+        self._state = array('i', [init])
+
+    def reset(self, value=0):
+        self._state[0] = value
+
+    def value(self):
+        return self._state[0]
+
+    def step(self, x):
+        s = self._state
+        y = s[0]
+        y += ((x - y) * self.k + 0x4000) >> 15
+        s[0] = y
+        return y
+
+    def block(self, buf, n):
+        onepole_block(buf, n, self._state, self.k)
+
+
+class Biquad(object):
+    '''
+    Direct form I biquad, coefficients in Q14 (a0 normalised to 1):
+        y = b0 x + b1 x1 + b2 x2 - a1 y1 - a2 y2
+    State array: [x1, x2, y1, y2]
+    '''
+    def __init__(self, b0, b1, b2, a1, a2):
+        self._coef = array('i', [to_q14(b0), to_q14(b1), to_q14(b2),
+                                 to_q14(a1), to_q14(a2)])
+        self._state = array('i', bytes(16))
+
+    def reset(self, value=0):
+        # Settle at DC for `value` (input and output equal when gain is 1)
+        s = self._state
+        s[0] = value
+        s[1] = value
+        s[2] = value
+        s[3] = value
+
+    def step(self, x):
+        c = self._coef
+        s = self._state
+        y = (c[0] * x + c[1] * s[0] + c[2] * s[1]
+             - c[3] * s[2] - c[4] * s[3] + 0x2000) >> 14
+        s[1] = s[0]
+        s[0] = x
+        s[3] = s[2]
+        s[2] = y
+        return y
+
+    def block(self, buf, n):
+        biquad_block(buf, n, self._state, self._coef)
+
+
+def _onepole_block_py(buf, n, state, k):
+    y = state[0]
+    for i in range(n):
+        y += ((buf[i] - y) * k + 0x4000) >> 15
+        buf[i] = y
+    state[0] = y
+
+
+def _biquad_block_py(buf, n, state, coef):
+    x1 = state[0]
+    x2 = state[1]
+    y1 = state[2]
+    y2 = state[3]
+    b0 = coef[0]
+    b1 = coef[1]
+    b2 = coef[2]
+    a1 = coef[3]
+    a2 = coef[4]
+    for i in range(n):
+        x = buf[i]
+        y = (b0 * x + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2 + 0x2000) >> 14
+        x2 = x1
+        x1 = x
+        y2 = y1
+        y1 = y
+        buf[i] = y
+    state[0] = x1
+    state[1] = x2
+    state[2] = y1
+    state[3] = y2
+
+
+if HAVE_VIPER:
+    @micropython.viper
+    def _onepole_block_viper(buf: ptr32, n: int, state: ptr32, k: int):
+        y = state[0]
+        for i in range(n):
+            y += ((buf[i] - y) * k + 0x4000) >> 15
+            buf[i] = y
+        state[0] = y
+
+    @micropython.viper
+    def _biquad_block_viper(buf: ptr32, n: int, state: ptr32, coef: ptr32):
+        x1 = state[0]
+        x2 = state[1]
+        y1 = state[2]
+        y2 = state[3]
+        for i in range(n):
+            x = buf[i]
+            y = (coef[0] * x + coef[1] * x1 + coef[2] * x2
+                 - coef[3] * y1 - coef[4] * y2 + 0x2000) >> 14
+            x2 = x1
+            x1 = x
+            y2 = y1
+            y1 = y
+            buf[i] = y
+        state[0] = x1
+        state[1] = x2
+        state[2] = y1
+        state[3] = y2
+
+    onepole_block = _onepole_block_viper
+    biquad_block = _biquad_block_viper
+else:
+    onepole_block = _onepole_block_py
+    biquad_block = _biquad_block_py
+
+
+def lowpass_biquad(fc, fs, q=0.7071):
+    """RBJ cookbook 低通 biquad（浮點設計，建構時量化成 Q14）"""
+    from math import cos, sin, pi
+    w0 = 2 * pi * fc / fs
+    alpha = sin(w0) / (2 * q)
+    a0 = 1 + alpha
+    b1 = (1 - cos(w0)) / a0
+    return Biquad(b1 / 2, b1, b1 / 2, -2 * cos(w0) / a0, (1 - alpha) / a0)
+
+
+# ==================== 測試代碼 ====================
+# Equivalence against the float filters this module replaces. Run on
+# CPython (pure Python kernels) or on the board (viper kernels).
+if __name__ == '__main__':
+    import random
+
+    class IIR_filter(object):
+        # float reference, as previously used in main.py / pulse_oximeter.py
+        def __init__(self, alpha):
+            self.old_value = 0.0
+            self.alpha = alpha
+
+        def step(self, value):
+            value = (self.old_value * self.alpha + value * (1 - self.alpha))
+            self.old_value = value
+            return value
+
+    random.seed(1)
+    FRAC = 8
+    ecg = [512 + int(200 * random.random() * (i % 80 == 0)) + random.randint(-5, 5)
+           for i in range(20000)]
+
+    for alpha in (0.995, 0.95, 0.99):
+        ref = IIR_filter(alpha)
+        ref.old_value = float(ecg[0])
+        fx = OnePole(alpha, ecg[0] << FRAC)
+        worst = 0.0
+        for v in ecg:
+            err = abs(fx.step(v << FRAC) / (1 << FRAC) - ref.step(v))
+            if err > worst:
+                worst = err
+        # dead band of the rounding step, in input units
+        bound = (1 << 14) / fx.k / (1 << FRAC) + 1.0 / (1 << FRAC)
+        print("OnePole alpha={}: max |err| = {:.4f} (bound {:.4f})".format(alpha, worst, bound))
+        assert worst <= bound
+
+    # block kernel == step()
+    fx1 = OnePole(0.995, ecg[0] << FRAC)
+    fx2 = OnePole(0.995, ecg[0] << FRAC)
+    buf = array('i', [v << FRAC for v in ecg])
+    fx2.block(buf, len(buf))
+    assert list(buf) == [fx1.step(v << FRAC) for v in ecg]
+
+    # biquad vs float direct form I
+    bq = lowpass_biquad(15, 100)
+    c = [v / Q14_ONE for v in bq._coef]
+    scale = 1 << 3
+    bq.reset(ecg[0] * scale)
+    x1 = x2 = y1 = y2 = float(ecg[0])
+    worst = 0.0
+    for v in ecg:
+        y = c[0] * v + c[1] * x1 + c[2] * x2 - c[3] * y1 - c[4] * y2
+        x2, x1, y2, y1 = x1, v, y1, y
+        err = abs(bq.step(v * scale) / scale - y)
+        if err > worst:
+            worst = err
+    print("Biquad lowpass 15 Hz @ 100 Hz: max |err| = {:.4f} ADC counts".format(worst))
+    assert worst < 1.0
+
+    bq1 = lowpass_biquad(15, 100)
+    bq2 = lowpass_biquad(15, 100)
+    buf = array('i', [v * scale for v in ecg])
+    bq2.block(buf, len(buf))
+    assert list(buf) == [bq1.step(v * scale) for v in ecg]
+
+    print("dsp: OK (viper kernels: {})".format(HAVE_VIPER))
@@ -0,0 +1,156 @@
+# ecg_engine.py - 與硬體無關的 ECG 心跳檢測引擎
+# DC remover + nodc background level + local peak detector + per-beat HR
+# (hr_estimator.py: trimmed mean of the last RRs, with a confidence score).
+# Filtering is fixed-point (dsp.OnePole), so a sample allocates nothing.
+#
+# The engine is driven one sample at a time: feed it (raw, now) pairs with
+# update(), or give it a source/clock pair (e.g. adc.read / ticks_ms) and call
+# poll() from the main loop. Nothing in here touches machine/network, so the
+# same code runs on the ESP32 and on CPython (see ecg_replay.py).
+
+from dsp import OnePole
+from hr_estimator import HREstimator
+
+try:
+    from utime import ticks_diff
+except ImportError:
+    def ticks_diff(a, b):
+        return a - b
+
+# dc / nodc / level / trigger are kept as integers in Q8 ADC counts
+FRAC_BITS = 8
+
+
+class LocalPeakDetector(object):
+    ''' DC remover + nodc level filter + three-point local peak with lockout '''
+    def __init__(self, dc_alpha=0.995, level_alpha=0.95, nodc_offset=2,
+                 refractory_ms=250):
+        self.nodc_offset = nodc_offset
+        self.refractory_ms = refractory_ms
+        self._offset_q = int(nodc_offset * (1 << FRAC_BITS))
+
+        self.dc_remover = OnePole(dc_alpha)
+        self.level_filter = OnePole(level_alpha)
+
+        self.reset(0)
+
+    def reset(self, first_sample):
+        # Start the DC remover at the first sample so the baseline does not
+        # need seconds to climb from zero
+        x0 = int(first_sample) << FRAC_BITS
+        self.dc_remover.reset(x0)
+        self.level_filter.reset(0)
+
+        self.dc_val = x0
+        self.nodc = 0
+        self.nodc_level = 0
+        self.trigger_level = 0
+
+        # local peak buffers
+        self.n2 = 0
+        self.n1 = 0
+        self.n0 = 0
+
+        self.lockout_until = 0
+        self.beat_ts = 0
+
+    def update(self, ecg, now):
+        # DC remove
+        x = ecg << FRAC_BITS
+        self.dc_val = self.dc_remover.step(x)
+        nodc = x - self.dc_val
+        self.nodc = nodc
+
+        # background level
+        self.nodc_level = self.level_filter.step(abs(nodc))
+        self.trigger_level = self.nodc_level + self._offset_q
+
+        # update local peak buffers
+        self.n2, self.n1, self.n0 = self.n1, self.n0, nodc
+        n1 = self.n1
+
+        # local peak detect
+        if (ticks_diff(now, self.lockout_until) >= 0) and (n1 > self.n2) \
+                and (n1 > self.n0) and (n1 > self.trigger_level):
+            self.lockout_until = now + self.refractory_ms
+            self.beat_ts = now
+            return True
+        return False
+
+    def status(self):
+        return "nodc= {} | lvl= {} | trig= {}".format(
+            self.nodc >> FRAC_BITS, self.nodc_level >> FRAC_BITS,
+            self.trigger_level >> FRAC_BITS)
+
+
+class ECGEngine(object):
+    '''
+    Sample-driven ECG pipeline: a beat detector plus a per-beat HR estimate.
+
+    source: callable returning one raw ADC reading (e.g. adc.read)
+    clock:  callable returning the current time in ms (e.g. ticks_ms)
+    Both are only needed for start()/poll(); update() takes explicit values.
+    '''
+    def __init__(self, source=None, clock=None, detector=None, sample_ms=10,
+                 rr_min_ms=270, rr_max_ms=2000, hr_window=9, hr_trim=2):
+        self.source = source
+        self.clock = clock
+        self.detector = detector if detector is not None else LocalPeakDetector()
+
+        self.sample_ms = sample_ms
+        self.rr_min_ms = rr_min_ms
+        self.rr_max_ms = rr_max_ms
+        self.hr = HREstimator(window=hr_window, trim=hr_trim,
+                              rr_min_ms=rr_min_ms, rr_max_ms=rr_max_ms)
+
+        self.start(0, 0)
+
+    def start(self, now=None, first_sample=None):
+        # Initialise filters from the first sample (read from source if the
+        # caller does not pass one in)
+        if now is None:
+            now = self.clock()
+        if first_sample is None:
+            first_sample = self.source()
+
+        self.raw_val = first_sample
+        self.detector.reset(first_sample)
+
+        self.next_sample = now
+        self.beat_time_mark = now
+        self.last_rr = -1
+        self.hr.reset()
+        self.heart_rate = 0.0
+        self.hr_confidence = 0
+        self.last_hr_update_ts = now
+        self.beat_count = 0
+
+    def poll(self, now=None):
+        # Take one sample every sample_ms; returns True when a beat was found
+        if now is None:
+            now = self.clock()
+        if ticks_diff(now, self.next_sample) < 0:
+            return False
+        self.next_sample = now + self.sample_ms
+        return self.update(self.source(), now)
+
+    def update(self, raw, now):
+        self.raw_val = raw
+        if not self.detector.update(raw, now):
+            return False
+
+        beat_ts = self.detector.beat_ts
+        rr = ticks_diff(beat_ts, self.beat_time_mark)
+        self.last_rr = rr
+        self.beat_time_mark = beat_ts
+        self.beat_count += 1
+
+        # an out-of-range RR keeps the last estimate (lower confidence)
+        if self.hr.update(rr):
+            self.heart_rate = self.hr.heart_rate
+            self.last_hr_update_ts = beat_ts
+        self.hr_confidence = self.hr.confidence
+        return True
+
+    def hr_age_ms(self, now):
+        return ticks_diff(now, self.last_hr_update_ts)
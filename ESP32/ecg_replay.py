@@ -0,0 +1,219 @@
+# ecg_replay.py - ECG 引擎的 NumPy 重播版本（僅在電腦上執行，不需上傳 ESP32）
+#
+# Vectorized twin of ecg_engine.ECGEngine for replaying recorded ADC traces on
+# CPython. The recursive single-pole stages reuse the fixed-point block
+# kernel from dsp.py (a recurrence does not vectorize); everything else -
+# nodc, trigger level, three-point peak candidates - is computed with NumPy,
+# and only the sparse candidate list is walked for the lockout. The per-beat
+# HR (hr_estimator.py) is a sorted sliding window over the in-range RRs
+# (sliding_window_view). Results are bit-identical to feeding the same trace
+# through ECGEngine.
+#
+# Usage:
+#   python ecg_replay.py trace.csv [sample_ms]
+# where trace.csv holds either one raw ADC value per line or "t_ms,raw" rows.
+
+from array import array
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from dsp import OnePole
+from ecg_engine import ECGEngine, LocalPeakDetector, FRAC_BITS
+
+
+def _onepole(values, alpha, init):
+    # Runs the very same integer kernel as OnePole.step()
+    buf = array('i', values.tolist())
+    f = OnePole(alpha, init)
+    f.block(buf, len(buf))
+    return np.frombuffer(buf, dtype=np.int32).astype(np.int64)
+
+
+def load_trace(path, sample_ms=10):
+    """
+    讀取 ADC 紀錄檔
+
+    Returns:
+        (raw, t_ms) int64 arrays
+    """
+    data = np.loadtxt(path, delimiter=',', ndmin=2, dtype=np.int64)
+    if data.shape[1] >= 2:
+        return data[:, 1], data[:, 0]
+    raw = data[:, 0]
+    return raw, np.arange(len(raw), dtype=np.int64) * sample_ms
+
+
+def replay(raw, t_ms, dc_alpha=0.995, level_alpha=0.95, nodc_offset=2,
+           refractory_ms=250, rr_min_ms=270, rr_max_ms=2000, hr_window=9, hr_trim=2):
+    """
+    Replay a trace through the ECG pipeline.
+
+    The first sample only initialises the DC remover, exactly like
+    ECGEngine.start(); detection runs over raw[1:].
+
+    Returns:
+        dict of arrays, one entry per detected beat:
+        'beat_ts', 'rr', 'hr' (heart rate after that beat) and 'conf'
+    """
+    raw = np.asarray(raw, dtype=np.int64)
+    t_ms = np.asarray(t_ms, dtype=np.int64)
+
+    x = raw[1:] << FRAC_BITS
+    t = t_ms[1:]
+
+    dc = _onepole(x, dc_alpha, int(raw[0]) << FRAC_BITS)
+    nodc = x - dc
+    trigger = _onepole(np.abs(nodc), level_alpha, 0) + int(nodc_offset * (1 << FRAC_BITS))
+
+    # n2, n1, n0 start at zero before the first processed sample
+    p = np.concatenate((np.zeros(2, dtype=np.int64), nodc))
+    n2, n1, n0 = p[:-2], p[1:-1], p[2:]
+    candidates = np.flatnonzero((n1 > n2) & (n1 > n0) & (n1 > trigger))
+
+    beat_ts = []
+    lockout_until = 0
+    for now in t[candidates].tolist():
+        if now - lockout_until < 0:
+            continue
+        lockout_until = now + refractory_ms
+        beat_ts.append(now)
+
+    beat_ts = np.array(beat_ts, dtype=np.int64)
+    rr = np.diff(beat_ts, prepend=int(t_ms[0]))
+    hr, conf = heart_rate(rr, hr_window, hr_trim, rr_min_ms, rr_max_ms)
+    return {'beat_ts': beat_ts, 'rr': rr, 'hr': hr, 'conf': conf}
+
+
+def heart_rate(rr, window=9, trim=2, rr_min_ms=270, rr_max_ms=2000, min_beats=3):
+    """
+    逐拍心率與信心分數（與 HREstimator 相同）
+
+    Returns:
+        (hr, conf)：每個心跳之後的心率 (bpm) 與信心分數 (0-100)
+    """
+    rr = np.asarray(rr, dtype=np.int64)
+    ok = (rr > rr_min_ms) & (rr < rr_max_ms)
+    v = rr[ok]
+    m = len(v)
+
+    # per in-range RR j: trimmed sum / count and spread of the window ending there
+    n_v = np.minimum(np.arange(1, m + 1), window)
+    total = np.zeros(m, dtype=np.int64)
+    kept = np.zeros(m, dtype=np.int64)
+    spread = np.zeros(m, dtype=np.int64)
+    for j in range(min(window - 1, m)):
+        # windows still filling up: trim in proportion
+        w = np.sort(v[:j + 1])
+        n = j + 1
+        tt = trim * n // window
+        total[j] = w[tt:n - tt].sum()
+        kept[j] = n - 2 * tt
+        spread[j] = (w[n - 1 - tt] - w[tt]) * 100 // w[n >> 1]
+    if m >= window:
+        w = np.sort(sliding_window_view(v, window), axis=1)
+        total[window - 1:] = w[:, trim:window - trim].sum(axis=1)
+        kept[window - 1:] = window - 2 * trim
+        spread[window - 1:] = (w[:, window - 1 - trim] - w[:, trim]) * 100 // w[:, window >> 1]
+    spread = np.minimum(spread, 100)
+
+    # each beat sees the window of the latest in-range RR up to it
+    pos = np.cumsum(ok) - 1
+    c = np.cumsum(ok)
+    hits = c - np.concatenate((np.zeros(window, dtype=np.int64), c[:-window]))[:len(c)]
+    ready = pos >= 0
+    ready[ready] = n_v[pos[ready]] >= min_beats
+    p = pos[ready]
+    hr = np.zeros(len(rr))
+    # Python round() on the same float ratio as the estimator
+    hr[ready] = [round(x, 1) for x in (60000 * kept[p] / total[p]).tolist()]
+    conf = np.zeros(len(rr), dtype=np.int64)
+    conf[ready] = (100 - spread[p]) * n_v[p] * hits[ready] // (window * window)
+    return hr, conf
+
+
+def replay_engine(raw, t_ms, detector=None, **params):
+    """
+    Reference: push the trace through ECGEngine one sample at a time.
+    Pass a detector instance (e.g. PanTompkinsDetector) to replay other
+    detection modes; remaining params go to LocalPeakDetector/ECGEngine.
+    """
+    rr_keys = ('rr_min_ms', 'rr_max_ms', 'hr_window', 'hr_trim')
+    if detector is None:
+        detector = LocalPeakDetector(**{k: v for k, v in params.items() if k not in rr_keys})
+    engine = ECGEngine(
+        detector=detector,
+        **{k: v for k, v in params.items() if k in rr_keys}
+    )
+    raw = [int(v) for v in raw]
+    t_ms = [int(v) for v in t_ms]
+    engine.start(t_ms[0], raw[0])
+
+    beat_ts = []
+    rr_list = []
+    hr_list = []
+    conf_list = []
+    for i in range(1, len(raw)):
+        if engine.update(raw[i], t_ms[i]):
+            beat_ts.append(engine.detector.beat_ts)
+            rr_list.append(engine.last_rr)
+            hr_list.append(engine.heart_rate)
+            conf_list.append(engine.hr_confidence)
+
+    return {
+        'beat_ts': np.array(beat_ts, dtype=np.int64),
+        'rr': np.array(rr_list, dtype=np.int64),
+        'hr': np.array(hr_list, dtype=np.float64),
+        'conf': np.array(conf_list, dtype=np.int64)
+    }
+
+
+def synthetic_trace(seconds=60, sample_ms=10, bpm=72, seed=0):
+    """產生簡單的合成 ECG（R 波 + 基線漂移 + 雜訊），10-bit ADC 範圍"""
+    rng = np.random.default_rng(seed)
+    t_ms = np.arange(0, seconds * 1000, sample_ms, dtype=np.int64)
+    t = t_ms / 1000.0
+    rr = 60.0 / bpm
+    beat_times = np.cumsum(rng.normal(rr, 0.03 * rr, int(seconds / rr) + 2))
+    sig = 512 + 40 * np.sin(2 * np.pi * 0.25 * t) + rng.normal(0, 3, len(t))
+    for bt in beat_times:
+        sig += 180 * np.exp(-0.5 * ((t - bt) / 0.012) ** 2)
+        sig += 30 * np.exp(-0.5 * ((t - bt - 0.25) / 0.04) ** 2)
+    return np.clip(np.round(sig), 0, 1023).astype(np.int64), t_ms
+
+
+# ==================== 測試代碼 ====================
+if __name__ == '__main__':
+    import sys
+    import time
+
+    if len(sys.argv) > 1:
+        sample_ms = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        raw, t_ms = load_trace(sys.argv[1], sample_ms)
+    else:
+        raw, t_ms = synthetic_trace(seconds=600)
+
+    duration_s = (t_ms[-1] - t_ms[0]) / 1000.0
+    print("=" * 50)
+    print("ECG replay: {} samples ({:.0f} s)".format(len(raw), duration_s))
+    print("=" * 50)
+
+    t0 = time.perf_counter()
+    fast = replay(raw, t_ms)
+    t1 = time.perf_counter()
+    ref = replay_engine(raw, t_ms)
+    t2 = time.perf_counter()
+
+    identical = all(np.array_equal(fast[k], ref[k]) for k in ('beat_ts', 'rr', 'hr', 'conf'))
+    print("beats:", len(fast['beat_ts']), "| last HR:", fast['hr'][-1] if len(fast['hr']) else None)
+    print("NumPy replay : {:.3f} s ({:.0f}x real time)".format(t1 - t0, duration_s / (t1 - t0)))
+    print("ECGEngine    : {:.3f} s ({:.0f}x real time)".format(t2 - t1, duration_s / (t2 - t1)))
+    print("bit-identical:", identical)
+
+    from pan_tompkins import PanTompkinsDetector
+    t3 = time.perf_counter()
+    pt = replay_engine(raw, t_ms, detector=PanTompkinsDetector(sample_ms=int(t_ms[1] - t_ms[0])))
+    t4 = time.perf_counter()
+    print("Pan-Tompkins : {:.3f} s | beats: {} | last HR: {}".format(
+        t4 - t3, len(pt['beat_ts']), pt['hr'][-1] if len(pt['hr']) else None))
+    sys.exit(0 if identical else 1)
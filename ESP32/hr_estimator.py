@@ -0,0 +1,190 @@
+# hr_estimator.py - 逐拍心率估計（滑動視窗截尾平均 + 信心分數）
+#
+# Replaces "average TARGET_N_BEATS clean RRs, then start over, and throw
+# everything away on one outlier": every beat updates the estimate from the
+# last `window` in-range RR intervals.
+#
+#   - the RRs are kept twice: in arrival order (ring, to know which one
+#     leaves) and sorted (array('H'), insert / remove by binary search and
+#     a shift - O(K) for the small K used here, no allocation)
+#   - HR = 60000 / mean of the sorted window without its `trim` shortest
+#     and `trim` longest RRs (trim = (window - 1) // 2 gives the median);
+#     a missed or extra beat lands in the trimmed tails instead of resetting
+#   - an RR outside [rr_min_ms, rr_max_ms] is not added, but the estimate
+#     stays; it only lowers the confidence
+#
+# Confidence (0-100) = window fill x share of the last `window` beats that
+# were in range x (100 - spread of the trimmed window in % of the median).
+
+from array import array
+
+
+def _popcount(x):
+    n = 0
+    while x:
+        x &= x - 1
+        n += 1
+    return n
+
+
+class HREstimator(object):
+    def __init__(self, window=9, trim=2, rr_min_ms=270, rr_max_ms=2000,
+                 min_beats=3):
+        """
+        Args:
+            window: 視窗內的 RR 數 K（最多 30）
+            trim: 兩端各去掉幾個 RR（(window - 1) // 2 = 中位數）
+            min_beats: 視窗內至少幾個 RR 才輸出心率
+        """
+        self.window = window
+        self.trim = trim
+        self.rr_min_ms = rr_min_ms
+        self.rr_max_ms = rr_max_ms
+        self.min_beats = min_beats
+        self._mask = (1 << window) - 1
+
+        self._ring = array('H', bytes(2 * window))
+        self._sorted = array('H', bytes(2 * window))
+        self.reset()
+
+    def reset(self):
+        self._head = 0
+        self._n = 0
+        self._hist = 0            # in-range bit per recent beat
+        self.heart_rate = 0.0
+        self.confidence = 0
+        self.rejected = 0
+
+    def _find(self, rr):
+        # first index in the sorted window with value >= rr
+        lo = 0
+        hi = self._n
+        s = self._sorted
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if s[mid] < rr:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _insert(self, rr):
+        s = self._sorted
+        i = self._find(rr)
+        j = self._n
+        while j > i:
+            s[j] = s[j - 1]
+            j -= 1
+        s[i] = rr
+        self._n += 1
+
+    def _remove(self, rr):
+        s = self._sorted
+        i = self._find(rr)
+        self._n -= 1
+        while i < self._n:
+            s[i] = s[i + 1]
+            i += 1
+
+    def update(self, rr):
+        """
+        每個心跳呼叫一次
+
+        Args:
+            rr: 與前一個心跳的間隔 (ms)
+
+        Returns:
+            bool: 心率是否更新
+        """
+        ok = self.rr_min_ms < rr < self.rr_max_ms
+        self._hist = ((self._hist << 1) | (1 if ok else 0)) & self._mask
+        if ok:
+            if self._n == self.window:
+                self._remove(self._ring[self._head])
+            self._ring[self._head] = rr
+            self._head = (self._head + 1) % self.window
+            self._insert(rr)
+        else:
+            self.rejected += 1
+
+        n = self._n
+        if n < self.min_beats:
+            self.confidence = 0
+            return False
+        s = self._sorted
+        # fewer RRs than the window: trim in proportion
+        t = self.trim * n // self.window
+        total = 0
+        for i in range(t, n - t):
+            total += s[i]
+        self.heart_rate = round(60000 * (n - 2 * t) / total, 1)
+
+        spread = (s[n - 1 - t] - s[t]) * 100 // s[n >> 1]
+        if spread > 100:
+            spread = 100
+        self.confidence = (100 - spread) * n * _popcount(self._hist) // (self.window * self.window)
+        return ok
+
+
+# ==================== 測試代碼 ====================
+# A 72 -> 90 bpm step with missed beats (double RR), extra detections (split
+# RR) and out-of-range glitches: the estimate follows within a few beats,
+# never drops to zero, and the old reset-on-outlier average is compared.
+if __name__ == '__main__':
+    import random
+
+    random.seed(23)
+
+    est = HREstimator()
+    # the averaging ECGEngine used before (3 clean RRs, reset on outliers)
+    old_n = 0
+    old_tot = 0
+    old_updates = 0
+    new_updates = 0
+    errors = []
+    beats = 0
+    for k in range(600):
+        bpm = 72 if k < 300 else 90
+        rr = int(60000 / bpm + random.gauss(0, 15))
+        u = random.random()
+        if u < 0.03:
+            rrs = [rr * 2]                          # missed beat
+        elif u < 0.06:
+            rrs = [rr // 3, rr - rr // 3]           # T-wave counted as a beat
+        elif u < 0.07:
+            rrs = [random.choice([40, 2500])]       # glitch
+        else:
+            rrs = [rr]
+        for r in rrs:
+            beats += 1
+            if est.update(r):
+                new_updates += 1
+            if 2000 > r > 270:
+                old_tot += r
+                old_n += 1
+                if old_n == 3:
+                    old_n = 0
+                    old_tot = 0
+                    old_updates += 1
+            else:
+                old_n = 0
+                old_tot = 0
+            assert est.heart_rate > 0 or beats < 3
+        if k % 300 > 10:
+            errors.append(abs(est.heart_rate - bpm))
+
+    print("beats {} | HR updates: estimator {} vs 3-beat average {}".format(
+        beats, new_updates, old_updates))
+    print("mean |error| after settling: {:.2f} bpm | max {:.1f} | confidence now {}".format(
+        sum(errors) / len(errors), max(errors), est.confidence))
+
+    # steady, clean rhythm -> high confidence; noisy -> low
+    clean = HREstimator()
+    noisy = HREstimator()
+    for k in range(30):
+        clean.update(800 + random.randint(-10, 10))
+        noisy.update((400, 800, 1300)[k % 3])
+    print("confidence clean {} | noisy {}".format(clean.confidence, noisy.confidence))
+    assert new_updates > 2 * old_updates and sum(errors) / len(errors) < 2.0
+    assert clean.confidence > 85 and noisy.confidence < 50
+    print("hr_estimator: OK")
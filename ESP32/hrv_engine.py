@@ -0,0 +1,248 @@
+# hrv_engine.py - 串流式心率變異度（HRV）指標
+#
+# Time-domain and Poincare HRV over the last `window` normal-to-normal (NN)
+# intervals, updated in O(1) per beat:
+#
+#   SDNN   standard deviation of NN intervals
+#   RMSSD  root mean square of successive NN differences
+#   pNN50  % of successive differences larger than 50 ms
+#   SD1    sqrt(var(dNN) / 2)           (Poincare, short-term)
+#   SD2    sqrt(2 SDNN^2 - SD1^2)       (Poincare, long-term)
+#
+# Accepted NNs live in a ring (array('H')); next to each one the ring keeps
+# its difference to the previous NN, or NO_DIFF when the two were not
+# adjacent beats (a rejected beat in between). NN and difference statistics
+# are sliding Welford accumulators: a beat entering the window is added, the
+# one falling out is removed, so nothing is ever re-scanned. Variances use
+# n - 1 (sample), as hrv_metrics.py on the Streamlit side does.
+#
+# Ectopic / artefact rejection: an RR outside [rr_min_ms, rr_max_ms] or
+# more than ectopic_pct % away from the previous NN is dropped (a premature
+# beat and its compensatory pause both fail). `reseed` rejections in a row
+# mean the rhythm really changed, and the next RR starts over as reference.
+
+from array import array
+from math import sqrt
+
+NO_DIFF = -32768
+
+
+class Welford(object):
+    ''' Running mean / variance with add() and remove() '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+
+    def remove(self, x):
+        if self.n <= 1:
+            self.reset()
+            return
+        old = self.mean
+        self.n -= 1
+        self.mean = (old * (self.n + 1) - x) / self.n
+        self.m2 -= (x - old) * (x - self.mean)
+        if self.m2 < 0.0:
+            self.m2 = 0.0
+
+    def var(self):
+        # sample variance
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+
+class HRVEngine(object):
+    def __init__(self, window=300, rr_min_ms=270, rr_max_ms=2000,
+                 ectopic_pct=20, reseed=3):
+        """
+        Args:
+            window: 計算用的 NN 數（300 ≈ 5 分鐘短期 HRV）
+            ectopic_pct: 與前一個 NN 相差超過此百分比視為異位 / 雜訊
+            reseed: 連續拒絕幾次後以下一個 RR 重新作為參考
+        """
+        self.window = window
+        self.rr_min_ms = rr_min_ms
+        self.rr_max_ms = rr_max_ms
+        self.ectopic_pct = ectopic_pct
+        self.reseed = reseed
+
+        self._nn = array('H', bytes(2 * window))
+        self._diff = array('h', bytes(2 * window))
+        self.nn_stats = Welford()
+        self.diff_stats = Welford()
+        self.restart()
+
+    def restart(self):
+        self._head = 0
+        self._count = 0
+        self._prev = 0           # previous accepted NN (0: none)
+        self._adjacent = False   # last beat was accepted
+        self._misses = 0
+        self._nn50 = 0
+        self.nn_stats.reset()
+        self.diff_stats.reset()
+
+        self.beats = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def gap(self):
+        """心跳紀錄中斷（例如導線脫落）：下一個 NN 不與前一個相減"""
+        self._adjacent = False
+
+    def update(self, rr):
+        """
+        每個心跳呼叫一次
+
+        Args:
+            rr: 與前一個心跳的間隔 (ms)
+
+        Returns:
+            bool: 是否被當作 NN 納入
+        """
+        self.beats += 1
+        ok = self.rr_min_ms < rr < self.rr_max_ms
+        if ok and self._prev and self._misses < self.reseed:
+            ok = abs(rr - self._prev) * 100 <= self.ectopic_pct * self._prev
+        if not ok:
+            self.rejected += 1
+            self._misses += 1
+            self._adjacent = False
+            return False
+
+        if self._misses >= self.reseed:
+            # new reference: no difference across the gap
+            self._adjacent = False
+        d = rr - self._prev if self._adjacent else NO_DIFF
+        self._misses = 0
+        self._prev = rr
+        self._adjacent = True
+        self.accepted += 1
+
+        i = self._head
+        if self._count == self.window:
+            # the oldest NN (and its difference) leaves the window
+            self.nn_stats.remove(self._nn[i])
+            old = self._diff[i]
+            if old != NO_DIFF:
+                self.diff_stats.remove(old)
+                if old > 50 or old < -50:
+                    self._nn50 -= 1
+        else:
+            self._count += 1
+        self._nn[i] = rr
+        self._diff[i] = d
+        self._head = (i + 1) % self.window
+
+        self.nn_stats.add(rr)
+        if d != NO_DIFF:
+            self.diff_stats.add(d)
+            if d > 50 or d < -50:
+                self._nn50 += 1
+        return True
+
+    def metrics(self):
+        """
+        目前視窗的 HRV 指標
+
+        Returns:
+            dict: n_nn, mean_nn, sdnn, rmssd, pnn50, sd1, sd2（ms / %，四捨五入到 0.1）；
+            NN 少於 3 個或相鄰差值少於 2 個時 None
+        """
+        nn = self.nn_stats
+        dd = self.diff_stats
+        if nn.n < 3 or dd.n < 2:
+            return None
+        sdnn2 = nn.var()
+        # mean of d^2 from the population variance and the mean
+        rmssd = sqrt(dd.m2 / dd.n + dd.mean * dd.mean)
+        sd1_2 = dd.var() / 2
+        sd2_2 = 2 * sdnn2 - sd1_2
+        return {
+            'n_nn': nn.n,
+            'mean_nn': round(nn.mean, 1),
+            'sdnn': round(sqrt(sdnn2), 1),
+            'rmssd': round(rmssd, 1),
+            'pnn50': round(100.0 * self._nn50 / dd.n, 1),
+            'sd1': round(sqrt(sd1_2), 1),
+            'sd2': round(sqrt(sd2_2), 1) if sd2_2 > 0 else 0.0
+        }
+
+
+# ==================== 測試代碼 ====================
+# Sliding-window metrics against a direct recomputation over the window,
+# on a synthetic RR series with respiratory sinus arrhythmia, ectopic beats
+# (premature + compensatory pause), missed beats and a rhythm change.
+if __name__ == '__main__':
+    import math
+    import random
+
+    random.seed(21)
+
+    def direct(nn, diffs):
+        # straightforward two-pass formulas (ddof = 1)
+        n = len(nn)
+        mean = sum(nn) / n
+        sdnn2 = sum([(x - mean) ** 2 for x in nn]) / (n - 1)
+        m = len(diffs)
+        dm = sum(diffs) / m
+        dvar = sum([(x - dm) ** 2 for x in diffs]) / (m - 1)
+        return {
+            'n_nn': n,
+            'mean_nn': round(mean, 1),
+            'sdnn': round(sqrt(sdnn2), 1),
+            'rmssd': round(sqrt(sum([x * x for x in diffs]) / m), 1),
+            'pnn50': round(100.0 * len([x for x in diffs if abs(x) > 50]) / m, 1),
+            'sd1': round(sqrt(dvar / 2), 1),
+            'sd2': round(sqrt(2 * sdnn2 - dvar / 2), 1)
+        }
+
+    engine = HRVEngine(window=120)
+    ring = []       # (nn, diff or None) of the window, as a plain list
+    ectopics = 0
+    t = 0.0
+    mismatches = 0
+    for k in range(3000):
+        base = 850 if k < 1500 else 650          # rhythm change halfway
+        rr = int(base + 45 * math.sin(2 * math.pi * t / 4200) + random.gauss(0, 18))
+        if random.random() < 0.02:
+            # premature beat and its compensatory pause
+            beats = [int(rr * 0.65), int(rr * 1.35)]
+            ectopics += 1
+        elif random.random() < 0.005:
+            beats = [rr * 2]                      # missed R-peak
+        else:
+            beats = [rr]
+        for b in beats:
+            t += b
+            was = engine._prev
+            adjacent = engine._adjacent and engine._misses < engine.reseed
+            if engine.update(b):
+                diff = b - was if adjacent else None
+                ring.append((b, diff))
+                if len(ring) > engine.window:
+                    ring.pop(0)
+        m = engine.metrics()
+        if m is not None and k % 50 == 0:
+            ref = direct([x for x, _ in ring], [d for _, d in ring if d is not None])
+            for key in ref:
+                if abs(ref[key] - m[key]) > 0.11:
+                    mismatches += 1
+                    print("mismatch", k, key, ref[key], m[key])
+
+    print("beats {} | NN {} | rejected {} (ectopic events {})".format(
+        engine.beats, engine.accepted, engine.rejected, ectopics))
+    print("last window:", engine.metrics())
+    assert mismatches == 0
+    # both beats of every ectopic event (and missed beats) are rejected,
+    # and the rhythm change is followed
+    assert engine.rejected >= 2 * ectopics and engine.metrics()['mean_nn'] < 700
+    print("sliding Welford == direct recomputation: OK")
@@ -0,0 +1,470 @@
+# http_keepalive.py - 精簡 HTTP/1.1 keep-alive 客戶端（FHIRClient 的 ESP32 傳輸層）
+#
+# urequests opens a new TCP connection for every request and allocates the
+# whole response. KeepAliveHTTP keeps one socket to the FHIR server open
+# across uploads, resolves DNS once, and reads each response into a
+# preallocated bytearray; the body comes back as a memoryview into that
+# buffer (valid until the next request).
+#
+# Supported: Content-Length and chunked bodies, bodiless responses (HEAD,
+# 204, 304), "Connection: close", and a transparent reconnect when the
+# server has dropped an idle connection (the request is resent once if the
+# old socket fails before any response byte).
+# Bodies larger than the buffer are drained and flagged as truncated.
+#
+# Runs unchanged on CPython, which is how the self-test below exercises it
+# against a local http.server.
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+ECONNRESET = 104
+
+
+class HTTPError(OSError):
+    pass
+
+
+def _find(mv, pat, start, end):
+    # bytes.find on a buffer window (bytearray.find is missing on MicroPython)
+    i = bytes(mv[start:end]).find(pat)
+    return i + start if i >= 0 else -1
+
+
+class KeepAliveHTTP(object):
+    def __init__(self, base_url, buf_size=8192, timeout=5):
+        if not base_url.startswith('http://'):
+            raise ValueError("only http:// is supported: " + base_url)
+        hostport = base_url[7:].split('/', 1)[0]
+        if ':' in hostport:
+            self.host, port = hostport.split(':', 1)
+            self.port = int(port)
+        else:
+            self.host = hostport
+            self.port = 80
+        self._origin = 'http://' + hostport
+        self.timeout = timeout
+
+        self._buf = bytearray(buf_size)
+        self._mv = memoryview(self._buf)
+        self._sock = None
+        self._addr = None
+
+        self.status = 0
+        self.location = None
+        self.truncated = False
+        self.connects = 0
+        self.requests = 0
+
+    # ---------- connection ----------
+
+    def _connect(self):
+        if self._addr is None:
+            self._addr = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0][-1]
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        try:
+            s.connect(self._addr)
+        except OSError:
+            s.close()
+            self._addr = None   # resolve again next time
+            raise
+        # MicroPython streams: write/readinto; CPython: sendall/recv_into
+        self._send = getattr(s, 'write', None) or s.sendall
+        self._recv_into = getattr(s, 'readinto', None) or s.recv_into
+        self._sock = s
+        self.connects += 1
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    # ---------- request ----------
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """
+        發送請求並讀取回應
+
+        Args:
+            method: HTTP 方法
+            url: 完整 URL（須與 base_url 同一主機）或路徑
+            body: str / bytes 請求體
+            headers: dict
+            timeout: 只用於這次請求的逾時秒數
+
+        Returns:
+            (status, memoryview of body)
+        """
+        if url.startswith('http://'):
+            if not url.startswith(self._origin):
+                raise ValueError("other host: " + url)
+            url = url[len(self._origin):] or '/'
+
+        if isinstance(body, str):
+            body = body.encode()
+        head = "{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n".format(
+            method, url, self.host, len(body) if body else 0)
+        if headers:
+            for k in headers:
+                head += "{}: {}\r\n".format(k, headers[k])
+        head = (head + "\r\n").encode()
+
+        for attempt in (0, 1):
+            fresh = self._sock is None
+            if fresh:
+                self._connect()
+            self._sock.settimeout(timeout or self.timeout)
+            try:
+                try:
+                    self._send(head)
+                    if body:
+                        self._send(body)
+                except OSError:
+                    raise _StaleConnection()
+                result = self._read_response(method == 'HEAD')
+                self.requests += 1
+                return result
+            except _StaleConnection:
+                # keep-alive socket closed by the server: reconnect once
+                self.close()
+                if fresh or attempt:
+                    raise HTTPError("connection closed by server")
+            except OSError:
+                self.close()
+                raise
+
+    # ---------- response ----------
+
+    def _fill(self, end):
+        # Read more bytes into the buffer at `end`; returns the new end
+        if end >= len(self._buf):
+            raise _Overflow()
+        try:
+            n = self._recv_into(self._mv[end:])
+        except OSError as e:
+            if end == 0 and e.args and e.args[0] == ECONNRESET:
+                raise _StaleConnection()
+            raise
+        if not n:
+            raise _StaleConnection() if end == 0 else HTTPError("short response")
+        return end + n
+
+    def _read_response(self, head_only=False):
+        end = 0
+        while True:
+            end = self._fill(end)
+            hdr_end = _find(self._mv, b'\r\n\r\n', 0, end)
+            if hdr_end >= 0:
+                break
+        head = bytes(self._mv[:hdr_end]).decode().split('\r\n')
+        self.status = int(head[0].split(' ', 2)[1])
+
+        length = -1
+        chunked = False
+        close = head[0].startswith('HTTP/1.0')
+        self.location = None
+        for line in head[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            if name in ('location', 'content-location'):
+                # created resource (.../Observation/<id>/_history/1)
+                self.location = value.strip()
+                continue
+            value = value.strip().lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'transfer-encoding':
+                chunked = 'chunked' in value
+            elif name == 'connection':
+                close = value == 'close'
+
+        # body starts right after the header; decode it in place
+        start = hdr_end + 4
+        self.truncated = False
+        if head_only or self.status in (204, 304):
+            # no body by definition, whatever the headers say; reading to
+            # close here would block until the keep-alive socket times out
+            body_end = start
+        elif chunked:
+            body_end = self._read_chunked(start, end)
+        elif length >= 0:
+            body_end = self._read_length(start, end, length)
+        else:
+            body_end = self._read_to_close(start, end)
+            close = True
+
+        if close:
+            self.close()
+        return self.status, self._mv[start:body_end]
+
+    def _drain(self, n):
+        # Discard n more bytes that do not fit into the buffer
+        self.truncated = True
+        scratch = self._mv[len(self._buf) - 256:]
+        while n > 0:
+            got = self._recv_into(scratch[:min(n, 256)])
+            if not got:
+                raise HTTPError("short response")
+            n -= got
+
+    def _read_length(self, start, end, length):
+        want = start + length
+        if want > len(self._buf):
+            # keep what fits, skip the rest so the connection stays usable
+            room = len(self._buf) - 256
+            while end < room:
+                end = self._fill_upto(end, room)
+            self._drain(want - end)
+            return room
+        while end < want:
+            end = self._fill_upto(end, want)
+        return want
+
+    def _fill_upto(self, end, limit):
+        n = self._recv_into(self._mv[end:limit])
+        if not n:
+            raise HTTPError("short response")
+        return end + n
+
+    def _read_to_close(self, start, end):
+        while True:
+            if end >= len(self._buf):
+                self.truncated = True
+                return end
+            n = self._recv_into(self._mv[end:])
+            if not n:
+                return end
+            end += n
+
+    def _read_chunked(self, start, end):
+        # w: write position of decoded body, r: read position in the buffer
+        mv = self._mv
+        w = start
+        r = start
+        limit = len(self._buf) - 256
+        while True:
+            # chunk size line
+            while True:
+                nl = _find(mv, b'\r\n', r, end)
+                if nl >= 0:
+                    break
+                end = self._compact_fill(w, r, end)
+                r = w
+            size = int(bytes(mv[r:nl]).split(b';')[0], 16)
+            r = nl + 2
+            if size == 0:
+                # trailer: read up to the final CRLF
+                while _find(mv, b'\r\n', r, end) < 0:
+                    end = self._compact_fill(w, r, end)
+                    r = w
+                return w
+            # chunk data (+ CRLF)
+            remaining = size
+            while remaining > 0:
+                if r >= end:
+                    end = self._compact_fill(w, r, end)
+                    r = w
+                n = min(remaining, end - r)
+                keep = min(n, limit - w)
+                if keep > 0:
+                    if w != r:
+                        mv[w:w + keep] = mv[r:r + keep]
+                    w += keep
+                if keep < n:
+                    self.truncated = True
+                r += n
+                remaining -= n
+            while end - r < 2:
+                end = self._compact_fill(w, r, end)
+                r = w
+            r += 2
+
+    def _compact_fill(self, w, r, end):
+        # Move unread bytes [r, end) down to w, then read more after them
+        n = end - r
+        if n and w != r:
+            self._mv[w:w + n] = self._mv[r:end]
+        end = w + n
+        if end >= len(self._buf):
+            raise _Overflow()
+        got = self._recv_into(self._mv[end:])
+        if not got:
+            raise HTTPError("short response")
+        return end + got
+
+
+class _StaleConnection(OSError):
+    pass
+
+
+class _Overflow(HTTPError):
+    pass
+
+
+# ==================== 測試代碼 ====================
+# CPython only: a local http.server stands in for HAPI. Checks connection
+# reuse, Content-Length / chunked / close-delimited bodies, oversized
+# bodies, and reconnecting after the server drops an idle connection.
+if __name__ == '__main__':
+    import json
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    stats = {'connections': 0, 'posts': 0}
+    BIG = b'x' * 20000
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        max_per_connection = 7
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            stats['connections'] += 1
+            stats['last'] = self.connection
+            self.served = 0
+
+        def log_message(self, *args):
+            pass
+
+        def handle(self):
+            try:
+                BaseHTTPRequestHandler.handle(self)
+            except ConnectionError:
+                pass   # the dropped connection in the reconnect check
+
+        def _reply(self, code, body, chunked=False, close=False):
+            self.served += 1
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/fhir+json')
+            if close or self.served >= self.max_per_connection:
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            if chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for i in range(0, len(body), 97):
+                    part = body[i:i + 97]
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+                self.wfile.write(b'0\r\n\r\n')
+            else:
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def do_POST(self):
+            data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            stats['posts'] += 1
+            if data.get("big"):
+                # accepted, but the echoed body does not fit the buffer
+                self.served += 1
+                self.send_response(201)
+                self.send_header('Location', self.path + '/' + str(stats['posts']) + '/_history/1')
+                self.send_header('Content-Length', str(len(BIG)))
+                self.end_headers()
+                self.wfile.write(BIG)
+                return
+            body = json.dumps({"resourceType": data["resourceType"],
+                               "id": str(stats['posts']), "echo": data}).encode()
+            self._reply(201, body, chunked=stats['posts'] % 2 == 0)
+
+        def do_GET(self):
+            if self.path.startswith('/fhir/big'):
+                self._reply(200, BIG, chunked='chunked' in self.path)
+            elif self.path.startswith('/fhir/close'):
+                self.send_response(200)
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(b'{"closed": true}')
+                self.close_connection = True
+            elif self.path.startswith('/fhir/notmod'):
+                # 304: no body and, as allowed, no Content-Length
+                self.send_response(304)
+                self.end_headers()
+            else:
+                self._reply(200, b'{"resourceType": "CapabilityStatement"}')
+
+        def do_HEAD(self):
+            # headers of the GET, body never sent
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BIG)))
+            self.end_headers()
+
+        def do_DELETE(self):
+            self.send_response(204)
+            self.end_headers()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:{}/fhir".format(server.server_address[1])
+
+    http = KeepAliveHTTP(base, buf_size=4096)
+    for i in range(20):
+        status, body = http.request('POST', base + '/Observation',
+                                    json.dumps({"resourceType": "Observation", "n": i, "note": "心率"}),
+                                    {'Content-Type': 'application/fhir+json'})
+        res = json.loads(bytes(body))
+        assert status == 201 and res["echo"]["n"] == i and res["echo"]["note"] == "心率"
+    print("20 POSTs over", http.connects, "connections (server closes every",
+          Handler.max_per_connection, ")")
+    assert http.connects == 3
+
+    status, body = http.request('GET', base + '/close')
+    assert bytes(body) == b'{"closed": true}' and http._sock is None
+
+    for path in ('/big', '/big?chunked'):
+        status, body = http.request('GET', base + path)
+        assert status == 200 and http.truncated and set(bytes(body)) == {ord('x')}
+        status, body = http.request('GET', base + '/metadata')
+        assert json.loads(bytes(body))["resourceType"] == "CapabilityStatement"
+    print("oversized bodies drained, connection still usable")
+
+    # idle connection dropped by the server side -> transparent reconnect
+    stats['last'].shutdown(socket.SHUT_RDWR)
+    before = http.connects
+    status, body = http.request('GET', base + '/metadata')
+    assert status == 200 and http.connects == before + 1
+    print("server-side close: reconnected transparently")
+
+    # bodiless responses come back at once, on the same connection
+    before = http.connects
+    t0 = time.time()
+    for method, path, code in (('DELETE', '/Observation/1', 204), ('GET', '/notmod', 304),
+                               ('HEAD', '/big', 200)):
+        status, body = http.request(method, base + path)
+        assert status == code and len(body) == 0, (method, status)
+    status, body = http.request('GET', base + '/metadata')
+    assert status == 200 and http.connects == before and time.time() - t0 < 1.0
+    print("HEAD / 204 / 304: no body read, connection kept")
+
+    # FHIRClient on top of the transport
+    from fhir_client_enhanced import FHIRClient
+    client = FHIRClient(base, keep_alive=True)
+    before = stats['connections']
+    ids = [client.create_heart_rate_observation("p1", 70 + i)[1] for i in range(5)]
+    assert all(ids) and client.ping()
+    print("FHIRClient keep-alive: ids", ids, "| new connections:", stats['connections'] - before)
+    assert stats['connections'] - before == 1
+
+    # 201 with a body larger than the buffer: still an accepted upload
+    client = FHIRClient(base, keep_alive=True)
+    client._http._buf = bytearray(1024)
+    client._http._mv = memoryview(client._http._buf)
+    ok, res = client._make_request('POST', base + '/Observation', {"resourceType": "Observation", "big": True})
+    assert ok and res == {"id": str(stats['posts'])} and client._http._sock is None, (ok, res)
+    print("truncated 201: accepted as", res)
+
+    # an unreadable GET body is an error, not an empty result
+    ok, res = client._make_request('GET', base + '/big')
+    assert not ok, res
+    ok, res = client._make_request('DELETE', base + '/Observation/1')
+    assert ok and res is None
+
+    server.shutdown()
+    print("http_keepalive: OK")
@@ -0,0 +1,201 @@
+# lead_off.py - AD8232 導線脫落偵測（LO+ / LO- 中斷驅動狀態機）
+#
+# The AD8232 drives LO+ / LO- high while the matching electrode is off; the
+# ECG output then sits at a rail or floats, and everything downstream
+# (filters, detector, HR, uploads) works on garbage. Both pins get an
+# edge interrupt whose handler only sets a flag and the edge time, so the
+# pins are read again only after an edge or while a transition is pending.
+#
+#   ON       -> an LO pin high for debounce_ms                -> OFF
+#   OFF      -> both LO pins low                               -> SETTLING
+#   SETTLING -> still both low after settle_ms                 -> ON
+#               (the AD8232 output needs a moment to recover,
+#                an LO pin going high again starts over)       -> OFF
+#
+# poll() returns LEADS_OFF / LEADS_ON once per change, so the caller can
+# pause detection, reset filter state on reattach and stop uploads, with
+# one status event instead of a stream of empty readings.
+
+try:
+    from utime import ticks_ms, ticks_diff
+except ImportError:
+    import time
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+ON = 0
+OFF = 1
+SETTLING = 2
+
+LEADS_OFF = 'off'
+LEADS_ON = 'on'
+
+
+class LeadOff(object):
+    def __init__(self, lo_plus, lo_minus=None, debounce_ms=50, settle_ms=1000,
+                 clock=ticks_ms):
+        """
+        Args:
+            lo_plus, lo_minus: AD8232 LO+ / LO- 的輸入 Pin（有 irq() / value()）
+            debounce_ms: 導線脫落需持續多久才算數
+            settle_ms: 重新接上後等待訊號穩定的時間
+            clock: 毫秒時鐘（ISR 內記錄邊緣時間）
+        """
+        self.pins = [p for p in (lo_plus, lo_minus) if p is not None]
+        self.debounce_ms = debounce_ms
+        self.settle_ms = settle_ms
+        self.clock = clock
+
+        self.state = ON
+        self._edge = True        # read the pins on the first poll()
+        self._edge_ms = 0
+        self._since = 0          # start of the pending transition
+        self._pending = False
+
+        self.edges = 0
+        self.off_count = 0
+        self.off_ms = 0
+        self._off_at = 0
+
+        self._isr_cb = self._isr  # bind once
+        for p in self.pins:
+            p.irq(trigger=p.IRQ_RISING | p.IRQ_FALLING, handler=self._isr_cb)
+
+    def deinit(self):
+        for p in self.pins:
+            p.irq(handler=None)
+
+    def _isr(self, _pin):
+        # Pin ISR: no allocation, just remember that something changed
+        self._edge = True
+        self._edge_ms = self.clock()
+        self.edges += 1
+
+    def _off(self):
+        for p in self.pins:
+            if p.value():
+                return True
+        return False
+
+    def attached(self):
+        return self.state == ON
+
+    def poll(self, now):
+        """
+        主迴圈每次呼叫
+
+        Returns:
+            LEADS_OFF / LEADS_ON（狀態改變時一次），否則 None
+        """
+        if not (self._edge or self._pending):
+            return None
+        if self._edge:
+            self._edge = False
+            edge_ms = self._edge_ms or now
+            off = self._off()
+            if self.state == ON:
+                # (re)start the debounce at the latest edge
+                self._pending = off
+                self._since = edge_ms
+            elif self.state == OFF:
+                if not off:
+                    self.state = SETTLING
+                    self._pending = True
+                    self._since = edge_ms
+            else:
+                if off:
+                    self.state = OFF
+                    self._pending = False
+                else:
+                    self._since = edge_ms
+
+        if not self._pending:
+            return None
+        if self.state == ON:
+            if ticks_diff(now, self._since) < self.debounce_ms:
+                return None
+            self._pending = False
+            if not self._off():
+                return None
+            self.state = OFF
+            self.off_count += 1
+            self._off_at = self._since
+            return LEADS_OFF
+        # SETTLING
+        if ticks_diff(now, self._since) < self.settle_ms:
+            return None
+        self._pending = False
+        if self._off():
+            self.state = OFF
+            return None
+        self.state = ON
+        self.off_ms += ticks_diff(now, self._off_at)
+        return LEADS_ON
+
+
+# ==================== 測試代碼 ====================
+# Simulated LO+ / LO- pins with edge interrupts and a fake clock: contact
+# bounce, a real detach, a bouncy reattach and a brief touch during settling
+# must give exactly one LEADS_OFF and one LEADS_ON per real event.
+if __name__ == '__main__':
+    class FakePin(object):
+        IRQ_FALLING = 1
+        IRQ_RISING = 2
+
+        def __init__(self):
+            self.level = 0
+            self.handler = None
+
+        def irq(self, trigger=None, handler=None):
+            self.handler = handler
+
+        def value(self):
+            return self.level
+
+        def drive(self, level):
+            if level != self.level:
+                self.level = level
+                if self.handler:
+                    self.handler(self)
+
+    clock = [0]
+    lo_p = FakePin()
+    lo_m = FakePin()
+    lead = LeadOff(lo_p, lo_m, debounce_ms=50, settle_ms=1000, clock=lambda: clock[0])
+
+    # (time ms, pin, level)
+    script = [
+        (1000, lo_p, 1), (1010, lo_p, 0),                       # 10 ms glitch: ignored
+        (3000, lo_m, 1), (3020, lo_m, 0), (3030, lo_m, 1),      # bouncy detach
+        (6000, lo_m, 0), (6005, lo_m, 1), (6010, lo_m, 0),      # bouncy reattach
+        (6500, lo_p, 1), (6530, lo_p, 0),                       # touch while settling
+        (12000, lo_p, 1),                                       # off at the end
+    ]
+    events = []
+    polls = 0
+    for t in range(0, 14000, 20):
+        # DSP loop every 20 ms; edges happen in between
+        while script and script[0][0] <= t:
+            when, pin, level = script.pop(0)
+            clock[0] = when
+            pin.drive(level)
+        clock[0] = t
+        ev = lead.poll(t)
+        polls += 1
+        if ev is not None:
+            events.append((t, ev))
+
+    print("events:", events)
+    print("edges: {} | off: {} times, {} ms | polls: {}".format(
+        lead.edges, lead.off_count, lead.off_ms, polls))
+    assert [e for _, e in events] == [LEADS_OFF, LEADS_ON, LEADS_OFF]
+    assert 3080 <= events[0][0] <= 3100           # debounced from the last edge
+    assert 7520 <= events[1][0] <= 7560           # settle restarted by the touch
+    assert lead.state == OFF and not lead.attached()
+    lead.deinit()
+    assert lo_p.handler is None and lo_m.handler is None
+    print("lead_off: OK")
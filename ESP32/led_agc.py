@@ -0,0 +1,255 @@
+# led_agc.py - MAX30102 LED 電流自動控制（AGC）
+#
+# The right LED current depends on skin tone and fit: too high and the
+# 18-bit ADC clips, too low and the pulse sits in the noise floor. LedAGC
+# averages each channel's DC level over interval_ms and steers the IR and
+# RED pulse amplitudes (0.2 mA per code) towards `target` x full scale:
+#
+#   - inside the dead band (target +- band) nothing changes, so the signal
+#     is not disturbed while it is usable
+#   - outside it the new current is amp * target / dc (the ambient-
+#     cancelled DC is proportional to LED current), limited to max_step
+#     codes per update and to [amp_min, amp_max]
+#   - a clipping window (peak near full scale) halves the current at once
+#   - a DC under absent_level means no finger: the current drops back to
+#     probe_amp instead of climbing to the maximum
+#
+# After every change the next settle_ms of samples are ignored (the LED and
+# the ambient cancellation need a moment). update() returns True when it
+# changed a current so the caller can restart DC/AC tracking. Running only
+# as bright as needed also saves most of the LED power of a fixed
+# MEDIUM (25.4 mA) setting.
+
+try:
+    from utime import ticks_add, ticks_diff
+except ImportError:
+    def ticks_add(a, b):
+        return a + b
+
+    def ticks_diff(a, b):
+        return a - b
+
+MA_PER_CODE = 0.2
+
+
+class LedAGC(object):
+    def __init__(self, sensor, full_scale=None, target=0.5, band=0.2,
+                 interval_ms=500, settle_ms=300, max_step=0x20,
+                 amp_min=0x04, amp_max=0xFF, probe_amp=0x1F,
+                 absent_level=0.02):
+        """
+        Args:
+            sensor: MAX30102（需 set_pulse_amplitude_ir / set_pulse_amplitude_red）
+            full_scale: ADC 滿刻度（預設依 sensor 的解析度）
+            target, band: 目標 DC 與死區（滿刻度的比例）
+            interval_ms: 每次調整間隔（DC 平均視窗）
+            settle_ms: 調整後忽略的時間
+            max_step: 每次最多調整的電流碼
+        """
+        self.sensor = sensor
+        if full_scale is None:
+            full_scale = 0x3FFFF >> getattr(sensor, '_fifo_shift', 0)
+        self.full_scale = full_scale
+        self._target = int(full_scale * target)
+        self._low = int(full_scale * (target - band))
+        self._high = int(full_scale * (target + band))
+        self._clip = full_scale - (full_scale >> 6)
+        self._absent = int(full_scale * absent_level)
+
+        self.interval_ms = interval_ms
+        self.settle_ms = settle_ms
+        self.max_step = max_step
+        self.amp_min = amp_min
+        self.amp_max = amp_max
+        self.probe_amp = probe_amp
+
+        # [IR, RED]
+        self.amp = [probe_amp, probe_amp]
+        self._sum = [0, 0]
+        self._peak = [0, 0]
+        self._n = 0
+        self._window_start = None
+        self._settle_until = None
+
+        self.finger = False
+        self.changes = 0
+        self.last_change = None
+
+        sensor.set_pulse_amplitude_ir(probe_amp)
+        sensor.set_pulse_amplitude_red(probe_amp)
+
+    def current_ma(self):
+        return (self.amp[0] * MA_PER_CODE, self.amp[1] * MA_PER_CODE)
+
+    def update(self, t, ir, red):
+        """
+        每個樣本呼叫一次
+
+        Args:
+            t: 樣本時間（ticks_ms）
+
+        Returns:
+            bool: 這次是否改了 LED 電流
+        """
+        if self._settle_until is not None:
+            if ticks_diff(t, self._settle_until) < 0:
+                return False
+            self._settle_until = None
+            self._window_start = None
+        if self._window_start is None:
+            self._window_start = t
+
+        s = self._sum
+        p = self._peak
+        s[0] += ir
+        s[1] += red
+        if ir > p[0]:
+            p[0] = ir
+        if red > p[1]:
+            p[1] = red
+        self._n += 1
+        if ticks_diff(t, self._window_start) < self.interval_ms:
+            return False
+
+        n = self._n
+        changed = False
+        present = False
+        for ch in (0, 1):
+            dc = s[ch] // n
+            if dc >= self._absent:
+                present = True
+            amp = self._next_amp(self.amp[ch], dc, p[ch])
+            if amp != self.amp[ch]:
+                self.amp[ch] = amp
+                changed = True
+            s[ch] = 0
+            p[ch] = 0
+        self._n = 0
+        self._window_start = t
+        self.finger = present
+
+        if changed:
+            self.sensor.set_pulse_amplitude_ir(self.amp[0])
+            self.sensor.set_pulse_amplitude_red(self.amp[1])
+            self._settle_until = ticks_add(t, self.settle_ms)
+            self.changes += 1
+            self.last_change = t
+        return changed
+
+    def _next_amp(self, amp, dc, peak):
+        if peak >= self._clip:
+            # clipping: the window is useless, back off hard
+            new = amp >> 1
+        elif dc < self._absent and amp >= self.probe_amp:
+            # nothing reflects the light: no finger, don't ramp up
+            return self.probe_amp
+        elif self._low <= dc <= self._high:
+            return amp
+        else:
+            new = amp * self._target // (dc if dc > 0 else 1)
+            if new > amp + self.max_step:
+                new = amp + self.max_step
+            elif new < amp - self.max_step:
+                new = amp - self.max_step
+            if dc < self._absent and new > self.probe_amp:
+                new = self.probe_amp
+        if new < self.amp_min:
+            new = self.amp_min
+        elif new > self.amp_max:
+            new = self.amp_max
+        return new
+
+
+# ==================== 測試代碼 ====================
+# Closed loop against a simulated sensor: DC proportional to LED current
+# times a per-person optical gain, 1.5% pulsatile AC at 72 bpm, noise, and
+# clipping at the 18-bit full scale.
+if __name__ == '__main__':
+    import math
+    import random
+
+    FULL = 0x3FFFF
+
+    class SimSensor(object):
+        def __init__(self, gain_ir, gain_red):
+            # ADC counts per LED code with a finger in place
+            self.gain = [gain_ir, gain_red]
+            self.amp = [0, 0]
+            self.finger = True
+            self.writes = 0
+
+        def set_pulse_amplitude_ir(self, amp):
+            self.amp[0] = amp
+            self.writes += 1
+
+        def set_pulse_amplitude_red(self, amp):
+            self.amp[1] = amp
+            self.writes += 1
+
+        def sample(self, t):
+            pulse = 1 + 0.015 * math.sin(2 * math.pi * 1.2 * t / 1000)
+            out = []
+            for ch in (0, 1):
+                g = self.gain[ch] if self.finger else 8
+                v = int(g * self.amp[ch] * pulse + random.gauss(0, 40))
+                out.append(min(max(v, 0), FULL))
+            return out
+
+    random.seed(17)
+
+    def run(sensor, agc, seconds, t0=0):
+        # 50 Hz. Returns (clipped samples after the first 5 s, mean LED mA,
+        # end time); checks the rate limit on every change.
+        clipped = 0
+        ma = 0.0
+        n = seconds * 50
+        for k in range(n):
+            t = t0 + k * 20
+            ir, red = sensor.sample(t)
+            before = list(agc.amp)
+            agc.update(t, ir, red)
+            for ch in (0, 1):
+                d = agc.amp[ch] - before[ch]
+                # only clipping or a lifted finger may cut by more than max_step
+                assert d <= agc.max_step
+                assert d >= -agc.max_step or agc.amp[ch] in (
+                    before[ch] >> 1, agc.amp_min, agc.probe_amp)
+            if k >= 250 and (ir >= FULL or red >= FULL):
+                clipped += 1
+            ma += sum(agc.current_ma())
+        return clipped, ma / n, t0 + n * 20
+
+    cases = (
+        ("light skin, tight fit", 4000, 2800),
+        ("typical", 1200, 900),
+        ("dark skin, loose fit", 420, 300),
+    )
+    for label, g_ir, g_red in cases:
+        sensor = SimSensor(g_ir, g_red)
+        agc = LedAGC(sensor)
+        clipped, ma, _ = run(sensor, agc, 30)
+        dc = [g * a for g, a in zip(sensor.gain, agc.amp)]
+        in_band = all(agc._low <= v <= agc._high or a == agc.amp_max
+                      for v, a in zip(dc, agc.amp))
+        # the same person at a fixed MEDIUM (0x7F) current
+        fixed = SimSensor(g_ir, g_red)
+        fixed.amp = [0x7F, 0x7F]
+        fixed_clip = sum(1 for k in range(1500) if max(fixed.sample(k * 20)) >= FULL)
+        print("{:<22}: LED {} -> DC {:.0%}/{:.0%} FS | {} changes | clipped {} (fixed MEDIUM: {})"
+              " | {:.1f} mA (fixed MEDIUM: {:.1f} mA)".format(
+                  label, [hex(a) for a in agc.amp], dc[0] / FULL, dc[1] / FULL,
+                  agc.changes, clipped, fixed_clip, ma, 2 * 0x7F * MA_PER_CODE))
+        assert in_band and clipped == 0 and agc.finger
+
+    # finger lifted: back to the probe current, not to the maximum
+    sensor = SimSensor(420, 300)
+    agc = LedAGC(sensor)
+    _, _, t = run(sensor, agc, 30)
+    assert agc.amp[0] > agc.probe_amp
+    sensor.finger = False
+    _, _, t = run(sensor, agc, 10, t)
+    assert agc.amp == [agc.probe_amp, agc.probe_amp] and not agc.finger
+    sensor.finger = True
+    run(sensor, agc, 30, t)
+    assert agc.finger and agc.amp[0] > agc.probe_amp
+    print("finger off / on: OK")
@@ -1,33 +1,52 @@
-from utime import ticks_ms, ticks_diff, sleep_ms
-from machine import Pin, ADC
+from utime import ticks_ms, ticks_diff, localtime, time
+try:
+    from utime import time_ns
+except ImportError:
+    time_ns = None
+from machine import Pin, ADC, unique_id
+from array import array
+import micropython
 import network
+import uasyncio as asyncio
 import ujson
+import ubinascii
 
 from fhir_client_enhanced import FHIRClient
-
-# =========================
-# IIR Filter
-# =========================
-class IIR_filter:
-    def __init__(self, alpha):
-        self.old_value = 0.0
-        self.alpha = alpha
-
-    def step(self, value):
-        value = (self.old_value * self.alpha + value * (1 - self.alpha))
-        self.old_value = value
-        return value
+from ecg_engine import ECGEngine, LocalPeakDetector
+from pan_tompkins import PanTompkinsDetector
+from adc_sampler import ADCSampler
+from uploader import UploadQueue, Uploader
+from waveform import WaveformChunker
+from store_forward import StoreForward, BUILDERS
+from wifi_link import WiFiLink
+from hrv_engine import HRVEngine
+from rr_stream import RRStream
+from sqi import SignalQuality
+from lead_off import LeadOff, LEADS_OFF, LEADS_ON
 
 # =========================
 # Config
 # =========================
 WIFI_SSID = "tungman142"
 WIFI_PASSWORD = "tungman212142"
+WIFI_STATIC_IP = True       # 重連時沿用上次 DHCP 拿到的 IP（快取於 wifi_cache.json）
+WIFI_FAST_TIMEOUT_MS = 3000  # 快取 AP 連不上就改掃描 + DHCP
+WIFI_TIMEOUT_MS = 30000
 
 FHIR_BASE_URL = "http://192.168.0.9:8080/fhir"
 PATIENT_ID = "1139"
+FHIR_PROBE_TIMEOUT_S = 2
+FHIR_KEEP_ALIVE = True      # 一條 HTTP/1.1 連線重複使用（http_keepalive.py）
+FHIR_TEMPLATES = True       # 心率 / 生理數據用預先序列化的 JSON 範本（obs_template.py）
 
 ADC_PIN = 36
+
+# AD8232 lead-off outputs (high while an electrode is off): detection pauses,
+# ECG uploads stop, and filters restart LEAD_SETTLE_MS after reattaching
+LEAD_OFF_DETECT = True
+LO_PLUS_PIN = 32
+LO_MINUS_PIN = 33
+LEAD_SETTLE_MS = 1000
 BLUE_LED_PIN = 5
 BUZZER_PIN = 2
 BUZZER_ACTIVE_HIGH = True   # 蜂鳴器不叫就改 False
@@ -40,6 +59,10 @@ PRINT_EVERY_MS = 3000
 BEEP_ON_BEAT = True
 BEEP_MS = 60
 
+# Beat detector: "local_peak" (DC remover + nodc local peak)
+#             or "pan_tompkins" (integer Pan-Tompkins, robust to T-waves/noise)
+DETECTOR = "local_peak"
+
 # DC remover + nodc peak detection
 DC_ALPHA = 0.995
 LEVEL_ALPHA = 0.95
@@ -48,10 +71,87 @@ REFRACTORY_MS = 250
 
 RR_MIN_MS = 270
 RR_MAX_MS = 2000
-TARGET_N_BEATS = 3
+# Per-beat HR: trimmed mean of the last HR_WINDOW in-range RRs, HR_TRIM
+# dropped at each end (hr_estimator.py); HR below HR_MIN_CONFIDENCE (0-100)
+# is printed but not uploaded
+HR_WINDOW = 9
+HR_TRIM = 2
+HR_MIN_CONFIDENCE = 40
+
+# Signal quality index per SQI_WINDOW_MS (sqi.py): ADC saturation, baseline
+# wander and kurtosis. Low-quality windows flag HR / waveform / RR
+# Observations in their note; with SQI_SUPPRESS = True their HR is not
+# uploaded at all and their beats are kept out of HRV.
+# SQI_AGREEMENT also runs a second detector (Pan-Tompkins, or the local-peak
+# one when DETECTOR is "pan_tompkins") and requires the two to agree. Off by
+# default: with NODC_OFFSET / REFRACTORY_MS above the local-peak detector
+# also fires between beats on clean signal, so about half of the clean
+# windows would fail it (see the sqi.py self-test)
+SQI_ENABLE = True
+SQI_WINDOW_MS = 5000
+SQI_AGREEMENT = False
+SQI_SUPPRESS = False
 
 SAMPLE_MS = 10
 
+# Timer-driven sampling: the ring holds ~5 s at 100 Hz, drained in batches
+SAMPLE_TIMER_ID = 0
+SAMPLE_BUF_LEN = 512
+DRAIN_BATCH = 64
+
+# uasyncio tasks: DSP pass interval, upload queue depth, end-of-test flush
+DSP_PERIOD_MS = 20
+UPLOAD_QUEUE_LEN = 12
+UPLOAD_FLUSH_MS = 15000
+
+# Raw ECG strips as valueSampledData, one Observation per chunk
+WAVEFORM_UPLOAD = True
+WAVEFORM_CHUNK_MS = 5000
+WAVEFORM_FILTERED = False      # True: DC removed + 25 Hz low-pass
+ECG_MV_PER_COUNT = 3300 / 1023 / 1100   # 3.3 V / 10-bit ADC / AD8232 gain
+
+# Beat-event mode: every R-peak goes into an RR series (rr_stream.py),
+# uploaded as one valueSampledData Observation per RR_FLUSH_MS; the periodic
+# HR Observation is then not sent (HR is still printed), so the HR tab and
+# the HR half of the dual-sensor Bundle stay empty - opt-in
+RR_STREAM = False
+RR_FLUSH_MS = 30000
+
+# Store-and-forward: observations that cannot be uploaded go to flash and
+# are replayed later as transaction Bundles, one batch per REPLAY_PERIOD_MS
+STORE_FORWARD = True
+SF_DIR = "sf"
+SF_SEGMENT_BYTES = 8192
+SF_MAX_SEGMENTS = 16       # at most 128 KB of flash
+REPLAY_BATCH = 10
+REPLAY_PERIOD_MS = 2000
+
+# Dual-sensor mode: MAX30102 PPG (SpO2) on I2C next to the ECG. Both run on
+# the same uasyncio scheduler; every PRINT_EVERY_MS the ECG heart rate and
+# the latest SpO2 go out together in one transaction Bundle
+DUAL_SENSOR = False
+PPG_SDA_PIN = 21
+PPG_SCL_PIN = 22
+PPG_I2C_FREQ = 400000
+PPG_INT_PIN = None          # MAX30102 INT（需上拉）; None = 輪詢
+PPG_POLL_MS = 100           # 輪詢間隔（FIFO 32 樣本 @ 50 Hz = 640 ms）
+PPG_SAMPLE_RATE = 400       # 400 Hz / 平均 8 = 50 Hz（SpO2Engine 的預設）
+PPG_SAMPLE_AVG = 8
+PPG_LED_AGC = True          # LED 電流自動控制（led_agc.py）
+SPO2_MAX_AGE_MS = 8000
+
+# Pulse transit time (dual-sensor only): ECG R-peak -> PPG upstroke delay,
+# uploaded as one summary Observation (mean/SD/min/max) per PTT_SUMMARY_MS
+# and at the end of the test
+PTT_ENABLE = True
+PTT_SUMMARY_MS = 30000
+PTT_MIN_PAIRS = 5
+
+# Heart rate variability (SDNN / RMSSD / pNN50 / Poincare SD1, SD2) over the
+# last HRV_WINDOW NN intervals; one Observation at the end of the test
+HRV_ENABLE = True
+HRV_WINDOW = 300            # 300 NN ≈ 5 分鐘短期 HRV
+
 # =========================
 # Helpers (no HTTP here)
 # =========================
@@ -66,6 +166,25 @@ def beep(buzzer: Pin, ms: int):
     buzzer_on(buzzer)
     return ticks_ms() + ms
 
+# (ticks_ms, wall-clock ms) taken once: every effectiveDateTime is placed
+# from the same pair, so timestamps are exact to the millisecond relative to
+# each other (RR chunks join up beat for beat), even where the RTC itself
+# only gives whole seconds
+_wall_anchor = None
+
+def wall_time_iso(t_ms):
+    # effectiveDateTime (with milliseconds) for a ticks_ms timestamp
+    global _wall_anchor
+    if _wall_anchor is None:
+        now = ticks_ms()
+        wall = time_ns() // 1000000 if time_ns is not None else time() * 1000
+        _wall_anchor = (now, wall)
+    wall_ms = _wall_anchor[1] + ticks_diff(t_ms, _wall_anchor[0])
+    t = localtime(wall_ms // 1000)
+    return "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:03d}".format(
+        t[0], t[1], t[2], t[3], t[4], t[5], wall_ms % 1000
+    )
+
 def blink_led_step(led: Pin, now, next_toggle_ts, interval_ms):
     if ticks_diff(now, next_toggle_ts) >= 0:
         led.value(0 if led.value() else 1)
@@ -85,199 +204,509 @@ adc = ADC(Pin(ADC_PIN))
 adc.width(ADC.WIDTH_10BIT)
 adc.atten(ADC.ATTN_11DB)
 
-dc_remover = IIR_filter(DC_ALPHA)
-nodc_level_filter = IIR_filter(LEVEL_ALPHA)
+if DETECTOR == "pan_tompkins":
+    detector = PanTompkinsDetector(sample_ms=SAMPLE_MS)
+else:
+    detector = LocalPeakDetector(DC_ALPHA, LEVEL_ALPHA, NODC_OFFSET, REFRACTORY_MS)
+
+engine = ECGEngine(
+    source=adc.read,
+    clock=ticks_ms,
+    detector=detector,
+    sample_ms=SAMPLE_MS,
+    rr_min_ms=RR_MIN_MS,
+    rr_max_ms=RR_MAX_MS,
+    hr_window=HR_WINDOW,
+    hr_trim=HR_TRIM
+)
+det = engine.detector
+
+sqi = None
+if SQI_ENABLE:
+    second = None
+    if not SQI_AGREEMENT:
+        pass
+    elif DETECTOR == "pan_tompkins":
+        second = LocalPeakDetector(DC_ALPHA, LEVEL_ALPHA, NODC_OFFSET, REFRACTORY_MS)
+    else:
+        second = PanTompkinsDetector(sample_ms=SAMPLE_MS)
+    sqi = SignalQuality(second=second, sample_ms=SAMPLE_MS, window_ms=SQI_WINDOW_MS)
+lead = None
+if LEAD_OFF_DETECT:
+    lead = LeadOff(Pin(LO_PLUS_PIN, Pin.IN), Pin(LO_MINUS_PIN, Pin.IN),
+                   settle_ms=LEAD_SETTLE_MS)
+
+# SQI window counters at the last RR chunk
+rr_sqi_windows = 0
+rr_sqi_bad = 0
+hrv = HRVEngine(window=HRV_WINDOW, rr_min_ms=RR_MIN_MS, rr_max_ms=RR_MAX_MS) if HRV_ENABLE else None
+
+micropython.alloc_emergency_exception_buf(100)
+sampler = ADCSampler(adc.read, capacity=SAMPLE_BUF_LEN, period_ms=SAMPLE_MS,
+                     timer_id=SAMPLE_TIMER_ID)
+drain_buf = array('H', bytes(2 * DRAIN_BATCH))
+
+chunker = None
+if WAVEFORM_UPLOAD:
+    chunker = WaveformChunker(chunk_len=WAVEFORM_CHUNK_MS // SAMPLE_MS,
+                              sample_ms=SAMPLE_MS, filtered=WAVEFORM_FILTERED)
+
+rr_stream = RRStream(flush_ms=RR_FLUSH_MS) if RR_STREAM else None
+
+store = None
+if STORE_FORWARD:
+    store = StoreForward(SF_DIR, device_id=ubinascii.hexlify(unique_id()).decode(),
+                         segment_bytes=SF_SEGMENT_BYTES, max_segments=SF_MAX_SEGMENTS)
+    print("[SF] backlog:", store.backlog, "records")
+
+ppg_sensor = None
+pulse_ox = None
+ptt = None
+if DUAL_SENSOR:
+    from machine import SoftI2C
+    from max30102 import MAX30102
+    from pulse_oximeter import Pulse_oximeter
+    from led_agc import LedAGC
+    from ptt_engine import PTTEngine
+
+    try:
+        i2c = SoftI2C(sda=Pin(PPG_SDA_PIN), scl=Pin(PPG_SCL_PIN), freq=PPG_I2C_FREQ)
+        ppg_sensor = MAX30102(i2c=i2c)
+        ppg_sensor.setup_sensor(sample_rate=PPG_SAMPLE_RATE, sample_avg=PPG_SAMPLE_AVG)
+        if PPG_INT_PIN is not None:
+            ppg_sensor.enable_interrupt_mode(Pin(PPG_INT_PIN, Pin.IN, Pin.PULL_UP))
+        agc = LedAGC(ppg_sensor) if PPG_LED_AGC else None
+        ptt = PTTEngine() if PTT_ENABLE else None
+        pulse_ox = Pulse_oximeter(ppg_sensor, agc=agc,
+                                  on_beat=ptt.add_upstroke if ptt is not None else None)
+    except RuntimeError as e:
+        print("[X] MAX30102:", e, "-> ECG only")
+        ppg_sensor = None
+        ptt = None
 
 # =========================
-# WiFi + FHIR
+# WiFi + FHIR (connected in the background by net_task)
 # =========================
 print("=" * 50)
-print("ESP32 HR 30s | DC remover + nodc local peak (NO AC_extractor)")
+print("ESP32 HR 30s | detector:", DETECTOR, "| SpO2:", "on" if ppg_sensor is not None else "off")
 print("=" * 50)
 
 sta = network.WLAN(network.STA_IF)
 sta.active(True)
-sta.connect(WIFI_SSID, WIFI_PASSWORD)
-
-timeout = 30
-while (not sta.isconnected()) and timeout > 0:
-    sleep_ms(1000)
-    timeout -= 1
-    print(".", end="")
+link = WiFiLink(sta, WIFI_SSID, WIFI_PASSWORD, static_ip=WIFI_STATIC_IP,
+                fast_timeout_ms=WIFI_FAST_TIMEOUT_MS, timeout_ms=WIFI_TIMEOUT_MS)
 
 fhir_ok = False
-fhir_client = None
+fhir_client = FHIRClient(FHIR_BASE_URL, keep_alive=FHIR_KEEP_ALIVE,
+                         templates=FHIR_TEMPLATES)
 
-if not sta.isconnected():
-    print("\n[X] WiFi failed -> local only")
-else:
-    ip = sta.ifconfig()[0]
-    print("\n[OK] WiFi connected, IP:", ip)
+# =========================
+# Tasks
+# =========================
+# network  : WiFi association + FHIR probe, alongside the measurement
+# sampling : hardware timer -> ADCSampler ring (never waits for anything)
+# DSP      : drain ring -> ECGEngine, LED/buzzer, every PRINT_EVERY_MS
+#            print + queue the HR (and SpO2 in dual-sensor mode) for
+#            upload; full waveform chunks are queued as they complete
+# PPG      : (dual-sensor) MAX30102 FIFO -> Pulse_oximeter / SpO2Engine,
+#            woken by the INT pin or every PPG_POLL_MS
+# uploader : UploadQueue -> deliver() -> fhir_client, or flash when the
+#            server cannot be reached (may block on the network)
+# replay   : flash backlog -> transaction Bundles while the uploader is idle
+upload_queue = UploadQueue(maxlen=UPLOAD_QUEUE_LEN)
+uploader = Uploader(upload_queue)
 
-    fhir_client = FHIRClient(FHIR_BASE_URL)
-    if fhir_client.test_connection():
+# store samples (for session summary / debugging)
+session_samples = []
+
+SENDERS = {
+    'hr': 'create_heart_rate_observation',
+    'vs': 'create_vital_sign_observation',
+    'wf': 'create_waveform_observation',
+    'ptt': 'create_ptt_observation',
+    'hrv': 'create_hrv_observation',
+    'rr': 'create_rr_observation',
+}
+
+
+def can_deliver():
+    return fhir_ok or store is not None
+
+
+def deliver(kind, kwargs):
+    # runs in the uploader task: send now, or keep it on flash for replay
+    if fhir_ok:
+        success, res = getattr(fhir_client, SENDERS[kind])(**kwargs)
+        if success or store is None:
+            return success, res
+    key = store.append(kind, kwargs)
+    return False, "stored on flash as " + key
+
+
+def deliver_batch(items):
+    # items: [(kind, kwargs), ...] -> one transaction Bundle, or one flash
+    # record each (replayed later like any other)
+    if fhir_ok:
+        resources = [getattr(fhir_client, BUILDERS[kind])(**kwargs) for kind, kwargs in items]
+        success, res = fhir_client.post_transaction(resources)
+        if success or store is None:
+            return success, res
+    keys = [store.append(kind, kwargs) for kind, kwargs in items]
+    return False, "stored on flash as " + ", ".join(keys)
+
+
+def sqi_note():
+    # None while the signal is fine (or SQI is off)
+    if sqi is None or sqi.ok:
+        return None
+    return sqi.note()
+
+
+def queue_waveform(chunk):
+    # key None: every chunk is kept, never coalesced
+    if can_deliver():
+        samples, t0_ms = chunk
+        upload_queue.put(None, deliver, 'wf', {
+            'patient_id': PATIENT_ID,
+            'samples': samples,
+            'period_ms': SAMPLE_MS,
+            'origin': chunker.origin(samples),
+            'factor': ECG_MV_PER_COUNT,
+            'unit': "mV",
+            'measurement_time': wall_time_iso(t0_ms),
+            'notes': sqi_note()
+        })
+
+
+def queue_rr(chunk):
+    # key None: every RR chunk is kept, never coalesced; the note counts the
+    # low-quality SQI windows since the previous chunk
+    global rr_sqi_windows, rr_sqi_bad
+    notes = None
+    if sqi is not None:
+        bad = sqi.bad_windows - rr_sqi_bad
+        if bad:
+            notes = "SQI low in {} of {} windows".format(bad, sqi.windows - rr_sqi_windows)
+        rr_sqi_windows = sqi.windows
+        rr_sqi_bad = sqi.bad_windows
+    if can_deliver():
+        rr, t0_ms = chunk
+        upload_queue.put(None, deliver, 'rr', {
+            'patient_id': PATIENT_ID,
+            'rr_ms': rr,
+            'measurement_time': wall_time_iso(t0_ms),
+            'notes': notes
+        })
+
+
+def queue_hrv_summary(now):
+    # one HRV Observation per session (None: not enough NN intervals)
+    metrics = hrv.metrics()
+    print("[HRV] beats:", hrv.beats, "| NN:", hrv.accepted, "| rejected:", hrv.rejected)
+    if metrics is None:
+        return
+    print("[HRV] SDNN", metrics['sdnn'], "ms | RMSSD", metrics['rmssd'], "ms | pNN50",
+          metrics['pnn50'], "% | SD1", metrics['sd1'], "| SD2", metrics['sd2'])
+    if can_deliver():
+        kwargs = {'patient_id': PATIENT_ID, 'measurement_time': wall_time_iso(now)}
+        kwargs.update(metrics)
+        upload_queue.put(None, deliver, 'hrv', kwargs)
+
+
+def queue_ptt_summary(now):
+    # key None: every summary is kept, never coalesced
+    summary = ptt.take_summary(PTT_MIN_PAIRS)
+    if summary is None:
+        return
+    n, mean, sd, lo, hi = summary
+    print("[PTT]", mean, "ms | SD", sd, "| range", lo, "-", hi, "| pairs", n)
+    if can_deliver():
+        upload_queue.put(None, deliver, 'ptt', {
+            'patient_id': PATIENT_ID,
+            'mean_ms': mean,
+            'sd_ms': sd,
+            'count': n,
+            'min_ms': lo,
+            'max_ms': hi,
+            'measurement_time': wall_time_iso(now)
+        })
+
+
+async def net_task():
+    global fhir_ok
+    if not await link.connect():
+        print("[X] WiFi failed -> local only")
+        return
+    print("[OK] WiFi connected in", link.connect_ms, "ms",
+          "(cached AP)" if link.fast else "(scan)", "| IP:", sta.ifconfig()[0])
+
+    if fhir_client.ping(FHIR_PROBE_TIMEOUT_S):
         print("[OK] FHIR reachable:", FHIR_BASE_URL)
         fhir_ok = True
     else:
         print("[X] FHIR unreachable -> local only")
 
-# =========================
-# Test Start
-# =========================
-print("\n[TEST] Start 30s measurement")
-beep_until = beep(buzzer, START_END_BEEP_MS)
-
-
-test_start = ticks_ms()
-test_end = test_start + TEST_DURATION_MS
 
-next_led_toggle = ticks_ms()
-next_print = ticks_ms()
-next_sample = ticks_ms()
-
-# init with first sample
-raw_val = adc.read()
-ecg = raw_val
-dc_remover.old_value = float(ecg)
-
-dc_val = float(ecg)
-nodc = 0.0
-nodc_level = 0.0
-trigger_level = 0.0
-
-# local peak buffers
-n2 = 0.0
-n1 = 0.0
-n0 = 0.0
-
-lockout_until = 0
-beep_until = 0
-
-beat_time_mark = ticks_ms()
-last_rr = -1
-num_beats = 0
-tot_intval = 0
-heart_rate = 0.0
-last_hr_update_ts = ticks_ms()
-
-# store samples (for session summary / debugging)
-session_samples = []
-
-# (optional) avoid uploading same HR too frequently
-last_uploaded_hr = None
-
-while True:
-    now = ticks_ms()
-
-    next_led_toggle = blink_led_step(blue_led, now, next_led_toggle, LED_BLINK_MS)
-
-    if ticks_diff(now, test_end) >= 0:
-        break
-
-    if beep_until != 0 and ticks_diff(now, beep_until) > 0:
-        buzzer_off(buzzer)
-        beep_until = 0
-
-    # sample every SAMPLE_MS
-    if ticks_diff(now, next_sample) >= 0:
-        next_sample = now + SAMPLE_MS
-
-        raw_val = adc.read()
-        ecg = raw_val
-
-        # DC remove
-        dc_val = dc_remover.step(ecg)
-        nodc = ecg - dc_val
-
-        # background level
-        nodc_level = nodc_level_filter.step(abs(nodc))
-        trigger_level = nodc_level + NODC_OFFSET
-
-        # update local peak buffers
-        n2, n1, n0 = n1, n0, nodc
-
-        # local peak detect
-        if (ticks_diff(now, lockout_until) >= 0) and (n1 > n2) and (n1 > n0) and (n1 > trigger_level):
-            lockout_until = now + REFRACTORY_MS
-
-            rr = ticks_diff(now, beat_time_mark)
-            last_rr = rr
-            beat_time_mark = now
-
-            if RR_MAX_MS > rr > RR_MIN_MS:
-                tot_intval += rr
-                num_beats += 1
-                if num_beats == TARGET_N_BEATS:
-                    seconds = tot_intval / 1000.0
-                    heart_rate = round(TARGET_N_BEATS / (seconds / 60.0), 1)
-                    last_hr_update_ts = now
-                    tot_intval = 0
-                    num_beats = 0
-            else:
-                tot_intval = 0
-                num_beats = 0
-
-            if BEEP_ON_BEAT:
-                beep_until = beep(buzzer, BEEP_MS)
-
-    # every 3 seconds: print + store sample + upload HR (via fhir_client)
-    if ticks_diff(now, next_print) >= 0:
-        next_print = now + PRINT_EVERY_MS
-        t_ms = ticks_diff(now, test_start)
-        age_ms = ticks_diff(now, last_hr_update_ts)
-
-        # store sample
-        session_samples.append({"t_ms": int(t_ms), "hr": float(heart_rate)})
-
-        # print status
-        if heart_rate > 0 and age_ms < 8000:
-            print("[HR]", heart_rate, "bpm",
-                  "| rr=", last_rr, "ms",
-                  "| nodc=", int(nodc),
-                  "| lvl=", int(nodc_level),
-                  "| trig=", int(trigger_level))
+async def ppg_task():
+    # The MAX30102 buffers 32 samples itself, so this only has to run a few
+    # times per second; a blocking upload longer than that shows up in
+    # ppg_sensor.overflow_count
+    while True:
+        if PPG_INT_PIN is not None:
+            await ppg_sensor.wait_and_drain()
         else:
-            print("[NO_HR] t=", int(t_ms), "ms",
-                  "| raw=", int(raw_val),
-                  "| ecg=", int(ecg),
-                  "| dc=", int(dc_val),
-                  "| nodc=", int(nodc),
-                  "| lvl=", int(nodc_level),
-                  "| trig=", int(trigger_level),
-                  "| last_rr=", last_rr)
-
-        # upload this HR sample as a standard Heart Rate Observation
-        if fhir_ok and fhir_client is not None:
+            ppg_sensor.check()
+        pulse_ox.drain()
+        if PPG_INT_PIN is None:
+            await asyncio.sleep_ms(PPG_POLL_MS)
+
+
+def restart_dsp(now, first_sample):
+    # fresh filter / detector state (test start, electrodes back on)
+    engine.start(now, first_sample)
+    if chunker is not None:
+        chunker.reset(first_sample)
+    if sqi is not None:
+        sqi.reset(first_sample)
+
+
+def on_leads_off(now, t_ms):
+    # one status event instead of a [NO_HR] line every PRINT_EVERY_MS; the
+    # beats before the detach still go out with their RR chunk
+    print("[LEADS] off at t=", int(t_ms), "ms -> detection paused, ECG uploads stopped")
+    session_samples.append({"t_ms": int(t_ms), "event": "leads_off"})
+    if rr_stream is not None:
+        chunk = rr_stream.flush()
+        if chunk is not None:
+            queue_rr(chunk)
+        rr_stream.restart()
+    if hrv is not None:
+        hrv.gap()
+    if ptt is not None:
+        ptt.restart()
+
+
+def on_leads_on(now, t_ms):
+    print("[LEADS] on at t=", int(t_ms), "ms -> detection restarts")
+    session_samples.append({"t_ms": int(t_ms), "event": "leads_on"})
+
+
+async def dsp_task():
+    print("\n[TEST] Start 30s measurement")
+    beep_until = beep(buzzer, START_END_BEEP_MS)
+
+    test_start = ticks_ms()
+    test_end = test_start + TEST_DURATION_MS
+
+    next_led_toggle = ticks_ms()
+    next_print = ticks_ms()
+    next_ptt = test_start + PTT_SUMMARY_MS
+
+    # init with first sample, then hand the ADC over to the timer
+    restart_dsp(test_start, adc.read())
+    sampler.start(test_start)
+    print("[BOOT] first sample at", test_start, "ms")
+    leads_on = True
+    reattached = False
+
+    # (optional) avoid uploading same HR too frequently
+    last_queued_hr = None
+    last_queued_spo2_at = None
+
+    while True:
+        now = ticks_ms()
+
+        next_led_toggle = blink_led_step(blue_led, now, next_led_toggle, LED_BLINK_MS)
+
+        if ticks_diff(now, test_end) >= 0:
+            break
+
+        if beep_until != 0 and ticks_diff(now, beep_until) > 0:
+            buzzer_off(buzzer)
+            beep_until = 0
+
+        if lead is not None:
+            event = lead.poll(now)
+            if event == LEADS_OFF:
+                leads_on = False
+                on_leads_off(now, ticks_diff(now, test_start))
+            elif event == LEADS_ON:
+                leads_on = True
+                reattached = True
+                on_leads_on(now, ticks_diff(now, test_start))
+
+        # drain samples taken by the timer since the last pass (and drop
+        # them while the leads are off)
+        while True:
+            n = sampler.drain(drain_buf)
+            if n == 0:
+                break
+            if not leads_on:
+                continue
+            seq = sampler.batch_seq
+            for i in range(n):
+                raw = drain_buf[i]
+                t = sampler.seq_to_ms(seq + i)
+                if reattached:
+                    reattached = False
+                    restart_dsp(t, raw)
+                    continue
+                if engine.update(raw, t):
+                    if BEEP_ON_BEAT:
+                        beep_until = beep(buzzer, BEEP_MS)
+                    if ptt is not None:
+                        ptt.add_r_peak(det.beat_ts)
+                    if sqi is not None:
+                        sqi.add_beat(det.beat_ts)
+                    if hrv is not None:
+                        if sqi is None or sqi.ok or not SQI_SUPPRESS:
+                            hrv.update(engine.last_rr)
+                        else:
+                            # next NN must not be differenced across the
+                            # low-quality stretch
+                            hrv.gap()
+                    if rr_stream is not None:
+                        chunk = rr_stream.add(det.beat_ts)
+                        if chunk is not None:
+                            queue_rr(chunk)
+                if sqi is not None and sqi.update(raw, t) and not sqi.ok:
+                    print("[SQI]", sqi.note())
+                if chunker is not None:
+                    chunk = chunker.add(raw, t)
+                    if chunk is not None:
+                        queue_waveform(chunk)
+
+        # every 3 seconds: print + store sample + queue HR for upload
+        # (nothing from the ECG side while the leads are off)
+        if ticks_diff(now, next_print) >= 0:
+            next_print = now + PRINT_EVERY_MS
+            t_ms = ticks_diff(now, test_start)
+            age_ms = engine.hr_age_ms(now)
+            heart_rate = engine.heart_rate if leads_on else 0
+
+            spo2 = 0
+            spo2_at = None
+            if pulse_ox is not None:
+                spo2 = pulse_ox.get_spo2()
+                spo2_at = pulse_ox.spo2_engine.updated_at
+                if spo2_at is None or ticks_diff(now, spo2_at) >= SPO2_MAX_AGE_MS:
+                    spo2 = 0
+
+            # store sample
+            if pulse_ox is not None:
+                session_samples.append({"t_ms": int(t_ms), "hr": float(heart_rate),
+                                        "spo2": round(spo2, 1)})
+            elif leads_on:
+                session_samples.append({"t_ms": int(t_ms), "hr": float(heart_rate)})
+
+            # print status
             if heart_rate > 0 and age_ms < 8000:
-                # avoid spamming identical HR (optional)
-                if (last_uploaded_hr is None) or (abs(heart_rate - last_uploaded_hr) >= 0.1):
-                    success, res = fhir_client.create_heart_rate_observation(PATIENT_ID, heart_rate)
-                    if success:
-                        last_uploaded_hr = heart_rate
-                    else:
-                        print("[FHIR] ✗ HR upload failed:", res)
-            else:
-                # 沒 HR 也留個記錄（可選：不想上傳就把這段刪掉）
-                # success, res = fhir_client.create_heart_rate_observation(PATIENT_ID, 0)  # 不建議
-                pass
-
-# =========================
-# End
-# =========================
-blue_led.value(0)
-buzzer_off(buzzer)
-beep_until = beep(buzzer, START_END_BEEP_MS)
-# 讓它真的叫完再結束（只在結束時等，不影響量測）
-while beep_until != 0 and ticks_diff(ticks_ms(), beep_until) > 0:
-    sleep_ms(10)
-buzzer_off(buzzer)
-beep_until = 0
-print("[TEST] Done. LED OFF. Samples:", len(session_samples))
-
-# =========================
-# Upload one session summary (optional, via fhir_client function)
-# =========================
-if fhir_ok and fhir_client is not None:
+                print("[HR]", heart_rate, "bpm",
+                      "| conf=", engine.hr_confidence,
+                      "| rr=", engine.last_rr, "ms",
+                      "|", det.status())
+            elif leads_on:
+                print("[NO_HR] t=", int(t_ms), "ms",
+                      "| raw=", int(engine.raw_val),
+                      "|", det.status(),
+                      "| last_rr=", engine.last_rr)
+            if pulse_ox is not None:
+                eng = pulse_ox.spo2_engine
+                print("[SpO2]", round(spo2, 1) if spo2 else "--", "%",
+                      "| PI=", round(eng.perfusion, 2), "%",
+                      "| LED=", pulse_ox.agc.current_ma() if pulse_ox.agc else "-",
+                      "| ovf=", ppg_sensor.overflow_count)
+
+            # queue this HR sample as a standard Heart Rate Observation;
+            # a newer HR replaces one that is still waiting (key 'hr').
+            # In dual-sensor mode HR and a new SpO2 estimate share one
+            # transaction Bundle (key 'vitals'). In beat-event mode the RR
+            # series carries the heart rate instead
+            if can_deliver():
+                items = []
+                hr_quality = sqi is None or sqi.ok or not SQI_SUPPRESS
+                if rr_stream is None and heart_rate > 0 and age_ms < 8000 and \
+                        engine.hr_confidence >= HR_MIN_CONFIDENCE and hr_quality:
+                    if (last_queued_hr is None) or (abs(heart_rate - last_queued_hr) >= 0.1):
+                        items.append(('hr', {
+                            'patient_id': PATIENT_ID,
+                            'heart_rate': heart_rate,
+                            'measurement_time': wall_time_iso(now),
+                            'notes': sqi_note()
+                        }))
+                        last_queued_hr = heart_rate
+                if spo2 > 0 and spo2_at != last_queued_spo2_at:
+                    items.append(('vs', {
+                        'patient_id': PATIENT_ID,
+                        'measurement_type': "血氧飽和度",
+                        'value': round(spo2, 1),
+                        'unit': "%",
+                        'measurement_time': wall_time_iso(spo2_at)
+                    }))
+                    last_queued_spo2_at = spo2_at
+                if pulse_ox is None:
+                    if items:
+                        upload_queue.put('hr', deliver, *items[0])
+                elif items:
+                    # a newer batch only replaces readings of the same kind:
+                    # an SpO2 still waiting is kept next to a newer HR
+                    pending = upload_queue.pending('vitals')
+                    if pending is not None:
+                        kinds = [kind for kind, _ in items]
+                        items = [item for item in pending[0] if item[0] not in kinds] + items
+                    upload_queue.put('vitals', deliver_batch, items)
+
+        if ptt is not None and ticks_diff(now, next_ptt) >= 0:
+            next_ptt = now + PTT_SUMMARY_MS
+            queue_ptt_summary(now)
+
+        await asyncio.sleep_ms(DSP_PERIOD_MS)
+
+    sampler.stop()
+    if lead is not None:
+        lead.deinit()
+    if ppg_sensor is not None:
+        ppg_sensor.shutdown()
+        pulse_ox.drain()
+    if ptt is not None:
+        # the rest of the last interval (if it has enough pairs)
+        ptt.flush()
+        queue_ptt_summary(ticks_ms())
+    if hrv is not None:
+        queue_hrv_summary(ticks_ms())
+    if rr_stream is not None:
+        chunk = rr_stream.flush()
+        if chunk is not None:
+            queue_rr(chunk)
+    if chunker is not None:
+        chunk = chunker.flush(min_len=WAVEFORM_CHUNK_MS // SAMPLE_MS // 5)
+        if chunk is not None:
+            queue_waveform(chunk)
+    blue_led.value(0)
+    buzzer_off(buzzer)
+    beep(buzzer, START_END_BEEP_MS)
+    # 讓它真的叫完再結束（只在結束時等，不影響量測）
+    await asyncio.sleep_ms(START_END_BEEP_MS)
+    buzzer_off(buzzer)
+    print("[TEST] Done. LED OFF. Samples:", len(session_samples))
+    print("[ADC] samples:", sampler.seq, "| overruns:", sampler.overruns,
+          "| max backlog:", sampler.max_backlog)
+    if ppg_sensor is not None:
+        print("[PPG] SpO2 windows:", pulse_ox.spo2_engine.windows,
+              "| rejected:", pulse_ox.spo2_engine.rejected,
+              "| FIFO overflow:", ppg_sensor.overflow_count)
+    if ptt is not None:
+        print("[PTT] session (n, mean, SD, min, max):", ptt.session.summary(),
+              "| unmatched:", ptt.unmatched, "| rejected:", ptt.rejected)
+    if lead is not None:
+        print("[LEADS] off:", lead.off_count, "times,", lead.off_ms, "ms")
+    if sqi is not None:
+        print("[SQI] windows:", sqi.windows, "| low quality:", sqi.bad_windows)
+    if rr_stream is not None:
+        print("[RR] beats:", rr_stream.beats, "| chunks:", rr_stream.chunks)
+
+
+def upload_session_summary():
     # 把整包 JSON 放到 notes 裡，不自建 HTTP function
     summary_notes = ujson.dumps({
         "duration_ms": TEST_DURATION_MS,
@@ -287,14 +716,64 @@ if fhir_ok and fhir_client is not None:
 
     # 用 client 的 generic API 上傳一筆「Session Summary」
     # 這筆不一定會被你的 UI 算進「生理數據」，但會出現在 timeline 當作紀錄
-    success, res = fhir_client.create_vital_sign_observation(
-        PATIENT_ID,
-        measurement_type="HR Session Summary",
-        value=0,
-        unit="session",
-        notes=summary_notes
-    )
+    success, res = deliver('vs', {
+        'patient_id': PATIENT_ID,
+        'measurement_type': "HR Session Summary",
+        'value': 0,
+        'unit': "session",
+        'measurement_time': wall_time_iso(ticks_ms()),
+        'notes': summary_notes
+    })
     if success:
         print("[FHIR] ✓ Session summary uploaded:", res)
-    else:
-        print("[FHIR] ✗ Session summary upload failed:", res)
+    return success, res
+
+
+async def replay_task():
+    # Earlier offline sessions, one Bundle at a time and only while the
+    # uploader is idle, so live uploads (and the DSP task) keep priority
+    while True:
+        await asyncio.sleep_ms(REPLAY_PERIOD_MS)
+        if fhir_ok and store.backlog and uploader.idle():
+            success, res = store.replay_once(fhir_client, REPLAY_BATCH)
+            if success and res:
+                print("[SF] replayed", res, "| backlog:", store.backlog)
+
+
+async def main():
+    wifi_task = asyncio.create_task(net_task())
+    upload_task = asyncio.create_task(uploader.run())
+    sf_task = None
+    if store is not None:
+        sf_task = asyncio.create_task(replay_task())
+    ppg = None
+    if ppg_sensor is not None:
+        ppg = asyncio.create_task(ppg_task())
+
+    await dsp_task()
+    if ppg is not None:
+        ppg.cancel()
+
+    # =========================
+    # Upload one session summary (optional, via fhir_client function)
+    # =========================
+    if can_deliver():
+        upload_queue.put('summary', upload_session_summary)
+
+    flush_start = ticks_ms()
+    while not uploader.idle() and ticks_diff(ticks_ms(), flush_start) < UPLOAD_FLUSH_MS:
+        await asyncio.sleep_ms(50)
+    upload_task.cancel()
+    wifi_task.cancel()
+    if sf_task is not None:
+        sf_task.cancel()
+
+    print("[FHIR] sent:", uploader.sent, "| failed:", uploader.failed,
+          "| coalesced:", upload_queue.coalesced, "| dropped:", upload_queue.dropped)
+    if store is not None:
+        store.flush()
+        print("[SF] stored:", store.stored, "| replayed:", store.replayed,
+              "| backlog:", store.backlog, "| dropped:", store.dropped)
+
+
+asyncio.run(main())
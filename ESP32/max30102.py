@@ -14,13 +14,58 @@
 # This driver aims at giving almost full access to Maxim MAX30102 functionalities.
 #                                                                          n-elia
 
-import uerrno
-from machine import SoftI2C
-from ustruct import unpack
-from utime import sleep_ms, ticks_diff, ticks_ms
+import sys
+from array import array
+
+try:
+    import uerrno
+except ImportError:
+    import errno as uerrno
+
+try:
+    from machine import SoftI2C
+except ImportError:
+    # host: only used as a type hint
+    SoftI2C = object
+
+try:
+    from ustruct import unpack
+except ImportError:
+    from struct import unpack
+
+try:
+    from utime import sleep_ms, ticks_add, ticks_diff, ticks_ms
+except ImportError:
+    from time import monotonic, sleep
+
+    def sleep_ms(ms):
+        sleep(ms / 1000)
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_add(a, b):
+        return a + b
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Wakes wait_and_drain() from the INT pin handler (on the host the handler
+# runs on the event loop thread, so a plain Event will do)
+_IntFlag = getattr(asyncio, 'ThreadSafeFlag', asyncio.Event)
 
 from circular_buffer import CircularBuffer
 
+# viper annotations (ptr8 / ptr32) only exist in the MicroPython compiler
+HAVE_VIPER = sys.implementation.name == 'micropython'
+if HAVE_VIPER:
+    import micropython
+
 # I2C address (7-bit address)
 MAX3010X_I2C_ADDRESS = 0x57  # Right-shift of 0xAE, 0xAF
 
@@ -150,18 +195,63 @@ SLOT_RED_PILOT = 0x06
 
 MAX30102_EXPECTED_PART_ID = 0x15
 
+# Configuration registers mirrored in the driver, as [start, stop) runs of
+# consecutive addresses (the address auto-increments, so a run is one
+# multi-byte transaction). All are 0x00 after a reset. Status, FIFO and
+# die temperature registers are not mirrored.
+MAX30102_SHADOW_RUNS = (
+    (MAX30102_INT_ENABLE_1, MAX30102_INT_ENABLE_2 + 1),
+    (MAX30102_FIFO_CONFIG, MAX30102_PARTICLE_CONFIG + 1),
+    (MAX30102_LED1_PULSE_AMP, MAX30102_LED2_PULSE_AMP + 1),
+    (MAX30102_LED_PROX_AMP, MAX30102_MULTI_LED_CONFIG_2 + 1),
+    (MAX30102_PROX_INT_THRESH, MAX30102_PROX_INT_THRESH + 1),
+)
+
 TAG = 'MAX30102'
 
-# Size of the queued readings
-STORAGE_QUEUE_SIZE = 4
+# The FIFO holds 32 samples; pointers and OVF_COUNTER are 5-bit
+MAX30102_FIFO_DEPTH = 32
+
+# Default size of the queued readings: two full FIFOs, since check()
+# drains the whole FIFO in one burst
+STORAGE_QUEUE_SIZE = 2 * MAX30102_FIFO_DEPTH
 
 
-# Data structure to hold the last readings
+# FIFO decode kernels: n samples of `step` bytes in src, one channel at
+# byte `offset` of each sample. Data is 18-bit, left-justified whatever the
+# ADC resolution, so out[i] = value >> shift with shift = 18 - resolution.
+def _fifo_decode_py(src, n, step, offset, shift, out):
+    j = offset
+    for i in range(n):
+        out[i] = (((src[j] << 16) | (src[j + 1] << 8) | src[j + 2]) & 0x3FFFF) >> shift
+        j += step
+
+
+if HAVE_VIPER:
+    @micropython.viper
+    def _fifo_decode_viper(src: ptr8, n: int, step: int, offset: int, shift: int, out: ptr32):
+        j = offset
+        for i in range(n):
+            out[i] = (((src[j] << 16) | (src[j + 1] << 8) | src[j + 2]) & 0x3FFFF) >> shift
+            j += step
+
+    fifo_decode = _fifo_decode_viper
+else:
+    fifo_decode = _fifo_decode_py
+
+
+# Data structure to hold the last readings (one ring per LED plus the
+# ticks_ms() time of each sample; readings that were never popped are
+# counted in .dropped once overwritten)
 class SensorData:
-    def __init__(self):
-        self.ir = CircularBuffer(STORAGE_QUEUE_SIZE)
-        self.red = CircularBuffer(STORAGE_QUEUE_SIZE)
-        self.green = CircularBuffer(STORAGE_QUEUE_SIZE)
+    def __init__(self, capacity=STORAGE_QUEUE_SIZE):
+        self.t = CircularBuffer(capacity)
+        self.ir = CircularBuffer(capacity)
+        self.red = CircularBuffer(capacity)
+        self.green = CircularBuffer(capacity)
+
+    def dropped(self):
+        return self.ir.dropped
 
 
 # Sensor class
@@ -169,6 +259,7 @@ class MAX30102(object):
     def __init__(self,
                  i2c: SoftI2C,
                  i2c_hex_address=MAX3010X_I2C_ADDRESS,
+                 storage_size=STORAGE_QUEUE_SIZE,
                  ):
         self._address = i2c_hex_address
         self._i2c = i2c
@@ -181,7 +272,41 @@ class MAX30102(object):
         self._acq_frequency = None
         self._acq_frequency_inv = None
         # Circular buffer of readings from the sensor
-        self.sense = SensorData()
+        self.sense = SensorData(storage_size)
+        # Preallocated burst buffers: registers INT_STAT_1 .. READ_PTR
+        # (0x00 - 0x06) and a full FIFO of IR + RED samples (3 bytes per LED)
+        self._regs_buf = bytearray(7)
+        self._ptr_mv = memoryview(self._regs_buf)[4:]
+        self._fifo_buf = bytearray(MAX30102_FIFO_DEPTH * 6)
+        self._fifo_mv = memoryview(self._fifo_buf)
+        # Decoded burst, one array per LED, and the resolution shift
+        self._ir_out = array('i', bytes(4 * MAX30102_FIFO_DEPTH))
+        self._red_out = array('i', bytes(4 * MAX30102_FIFO_DEPTH))
+        self._t_out = array('i', bytes(4 * MAX30102_FIFO_DEPTH))
+        self._fifo_shift = 0
+        # Sample clock (see _stamp()): ticks_ms() of the last stamped
+        # sample plus a sub-millisecond remainder in us
+        self._acq_period_us = 0
+        self._t_last = 0
+        self._t_frac = 0
+        self._t_started = False
+        # Samples lost to FIFO overflow since start (OVF_COUNTER, summed)
+        self.overflow_count = 0
+        # Shadow copy of the configuration registers (MAX30102_SHADOW_RUNS)
+        # and the ones changed inside batch() but not yet written
+        self._shadow = bytearray(MAX30102_PROX_INT_THRESH + 1)
+        self._shadow_mv = memoryview(self._shadow)
+        self._dirty = bytearray(MAX30102_PROX_INT_THRESH + 1)
+        self._batch = 0
+        # Interrupt mode (see enable_interrupt_mode())
+        self._int_pin = None
+        self._int_pending = False
+        self._int_mark = 0
+        self._int_timeout_ms = 0
+        self._int_flag = None
+        self._int_handler = self._on_int  # bind once, not in the ISR setup
+        self.int_count = 0
+        self.int_status = 0
 
         try:
             # self._i2c.readfrom(self._address, 1) # Some boards won't work if scan() is never called
@@ -197,6 +322,8 @@ class MAX30102(object):
         if not (self.check_part_id()):
             raise RuntimeError("I2C device ID not corresponding to MAX30102 or MAX30102")
 
+        self.reload_shadow()
+
     # Sensor setup method
     def setup_sensor(self, led_mode=2, adc_range=16384, sample_rate=400,
                      led_power=MAX30102_PULSE_AMP_MEDIUM, sample_avg=8,
@@ -204,6 +331,17 @@ class MAX30102(object):
         # Reset the sensor's registers from previous configurations
         self.soft_reset()
 
+        # Settings below only update the shadow registers; they are written
+        # at the end of the block, one transaction per run of registers
+        with self.batch():
+            self._setup(led_mode, adc_range, sample_rate, led_power,
+                        sample_avg, pulse_width)
+
+        # Clears the FIFO
+        self.clear_fifo()
+
+    def _setup(self, led_mode, adc_range, sample_rate, led_power,
+               sample_avg, pulse_width):
         # Set the number of samples to be averaged by the chip to 8
         self.set_fifo_average(sample_avg)
 
@@ -228,9 +366,6 @@ class MAX30102(object):
         self.set_pulse_amplitude_red(led_power)
         self.set_pulse_amplitude_proximity(led_power)
 
-        # Clears the FIFO
-        self.clear_fifo()
-
     def __del__(self):
         self.shutdown()
 
@@ -293,12 +428,19 @@ class MAX30102(object):
         # and data registers are reset to their power-on-state through
         # a power-on reset. The RESET bit is cleared automatically back to zero
         # after the reset sequence is completed. (datasheet pag. 19)
-        self.set_bitmask(MAX30102_MODE_CONFIG, MAX30102_RESET_MASK, MAX30102_RESET)
+        self.i2c_set_register(MAX30102_MODE_CONFIG,
+                              self._shadow[MAX30102_MODE_CONFIG] | MAX30102_RESET)
         curr_status = -1
         while not ((curr_status & MAX30102_RESET) == 0):
             sleep_ms(10)
             curr_status = ord(self.i2c_read_register(MAX30102_MODE_CONFIG))
 
+        # Every configuration register is back to its power-on value (0)
+        for start, stop in MAX30102_SHADOW_RUNS:
+            for reg in range(start, stop):
+                self._shadow[reg] = 0
+                self._dirty[reg] = 0
+
     # Power states methods
     def shutdown(self):
         # Put IC into low power mode (datasheet pg. 19)
@@ -401,8 +543,11 @@ class MAX30102(object):
             raise ValueError('Wrong pulse width:{0}!'.format(pulse_width))
         self.set_bitmask(MAX30102_PARTICLE_CONFIG, MAX30102_PULSE_WIDTH_MASK, pw)
 
-        # Store the pulse width
+        # Store the pulse width. It also sets the ADC resolution: 15, 16,
+        # 17, 18 bits for codes 0 - 3; FIFO data are left-justified in 18
+        # bits, so readings are shifted right by 18 - resolution
         self._pulse_width = pw
+        self._fifo_shift = 3 - pw
 
     # LED Pulse Amplitude Configuration methods
     def set_active_leds_amplitude(self, amplitude):
@@ -412,19 +557,19 @@ class MAX30102(object):
             self.set_pulse_amplitude_red(amplitude)
 
     def set_pulse_amplitude_ir(self, amplitude):
-        self.i2c_set_register(MAX30102_LED1_PULSE_AMP, amplitude)
+        self.set_bitmask(MAX30102_LED1_PULSE_AMP, 0x00, amplitude)
 
     def set_pulse_amplitude_red(self, amplitude):
-        self.i2c_set_register(MAX30102_LED2_PULSE_AMP, amplitude)
+        self.set_bitmask(MAX30102_LED2_PULSE_AMP, 0x00, amplitude)
 
     def set_pulse_amplitude_proximity(self, amplitude):
-        self.i2c_set_register(MAX30102_LED_PROX_AMP, amplitude)
+        self.set_bitmask(MAX30102_LED_PROX_AMP, 0x00, amplitude)
 
     def set_proximity_threshold(self, thresh_msb):
         # Set the IR ADC count that will trigger the beginning of particle-
         # sensing mode.The threshMSB signifies only the 8 most significant-bits
         # of the ADC count. (datasheet page 24)
-        self.i2c_set_register(MAX30102_PROX_INT_THRESH, thresh_msb)
+        self.set_bitmask(MAX30102_PROX_INT_THRESH, 0x00, thresh_msb)
 
     # FIFO averaged samples number Configuration
     def set_fifo_average(self, number_of_samples):
@@ -461,6 +606,9 @@ class MAX30102(object):
             # Compute the time interval to wait before taking a good measure
             # (see note in setSampleRate() method)
             self._acq_frequency_inv = int(ceil(1000 / self._acq_frequency))
+            # Exact sample period for the timestamps
+            self._acq_period_us = int(1000000 / self._acq_frequency)
+            self._t_started = False
 
     def get_acquisition_frequency(self):
         return self._acq_frequency
@@ -468,9 +616,8 @@ class MAX30102(object):
     def clear_fifo(self):
         # Resets all points to start in a known state
         # Datasheet page 15 recommends clearing FIFO before beginning a read
-        self.i2c_set_register(MAX30102_FIFO_WRITE_PTR, 0)
-        self.i2c_set_register(MAX30102_FIFO_OVERFLOW, 0)
-        self.i2c_set_register(MAX30102_FIFO_READ_PTR, 0)
+        # (WRITE_PTR, OVF_COUNTER and READ_PTR are consecutive: one write)
+        self._i2c.writeto_mem(self._address, MAX30102_FIFO_WRITE_PTR, b'\x00\x00\x00')
 
     def enable_fifo_rollover(self):
         # FIFO rollover: enable to allow FIFO tro wrap/roll over
@@ -496,6 +643,69 @@ class MAX30102(object):
         wp = self.i2c_read_register(MAX30102_FIFO_READ_PTR)
         return wp
 
+    # Interrupt-driven acquisition
+    def enable_interrupt_mode(self, pin, a_full=24, data_ready=False):
+        # The INT pin (active low, open drain: use a pull-up) goes low when
+        # a_full samples are waiting in the FIFO (A_FULL, 17..32), or for
+        # every new sample with data_ready=True (PPG_RDY). The pin handler
+        # only sets a flag; check() then returns at once without touching
+        # the bus until INT fired, so a polling loop costs nothing between
+        # batches, and wait_and_drain() lets a uasyncio task sleep instead.
+        if not 17 <= a_full <= MAX30102_FIFO_DEPTH:
+            raise ValueError('Wrong almost full level:{0}!'.format(a_full))
+        with self.batch():
+            # FIFO_A_FULL counts the free slots left when the interrupt fires
+            self.set_fifo_almost_full(MAX30102_FIFO_DEPTH - a_full)
+            if data_ready:
+                self.disable_a_full()
+                self.enable_data_rdy()
+                batch = 1
+            else:
+                self.disable_data_rdy()
+                self.enable_a_full()
+                batch = a_full
+
+        # Fallback if an edge is ever missed: drain anyway after twice the
+        # time a batch takes to fill
+        self._int_timeout_ms = 2 * batch * (self._acq_frequency_inv or 20) + 100
+        if self._int_flag is None:
+            self._int_flag = _IntFlag()
+        self._int_pin = pin
+        # Drain (and clear any stale interrupt) on the first check()
+        self._int_pending = True
+        pin.irq(trigger=pin.IRQ_FALLING, handler=self._int_handler)
+
+    def disable_interrupt_mode(self):
+        if self._int_pin is not None:
+            self._int_pin.irq(handler=None)
+            self._int_pin = None
+        self.disable_a_full()
+        self.disable_data_rdy()
+
+    def _on_int(self, _pin):
+        # Pin ISR: no I2C and no allocation here
+        self._int_pending = True
+        self.int_count += 1
+        self._int_flag.set()
+
+    async def wait_and_drain(self):
+        # Sleep until the INT pin fires (or the fallback timeout), then
+        # drain the FIFO; returns the number of samples read
+        while True:
+            n = self.check()
+            if n or self._int_pin is None:
+                return n
+            try:
+                await asyncio.wait_for(self._int_flag.wait(), self._int_timeout_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._int_flag.clear()
+
+    def get_overflow_counter(self):
+        # Number of samples lost since the last FIFO read (saturates at 31).
+        # Reading FIFO_DATA resets it (datasheet pag. 16)
+        return ord(self.i2c_read_register(MAX30102_FIFO_OVERFLOW)) & 0x1F
+
     # Die Temperature method: returns the temperature in C
     def read_temperature(self):
         # DIE_TEMP_RDY interrupt must be enabled
@@ -519,7 +729,7 @@ class MAX30102(object):
 
     def set_prox_int_tresh(self, val):
         # Set the PROX_INT_THRESH (see proximity function on datasheet, pag 10)
-        self.i2c_set_register(MAX30102_PROX_INT_THRESH, val)
+        self.set_bitmask(MAX30102_PROX_INT_THRESH, 0x00, val)
 
     # DeviceID and Revision methods
     def read_part_id(self):
@@ -558,8 +768,8 @@ class MAX30102(object):
 
     def disable_slots(self):
         # Clear all the slots assignments
-        self.i2c_set_register(MAX30102_MULTI_LED_CONFIG_1, 0)
-        self.i2c_set_register(MAX30102_MULTI_LED_CONFIG_2, 0)
+        self.set_bitmask(MAX30102_MULTI_LED_CONFIG_1, 0x00, 0)
+        self.set_bitmask(MAX30102_MULTI_LED_CONFIG_2, 0x00, 0)
 
     # Low-level I2C Communication
     def i2c_read_register(self, REGISTER, n_bytes=1):
@@ -568,23 +778,143 @@ class MAX30102(object):
 
     def i2c_set_register(self, REGISTER, VALUE):
         self._i2c.writeto(self._address, bytearray([REGISTER, VALUE]))
+        # Keep the shadow in step with direct writes
+        if REGISTER < len(self._shadow):
+            self._shadow[REGISTER] = VALUE
         return
 
-    # Given a register, read it, mask it, and then set the thing
+    # Given a configuration register, mask its shadow copy and set the
+    # thing. The bus is written only if the content changes (and, inside
+    # batch(), only once at the end of the block).
     def set_bitmask(self, REGISTER, MASK, NEW_VALUES):
-        newCONTENTS = (ord(self.i2c_read_register(REGISTER)) & MASK) | NEW_VALUES
-        self.i2c_set_register(REGISTER, newCONTENTS)
+        newCONTENTS = (self._shadow[REGISTER] & MASK) | NEW_VALUES
+        if newCONTENTS == self._shadow[REGISTER]:
+            return
+        if self._batch:
+            self._shadow[REGISTER] = newCONTENTS
+            self._dirty[REGISTER] = 1
+        else:
+            self.i2c_set_register(REGISTER, newCONTENTS)
         return
 
-    # Given a register, read it and mask it
+    # Given a register, mask it and set the thing (same as set_bitmask())
     def bitmask(self, reg, slotMask, thing):
-        originalContents = ord(self.i2c_read_register(reg))
-        originalContents = originalContents & slotMask
-        self.i2c_set_register(reg, originalContents | thing)
-
+        self.set_bitmask(reg, slotMask, thing)
+
+    # Batched configuration: `with sensor.batch(): ...` collects register
+    # changes and writes them when the block ends, each run of consecutive
+    # registers in one multi-byte transaction
+    def batch(self):
+        return self
+
+    def __enter__(self):
+        self._batch += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._batch -= 1
+        if not self._batch:
+            self.flush_config()
+        return False
+
+    def flush_config(self):
+        # Write the registers changed inside batch(): per run, one write
+        # from the first to the last changed register
+        dirty = self._dirty
+        for start, stop in MAX30102_SHADOW_RUNS:
+            first = -1
+            last = -1
+            for reg in range(start, stop):
+                if dirty[reg]:
+                    if first < 0:
+                        first = reg
+                    last = reg
+                    dirty[reg] = 0
+            if first >= 0:
+                self._i2c.writeto_mem(self._address, first,
+                                      self._shadow_mv[first:last + 1])
+
+    def reload_shadow(self):
+        # Read all configuration registers back into the shadow (at start,
+        # or if the sensor may have been reset behind the driver's back)
+        for start, stop in MAX30102_SHADOW_RUNS:
+            self._i2c.readfrom_mem_into(self._address, start,
+                                        self._shadow_mv[start:stop])
+            for reg in range(start, stop):
+                self._dirty[reg] = 0
+
+    # Reference decoder for one channel of one sample (check() uses the
+    # fifo_decode() kernel instead)
     def fifo_bytes_to_int(self, fifo_bytes):
         value = unpack(">i", b'\x00' + fifo_bytes)
-        return (value[0] & 0x3FFFF) >> self._pulse_width
+        return (value[0] & 0x3FFFF) >> self._fifo_shift
+
+    # Sample timestamps. The FIFO hands out samples on the sensor's own
+    # clock, so sample k+1 is exactly one period after sample k; only the
+    # clock's offset has to be found. At each drain the newest sample was
+    # taken no later than `now` (the time the pointers were read): if the
+    # clock puts it later it is moved back at once, otherwise it creeps
+    # forward by 1/16 of the gap, so it settles on the shortest observed
+    # drain latency and follows the sensor/MCU clock drift. Samples lost
+    # to overflow still advance the clock.
+    def _stamp(self, now, lost, n):
+        period = self._acq_period_us
+        if not self._t_started:
+            # first batch: the newest sample at `now`
+            back = (lost + n) * period
+            ms = (back + 999) // 1000
+            self._t_last = ticks_add(now, -ms)
+            self._t_frac = ms * 1000 - back
+            self._t_started = True
+        t = self._t_last
+        frac = self._t_frac + lost * period
+
+        err = ticks_diff(now, ticks_add(t, (frac + n * period) // 1000))
+        if err < 0:
+            frac += err * 1000
+        else:
+            frac += (err * 1000) >> 4
+        t = ticks_add(t, frac // 1000)
+        frac %= 1000
+
+        out = self._t_out
+        for i in range(n):
+            frac += period
+            if frac >= 1000:
+                t = ticks_add(t, frac // 1000)
+                frac %= 1000
+            out[i] = t
+        self._t_last = t
+        self._t_frac = frac
+
+    def _align_times(self):
+        # Drop the times of readings already taken with pop_ir/red_*()
+        t = self.sense.t
+        while len(t) > len(self.sense.ir):
+            t.pop()
+
+    # Pops the oldest sample as (ticks_ms, ir, red), or None
+    def pop_sample(self):
+        self._align_times()
+        if len(self.sense.t) == 0:
+            return None
+        red = self.sense.red.pop() if self._active_leds > 1 else 0
+        return self.sense.t.pop(), self.sense.ir.pop(), red
+
+    # Copies up to len(t) samples into parallel arrays (times, IR and, with
+    # two LEDs, RED), oldest first; returns the count
+    def drain_samples(self, t, ir, red=None):
+        self._align_times()
+        n = self.sense.t.drain(t)
+        self.sense.ir.drain(ir, n)
+        if self._active_leds > 1:
+            if red is None:
+                # keep the rings in step
+                for _ in range(n):
+                    self.sense.red.pop()
+            else:
+                self.sense.red.drain(red, n)
+        return n
 
     # Returns how many samples are available
     def available(self):
@@ -629,46 +959,65 @@ class MAX30102(object):
     # (useless - for comparison purposes only)
     def next_sample(self):
         if self.available():
-            # With respect to the SparkFun library, using a deque object 
-            # allows us to avoid manually advancing of the tail
+            # With respect to the SparkFun library, the ring buffer
+            # advances its own tail on pop()
             return True
 
     # Polls the sensor for new data
     def check(self):
-        # Call continuously to poll the sensor for new data.
-        read_pointer = ord(self.get_read_pointer())
-        write_pointer = ord(self.get_write_pointer())
-
-        # Do we have new data?
-        if read_pointer != write_pointer:
-            # Calculate the number of readings we need to get from sensor
-            number_of_samples = write_pointer - read_pointer
-
-            # Wrap condition (return to the beginning of 32 samples)
-            if number_of_samples < 0:
-                number_of_samples += 32
-
-            for i in range(number_of_samples):
-                # Read a number of bytes equal to activeLEDs*3 (= 1 sample)
-                fifo_bytes = self.i2c_read_register(MAX30102_FIFO_DATA,
-                                                    self._multi_led_read_mode)
-
-                # Convert the readings from bytes to integers, depending
-                # on the number of active LEDs
-                if self._active_leds > 0:
-                    self.sense.ir.append(
-                        self.fifo_bytes_to_int(fifo_bytes[0:3])
-                    )
-
-                if self._active_leds > 1:
-                    self.sense.red.append(
-                        self.fifo_bytes_to_int(fifo_bytes[3:6])
-                    )
+        # Call continuously to poll the sensor for new data. Every pending
+        # sample is fetched in a single I2C burst; returns how many were read
+        # (0 if none). WRITE_PTR, OVF_COUNTER and READ_PTR are consecutive
+        # registers, so one 3-byte read gets all of them.
+        regs = self._regs_buf
+        now = ticks_ms()
+        if self._int_pin is not None:
+            # Interrupt mode: no bus traffic until INT fired
+            if not self._int_pending and ticks_diff(now, self._int_mark) < self._int_timeout_ms:
+                return 0
+            self._int_pending = False
+            self._int_mark = now
+            # INT_STAT_1 .. READ_PTR at once; reading the status clears the
+            # interrupt and releases the INT pin
+            self._i2c.readfrom_mem_into(self._address, MAX30102_INT_STAT_1, regs)
+            self.int_status = regs[0]
+        else:
+            self._i2c.readfrom_mem_into(self._address, MAX30102_FIFO_WRITE_PTR, self._ptr_mv)
+        write_pointer = regs[4] & 0x1F
+        overflow = regs[5] & 0x1F
+        read_pointer = regs[6] & 0x1F
+
+        # Calculate the number of readings we need to get from sensor
+        # (wraps at the 32 samples of the FIFO)
+        number_of_samples = (write_pointer - read_pointer) & 0x1F
+        if overflow:
+            # The FIFO filled up between polls: pointers are equal again,
+            # 32 samples are waiting and OVF_COUNTER older ones were lost
+            self.overflow_count += overflow
+            if number_of_samples == 0:
+                number_of_samples = MAX30102_FIFO_DEPTH
+        if number_of_samples == 0:
+            return 0
 
-                return True
+        # Read activeLEDs*3 bytes per sample, all samples at once
+        step = self._multi_led_read_mode
+        mv = self._fifo_mv
+        self._i2c.readfrom_mem_into(self._address, MAX30102_FIFO_DATA,
+                                    mv[:number_of_samples * step])
 
-        else:
-            return False
+        # Convert the readings from bytes to integers, depending on the
+        # number of active LEDs: whole burst at once, no allocation
+        fifo_decode(self._fifo_buf, number_of_samples, step, 0, self._fifo_shift, self._ir_out)
+        self.sense.ir.extend(self._ir_out, number_of_samples)
+        if self._active_leds > 1:
+            fifo_decode(self._fifo_buf, number_of_samples, step, 3, self._fifo_shift, self._red_out)
+            self.sense.red.extend(self._red_out, number_of_samples)
+
+        # Time of each sample, on the sensor's sample clock
+        self._stamp(now, overflow, number_of_samples)
+        self.sense.t.extend(self._t_out, number_of_samples)
+
+        return number_of_samples
 
     # Check for new data but give up after a certain amount of time
     def safe_check(self, max_time_to_check):
@@ -681,3 +1030,386 @@ class MAX30102(object):
                 # new data found
                 return True
             sleep_ms(1)
+
+
+# Self-test: shadow registers, burst read, overflow accounting, FIFO
+# decoding and interrupt mode against a register-level model of the
+# sensor, so it runs on the host as well.
+if __name__ == '__main__':
+    class FakePin(object):
+        # INT line: open drain, pulled up (1) until the sensor asserts it
+        IRQ_FALLING = 2
+
+        def __init__(self):
+            self.level = 1
+            self.handler = None
+
+        def irq(self, trigger=None, handler=None):
+            self.handler = handler
+
+        def drive(self, level):
+            if self.level and not level and self.handler:
+                self.handler(self)
+            self.level = level
+
+    class FakeBus(object):
+        # MAX30102 register file with a 32-sample FIFO (rollover enabled:
+        # a full FIFO overwrites its oldest sample and counts it in
+        # OVF_COUNTER). The register pointer auto-increments except on
+        # FIFO_DATA, which pops one byte of the current sample per read.
+        def __init__(self):
+            self.regs = bytearray(256)
+            self.regs[MAX30102_PART_ID] = MAX30102_EXPECTED_PART_ID
+            self.fifo = [b'\x00' * 6] * MAX30102_FIFO_DEPTH
+            self.count = 0
+            self._reg = 0
+            self._byte = 0
+            self.transactions = 0
+            self.writes = []  # (first register, bytes) per register write
+            self.pin = None
+
+        def scan(self):
+            return [MAX3010X_I2C_ADDRESS]
+
+        def push(self, ir, red):
+            wr = self.regs[MAX30102_FIFO_WRITE_PTR]
+            self.fifo[wr] = bytes([(ir >> 16) & 3, (ir >> 8) & 255, ir & 255,
+                                   (red >> 16) & 3, (red >> 8) & 255, red & 255])
+            self.regs[MAX30102_FIFO_WRITE_PTR] = (wr + 1) & 0x1F
+            if self.count == MAX30102_FIFO_DEPTH:
+                self.regs[MAX30102_FIFO_READ_PTR] = (self.regs[MAX30102_FIFO_READ_PTR] + 1) & 0x1F
+                self.regs[MAX30102_FIFO_OVERFLOW] = min(self.regs[MAX30102_FIFO_OVERFLOW] + 1, 0x1F)
+            else:
+                self.count += 1
+
+            status = 0
+            if self.count >= MAX30102_FIFO_DEPTH - (self.regs[MAX30102_FIFO_CONFIG] & 0x0F):
+                status |= MAX30102_INT_A_FULL_ENABLE
+            status |= MAX30102_INT_DATA_RDY_ENABLE
+            self.regs[MAX30102_INT_STAT_1] |= status & self.regs[MAX30102_INT_ENABLE_1]
+            self._update_pin()
+
+        def _update_pin(self):
+            if self.pin is not None:
+                self.pin.drive(0 if self.regs[MAX30102_INT_STAT_1] else 1)
+
+        def _read_byte(self):
+            if self._reg != MAX30102_FIFO_DATA:
+                v = self.regs[self._reg]
+                if self._reg == MAX30102_INT_STAT_1:
+                    # reading the status clears it and releases INT
+                    self.regs[MAX30102_INT_STAT_1] = 0
+                    self._update_pin()
+                self._reg = (self._reg + 1) & 0xFF
+                return v
+            rd = self.regs[MAX30102_FIFO_READ_PTR]
+            v = self.fifo[rd][self._byte]
+            self._byte += 1
+            if self._byte == 6:
+                self._byte = 0
+                if self.count:
+                    self.count -= 1
+                    self.regs[MAX30102_FIFO_READ_PTR] = (rd + 1) & 0x1F
+                self.regs[MAX30102_FIFO_OVERFLOW] = 0
+            return v
+
+        def writeto(self, addr, buf):
+            self.transactions += 1
+            self._reg = buf[0]
+            self._byte = 0
+            if len(buf) > 1:
+                self.writes.append((buf[0], bytes(buf[1:])))
+            for v in buf[1:]:
+                if self._reg == MAX30102_FIFO_WRITE_PTR:
+                    self.count = 0
+                if self._reg == MAX30102_MODE_CONFIG:
+                    # reset completes at once
+                    v &= ~MAX30102_RESET & 0xFF
+                self.regs[self._reg] = v
+                self._reg = (self._reg + 1) & 0xFF
+
+        def readfrom(self, addr, n):
+            self.transactions += 1
+            return bytes([self._read_byte() for _ in range(n)])
+
+        def writeto_mem(self, addr, reg, buf):
+            self.writeto(addr, bytes([reg]) + bytes(buf))
+
+        def readfrom_mem_into(self, addr, reg, buf):
+            self.transactions += 1
+            self._reg = reg
+            self._byte = 0
+            for i in range(len(buf)):
+                buf[i] = self._read_byte()
+
+    bus = FakeBus()
+    sensor = MAX30102(i2c=bus)
+
+    # ---------- shadow registers ----------
+    def in_sync():
+        for start, stop in MAX30102_SHADOW_RUNS:
+            if bytes(sensor._shadow[start:stop]) != bytes(bus.regs[start:stop]):
+                return False
+        return True
+
+    bus.transactions = 0
+    sensor.setup_sensor()
+    setup_tx = bus.transactions
+    assert in_sync() and bus.regs[MAX30102_LED1_PULSE_AMP] == MAX30102_PULSE_AMP_MEDIUM
+    # every setter called with the value the shadow already holds: no bus
+    # traffic, in or out of batch()
+    def set_defaults():
+        sensor.set_fifo_average(8)
+        sensor.enable_fifo_rollover()
+        sensor.set_led_mode(2)
+        sensor.set_adc_range(16384)
+        sensor.set_sample_rate(400)
+        sensor.set_pulse_width(411)
+        sensor.set_pulse_amplitude_ir(MAX30102_PULSE_AMP_MEDIUM)
+        sensor.set_pulse_amplitude_red(MAX30102_PULSE_AMP_MEDIUM)
+        sensor.set_pulse_amplitude_proximity(MAX30102_PULSE_AMP_MEDIUM)
+        sensor.wakeup()
+
+    bus.transactions = 0
+    set_defaults()
+    with sensor.batch():
+        set_defaults()
+    assert bus.transactions == 0 and not any(sensor._dirty)
+    del bus.writes[:]
+    sensor.set_sample_rate(100)              # one write, no read
+    assert bus.transactions == 1
+    assert bus.writes == [(MAX30102_PARTICLE_CONFIG, bytes([sensor._shadow[MAX30102_PARTICLE_CONFIG]]))]
+    with sensor.batch():                     # LED1 + LED2: one 2-byte write
+        sensor.set_pulse_amplitude_ir(0x40)
+        sensor.set_pulse_amplitude_red(0x50)
+    assert bus.transactions == 2 and in_sync()
+    assert bus.writes[1:] == [(MAX30102_LED1_PULSE_AMP, b'\x40\x50')]
+
+    # flush_config(): FIFO_CONFIG and PARTICLE_CONFIG are one run with
+    # MODE_CONFIG (unchanged) between them, written through from the
+    # shadow; LED1 is in another run, so a second write
+    del bus.writes[:]
+    mode = bus.regs[MAX30102_MODE_CONFIG]
+    with sensor.batch():
+        sensor.set_pulse_amplitude_ir(0x30)
+        sensor.set_fifo_average(4)
+        sensor.set_sample_rate(400)
+        sensor.set_fifo_average(4)           # same value again: no effect
+    assert bus.writes == [
+        (MAX30102_FIFO_CONFIG, bytes(sensor._shadow[MAX30102_FIFO_CONFIG:MAX30102_PARTICLE_CONFIG + 1])),
+        (MAX30102_LED1_PULSE_AMP, b'\x30'),
+    ], bus.writes
+    assert bus.regs[MAX30102_MODE_CONFIG] == mode and in_sync()
+    assert not any(sensor._dirty)
+    with sensor.batch():                     # nothing changed: nothing sent
+        sensor.set_fifo_average(4)
+    assert len(bus.writes) == 2
+    sensor.set_fifo_average(8)
+    sensor.set_sample_rate(400)
+    sensor.set_active_leds_amplitude(MAX30102_PULSE_AMP_MEDIUM)
+    bus.regs[MAX30102_LED1_PULSE_AMP] = 0    # changed behind the driver's back
+    sensor.reload_shadow()
+    assert in_sync()
+    sensor.set_pulse_amplitude_ir(MAX30102_PULSE_AMP_MEDIUM)
+    assert in_sync()
+    print("shadow registers: OK | setup_sensor():", setup_tx, "I2C transactions")
+
+    def drain():
+        out = []
+        while sensor.available():
+            out.append((sensor.pop_ir_from_storage(), sensor.pop_red_from_storage()))
+        return out
+
+    # 20 pending samples: one pointer read + one burst
+    bus.transactions = 0
+    for i in range(20):
+        bus.push(1000 + i, 2000 + i)
+    assert sensor.check() == 20
+    assert bus.transactions == 2
+    assert drain() == [(1000 + i, 2000 + i) for i in range(20)]
+    assert sensor.check() == 0 and sensor.overflow_count == 0
+
+    # pointers wrap past 31
+    for i in range(25):
+        bus.push(3000 + i, 4000 + i)
+    assert sensor.check() == 25
+    assert drain() == [(3000 + i, 4000 + i) for i in range(25)]
+
+    # 40 samples between polls: 8 lost, the newest 32 are read
+    for i in range(40):
+        bus.push(5000 + i, 6000 + i)
+    assert sensor.check() == 32
+    assert sensor.overflow_count == 8
+    assert drain() == [(5000 + i, 6000 + i) for i in range(8, 40)]
+    assert sensor.get_overflow_counter() == 0
+    assert sensor.sense.dropped() == 0
+
+    # a consumer that falls behind loses the oldest queued readings, counted
+    small = MAX30102(i2c=bus, storage_size=8)
+    small.setup_sensor()
+    for i in range(20):
+        bus.push(i, i)
+    assert small.check() == 20 and small.sense.dropped() == 12
+    assert small.sense.ir.pop() == 12 and small.sense.red.pop_head() == 19
+    print("burst read: OK | overflow counted:", sensor.overflow_count)
+
+    # ---------- FIFO decoding ----------
+    # Resolution per pulse width (datasheet, SPO2 configuration): FIFO words
+    # are left-justified in 18 bits, so a 15-bit reading comes out as the
+    # 18-bit word / 8. Only 411 us is unscaled, as before.
+    RESOLUTION = {69: 15, 118: 16, 215: 17, 411: 18}
+    for pulse_width in (69, 118, 215, 411):
+        sensor.set_pulse_width(pulse_width)
+        drop = 18 - RESOLUTION[pulse_width]
+        for v in (0x3FFFF, 0x2ABCD, 0x20000, 0x00008, 0x00007, 0):
+            word = bytes([v >> 16, (v >> 8) & 255, v & 255])
+            assert sensor.fifo_bytes_to_int(word) == v >> drop
+            # bits 23..18 of the word are unused and ignored
+            assert sensor.fifo_bytes_to_int(bytes([word[0] | 0xFC]) + word[1:]) == v >> drop
+        assert sensor.fifo_bytes_to_int(b'\x03\xff\xff') == (1 << RESOLUTION[pulse_width]) - 1
+
+    # fifo_decode() against the struct-based fifo_bytes_to_int() on random
+    # bursts, for every pulse width (= resolution) and IR-only / IR + RED
+    import random
+    random.seed(15)
+    out = array('i', bytes(4 * MAX30102_FIFO_DEPTH))
+    for pulse_width in (69, 118, 215, 411):
+        sensor.set_pulse_width(pulse_width)
+        for _ in range(300):
+            step = random.choice((3, 6))
+            n = random.randint(1, MAX30102_FIFO_DEPTH)
+            src = bytearray(random.getrandbits(8) for _ in range(MAX30102_FIFO_DEPTH * 6))
+            for offset in range(0, step, 3):
+                fifo_decode(src, n, step, offset, sensor._fifo_shift, out)
+                ref = [sensor.fifo_bytes_to_int(bytes(src[i * step + offset:i * step + offset + 3]))
+                       for i in range(n)]
+                assert list(out[:n]) == ref
+        # end to end: check() / pop give what fifo_bytes_to_int() makes of
+        # the same FIFO bytes, i.e. the reading at the ADC resolution
+        raw = [random.getrandbits(18) for _ in range(20)]
+        words = []
+        for v in raw:
+            bus.push(v, v ^ 0x3FFFF)
+            words.append(bus.fifo[(bus.regs[MAX30102_FIFO_WRITE_PTR] - 1) & 0x1F])
+        assert sensor.check() == 20
+        got = drain()
+        assert got == [(sensor.fifo_bytes_to_int(w[:3]), sensor.fifo_bytes_to_int(w[3:])) for w in words]
+        drop = 18 - RESOLUTION[pulse_width]
+        assert got == [(v >> drop, (v ^ 0x3FFFF) >> drop) for v in raw]
+    assert sensor._fifo_shift == 0
+    print("fifo_decode == struct reference: OK (4 pulse widths x 300 bursts)")
+
+    # ---------- interrupt mode ----------
+    # 1000 samples at 50 Hz with a 1 ms polling loop. The 5-bit pointers
+    # wrap ~31 times and batches of 24 regularly straddle 31 -> 0.
+    def run(n_samples, polls_per_sample, base):
+        got = []
+        wrapped = 0
+        bus.transactions = 0
+        for i in range(n_samples):
+            bus.push(base + i, base + 50000 + i)
+            for _ in range(polls_per_sample):
+                rd = bus.regs[MAX30102_FIFO_READ_PTR]
+                n = sensor.check()
+                if n and rd + n > MAX30102_FIFO_DEPTH:
+                    wrapped += 1
+                got += drain()
+        got += drain()
+        assert got == [(base + i, base + 50000 + i) for i in range(len(got))]
+        return len(got), bus.transactions, wrapped
+
+    n, poll_tx, _ = run(1000, 20, 10000)
+    assert n == 1000
+
+    pin = FakePin()
+    bus.pin = pin
+    sensor.enable_interrupt_mode(pin, a_full=24)
+    assert sensor.check() == 0  # initial drain, FIFO empty
+    n, irq_tx, wrapped = run(1000, 20, 20000)
+    assert n == 1000 - 1000 % 24   # the tail stays until the next A_FULL
+    assert sensor.int_count == 1000 // 24
+    assert wrapped > 10 and sensor.overflow_count == 8  # nothing new lost
+    assert irq_tx * 10 < poll_tx
+    print("interrupt mode: OK | I2C transactions per 1000 samples:",
+          poll_tx, "(polling) ->", irq_tx, "(A_FULL)")
+
+    # the tail from above, then a uasyncio-style consumer sleeping on INT
+    sensor._int_pending = True
+    sensor.check()
+    drain()
+
+    async def feed():
+        for i in range(96):
+            bus.push(i, i)
+            await asyncio.sleep(0)
+
+    async def consume():
+        got = 0
+        while got < 96:
+            got += await sensor.wait_and_drain()
+            drain()
+        return got
+
+    async def both():
+        task = asyncio.create_task(feed())
+        got = await consume()
+        await task
+        return got
+
+    ints = sensor.int_count
+    # the consumer wakes a push or two late, so the last batch stays under
+    # A_FULL and comes in through the missed-edge timeout
+    assert asyncio.run(both()) == 96 and sensor.int_count - ints == 3
+
+    # PPG_RDY: one interrupt per sample
+    sensor.enable_interrupt_mode(pin, data_ready=True)
+    assert sensor.check() == 0
+    for i in range(5):
+        bus.push(i, i)
+        assert sensor.check() == 1
+        assert sensor.check() == 0
+    print("wait_and_drain / PPG_RDY: OK")
+
+    # ---------- sample timestamps ----------
+    # The sensor clock runs 1% slow, then 1% fast, against the MCU; the loop
+    # drains every 1-30 ms with occasional 150-400 ms stalls (uploads).
+    # Stamps from the FIFO must track the true sample times regardless.
+    sensor.disable_interrupt_mode()
+    sensor.check()
+    drain()
+    clock = [0]
+
+    def ticks_ms():
+        # module-level name used by check(): a simulated MCU clock
+        return clock[0]
+
+    for drift in (1.01, 0.99):
+        sensor.update_acquisition_frequency()
+        period = sensor._acq_period_us / 1000 * drift
+        start = clock[0]
+        t_true = start + period
+        pending = []
+        stamped_err = []
+        naive_err = []
+        while clock[0] < start + 120000:
+            clock[0] += random.randint(150, 400) if random.random() < 0.03 else random.randint(1, 30)
+            while t_true <= clock[0]:
+                bus.push(1, 1)
+                pending.append(t_true)
+                t_true += period
+            sensor.check()
+            while True:
+                sample = sensor.pop_sample()
+                if sample is None:
+                    break
+                truth = pending.pop(0)
+                if truth > start + 10000:
+                    stamped_err.append(sample[0] - truth)
+                    naive_err.append(clock[0] - truth)
+        worst = max(abs(e) for e in stamped_err)
+        mean = sum(abs(e) for e in stamped_err) / len(stamped_err)
+        naive = sum(abs(e) for e in naive_err) / len(naive_err)
+        print("timestamps, sensor clock x{}: mean |err| {:.1f} ms, max {:.1f} ms"
+              " (time of processing: mean {:.1f} ms, max {:.0f} ms)".format(
+                  drift, mean, worst, naive, max(naive_err)))
+        assert worst <= period and mean * 5 < naive
@@ -0,0 +1,172 @@
+# obs_template.py - 預先序列化的 Observation JSON 範本
+#
+# Building an Observation dict and json.dumps()-ing it allocates the whole
+# nested structure (category, code, system strings ...) on every upload,
+# only to change one number and a timestamp. ObservationTemplate renders
+# the resource once with marker strings in the variable fields, keeps the
+# static JSON between them as bytes, and afterwards only splices the
+# encoded values in.
+#
+# The markers are produced by the very same builder and json.dumps, so a
+# rendered template is byte-for-byte what json.dumps(build(...)) gives for
+# the same values (checked below, together with a benchmark).
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+MARK = "@@tpl{}@@"
+
+
+class ObservationTemplate(object):
+    def __init__(self, build, variables, **fixed):
+        """
+        Args:
+            build: 產生 Observation dict 的函數（例如 FHIRClient.build_heart_rate_observation）
+            variables: 每次會變動的參數名稱
+            fixed: 其餘固定參數
+        """
+        self.variables = tuple(variables)
+        kwargs = dict(fixed)
+        for i in range(len(self.variables)):
+            kwargs[self.variables[i]] = MARK.format(i)
+        text = json.dumps(build(**kwargs))
+
+        parts = []
+        order = []
+        pos = 0
+        while True:
+            start = text.find('"@@tpl', pos)
+            if start < 0:
+                break
+            end = text.index('@@"', start + 6)
+            parts.append(text[pos:start].encode())
+            order.append(int(text[start + 6:end]))
+            pos = end + 3
+        parts.append(text[pos:].encode())
+        if sorted(order) != list(range(len(self.variables))):
+            raise ValueError("variable not found once in the rendered resource")
+
+        self._parts = parts
+        self._order = order
+        self.static_bytes = sum([len(p) for p in parts])
+
+    def render(self, *values):
+        """以 values（順序同 variables）產生完整 JSON bytes"""
+        out = [self._parts[0]]
+        for i in range(len(self._order)):
+            out.append(json.dumps(values[self._order[i]]).encode())
+            out.append(self._parts[i + 1])
+        return b''.join(out)
+
+    def render_into(self, buf, *values):
+        """
+        寫入預先配置的 bytearray，不產生完整字串
+
+        Returns:
+            int: 寫入長度（buf 太小時 raise ValueError）
+        """
+        mv = memoryview(buf)
+        size = len(buf)
+        pos = 0
+        for i in range(len(self._parts)):
+            if i:
+                v = json.dumps(values[self._order[i - 1]]).encode()
+                if pos + len(v) > size:
+                    raise ValueError("template buffer too small")
+                mv[pos:pos + len(v)] = v
+                pos += len(v)
+            part = self._parts[i]
+            if pos + len(part) > size:
+                raise ValueError("template buffer too small")
+            mv[pos:pos + len(part)] = part
+            pos += len(part)
+        return pos
+
+
+# ==================== 測試代碼 ====================
+# Equivalence with the dict + json.dumps path, then a benchmark. Runs on
+# CPython and on the board (where it also reports heap allocation).
+if __name__ == '__main__':
+    import random
+    import gc
+
+    try:
+        from utime import ticks_us, ticks_diff
+    except ImportError:
+        from time import perf_counter
+
+        def ticks_us():
+            return int(perf_counter() * 1000000)
+
+        def ticks_diff(a, b):
+            return a - b
+
+    from fhir_client_enhanced import FHIRClient
+
+    client = FHIRClient("http://192.168.0.9:8080/fhir")
+    hr_tpl = ObservationTemplate(client.build_heart_rate_observation,
+                                 ('heart_rate', 'measurement_time'), patient_id="1139")
+    vs_tpl = ObservationTemplate(client.build_vital_sign_observation,
+                                 ('value', 'measurement_time'), patient_id="1139",
+                                 measurement_type="血氧飽和度", unit="%")
+
+    random.seed(3)
+    buf = bytearray(1024)
+    for i in range(2000):
+        hr = round(random.uniform(30, 220), 1) if i % 3 else random.randint(30, 220)
+        stamp = "2026-10-{:02d}T{:02d}:{:02d}:{:02d}".format(
+            random.randint(1, 28), random.randint(0, 23), random.randint(0, 59), random.randint(0, 59))
+        ref = json.dumps(client.build_heart_rate_observation("1139", hr, stamp)).encode()
+        assert hr_tpl.render(hr, stamp) == ref
+        n = hr_tpl.render_into(buf, hr, stamp)
+        assert bytes(buf[:n]) == ref
+
+        spo2 = round(random.uniform(85, 100), 2)
+        ref = json.dumps(client.build_vital_sign_observation(
+            "1139", "血氧飽和度", spo2, "%", stamp)).encode()
+        assert vs_tpl.render(spo2, stamp) == ref
+
+    # FHIRClient(templates=True) sends exactly what the dict path sends
+    sent = []
+
+    class CaptureClient(FHIRClient):
+        def _make_request(self, method, url, data=None, params=None):
+            sent.append(self._encode(data))
+            return True, {"id": "1"}
+
+    for use_templates in (False, True):
+        c = CaptureClient(templates=use_templates)
+        c.create_heart_rate_observation("1139", 71.5, "2026-10-17T12:00:00")
+        c.create_vital_sign_observation("1139", "體溫", 36.6, "Cel", "2026-10-17T12:00:00")
+    assert sent[0].encode() == sent[2] and sent[1].encode() == sent[3]
+    print("templates == json.dumps(dict): OK (2000 x 2 resources)")
+    print("static bytes per heart-rate Observation:", hr_tpl.static_bytes)
+
+    # fewer rounds on the board: the heap is measured with gc disabled
+    N = 200 if hasattr(gc, 'mem_alloc') else 2000
+    stamp = "2026-10-17T12:00:00"
+
+    def bench(label, fn):
+        mem = getattr(gc, 'mem_alloc', None)
+        gc.collect()
+        if mem:
+            gc.disable()
+            m0 = mem()
+        t0 = ticks_us()
+        for i in range(N):
+            fn(72.5)
+        us = ticks_diff(ticks_us(), t0) / N
+        extra = ""
+        if mem:
+            extra = " | {} B heap".format((mem() - m0) // N)
+            gc.enable()
+        print("{:<24}: {:7.1f} us{}".format(label, us, extra))
+        return us
+
+    t_dict = bench("dict + json.dumps", lambda v: json.dumps(
+        client.build_heart_rate_observation("1139", v, stamp)))
+    t_tpl = bench("template.render", lambda v: hr_tpl.render(v, stamp))
+    t_into = bench("template.render_into", lambda v: hr_tpl.render_into(buf, v, stamp))
+    print("speed-up: {:.1f}x (render) / {:.1f}x (render_into)".format(t_dict / t_tpl, t_dict / t_into))
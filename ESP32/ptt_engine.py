@@ -0,0 +1,274 @@
+# ptt_engine.py - 脈波傳導時間（ECG R 波 -> PPG 上升段）
+#
+# Pulse transit (strictly: pulse arrival) time is the delay from an ECG
+# R-peak to the arrival of the same beat at the finger. It shortens when
+# blood pressure rises, so its trend is worth reporting; single values are
+# noisy, so the engine uploads summaries (mean / SD / min / max / count per
+# interval), not pairs.
+#
+# Both event streams carry ticks_ms sample timestamps (ECG: ADCSampler,
+# PPG: the MAX30102 sample clock) but reach the engine out of step - the
+# PPG arrives in FIFO bursts up to a second late. Matching is therefore
+# deferred and bounded:
+#
+#   - R-peaks go into a ring of the last R_RING times
+#   - an upstroke u waits in a ring of PENDING_RING until it can be
+#     decided: an R-peak later than u - ptt_min_ms has arrived (so no
+#     better candidate can still come), or settle_ms of newer events passed
+#   - its partner is the latest R-peak r <= u - ptt_min_ms; the pair counts
+#     if u - r <= ptt_max_ms and r was not used by an earlier upstroke
+#   - after warm_up pairs, a PTT more than max_jump_ms away from the running
+#     trend (integer EWMA, Q4 ms) is rejected as a mismatched beat; warm_up
+#     rejections in a row mean the trend itself is wrong (a bad start, or a
+#     real step), so it is seeded again from the next pair
+#
+# Statistics are integer sums (n, sum, sum of squares, min, max) per
+# summary interval and for the whole session: O(1) memory and no
+# allocation per beat. ptt_replay.py is the NumPy twin.
+
+from array import array
+from math import sqrt
+
+try:
+    from utime import ticks_diff
+except ImportError:
+    def ticks_diff(a, b):
+        return a - b
+
+R_RING = 8
+PENDING_RING = 8
+# EWMA trend in Q4 ms, weight 1/8 per accepted pair
+TREND_FRAC_BITS = 4
+TREND_SHIFT = 3
+
+
+class PTTStats(object):
+    ''' n / sum / sum of squares / min / max of integer PTTs '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.s1 = 0
+        self.s2 = 0
+        self.min = 0
+        self.max = 0
+
+    def add(self, ptt):
+        if self.n == 0 or ptt < self.min:
+            self.min = ptt
+        if self.n == 0 or ptt > self.max:
+            self.max = ptt
+        self.n += 1
+        self.s1 += ptt
+        self.s2 += ptt * ptt
+
+    def mean(self):
+        return self.s1 / self.n if self.n else 0.0
+
+    def sd(self):
+        # sample standard deviation
+        if self.n < 2:
+            return 0.0
+        return sqrt(max(self.s2 - self.s1 * self.s1 / self.n, 0.0) / (self.n - 1))
+
+    def summary(self):
+        """(n, mean, sd, min, max)，mean / sd 四捨五入到 0.1 ms"""
+        return (self.n, round(self.mean(), 1), round(self.sd(), 1), self.min, self.max)
+
+
+class PTTEngine(object):
+    def __init__(self, ptt_min_ms=120, ptt_max_ms=450, settle_ms=2000,
+                 max_jump_ms=60, warm_up=3):
+        self.ptt_min_ms = ptt_min_ms
+        self.ptt_max_ms = ptt_max_ms
+        self.settle_ms = settle_ms
+        self.max_jump_ms = max_jump_ms
+        self.warm_up = warm_up
+
+        self._r = array('i', bytes(4 * R_RING))
+        self._u = array('i', bytes(4 * PENDING_RING))
+
+        self.interval = PTTStats()
+        self.session = PTTStats()
+        self.restart()
+
+    def restart(self):
+        # Forget pending events (e.g. leads or finger off)
+        self._r_head = 0
+        self._r_count = 0
+        self._u_tail = 0
+        self._u_count = 0
+        self._last_used = None
+        self._newest = None
+        self.trend = 0            # Q4 ms
+        self.accepted = 0
+        self._misses = 0
+
+        self.last_ptt = 0
+        self.unmatched = 0
+        self.rejected = 0
+
+    def trend_ms(self):
+        return self.trend >> TREND_FRAC_BITS
+
+    # ---------- events ----------
+
+    def add_r_peak(self, t):
+        """ECG R 波時間（ticks_ms，遞增）"""
+        self._r[self._r_head] = t
+        self._r_head = (self._r_head + 1) % R_RING
+        if self._r_count < R_RING:
+            self._r_count += 1
+        self._seen(t)
+        return self._match(False)
+
+    def add_upstroke(self, t):
+        """PPG 上升段時間（ticks_ms，遞增）"""
+        if self._u_count == PENDING_RING:
+            # nothing decided for a whole ring: oldest is unmatched
+            self._u_tail = (self._u_tail + 1) % PENDING_RING
+            self._u_count -= 1
+            self.unmatched += 1
+        self._u[(self._u_tail + self._u_count) % PENDING_RING] = t
+        self._u_count += 1
+        self._seen(t)
+        return self._match(False)
+
+    def flush(self):
+        """結束時決定所有等待中的上升段"""
+        return self._match(True)
+
+    def _seen(self, t):
+        if self._newest is None or ticks_diff(t, self._newest) > 0:
+            self._newest = t
+
+    # ---------- matching ----------
+
+    def _latest_r(self, limit):
+        # Latest R-peak <= limit, or None; also whether a later one exists
+        later = False
+        i = self._r_head
+        for _ in range(self._r_count):
+            i = (i - 1) % R_RING
+            r = self._r[i]
+            if ticks_diff(r, limit) <= 0:
+                return r, later
+            later = True
+        return None, later
+
+    def _match(self, force):
+        # Decide pending upstrokes oldest first; returns the number of new
+        # accepted PTTs
+        new = 0
+        while self._u_count:
+            u = self._u[self._u_tail]
+            r, later = self._latest_r(u - self.ptt_min_ms)
+            if not (force or later or ticks_diff(self._newest, u) > self.settle_ms):
+                break
+            self._u_tail = (self._u_tail + 1) % PENDING_RING
+            self._u_count -= 1
+
+            if r is None or ticks_diff(u, r) > self.ptt_max_ms or \
+                    (self._last_used is not None and ticks_diff(r, self._last_used) <= 0):
+                self.unmatched += 1
+                continue
+            self._last_used = r
+            if self._accept(ticks_diff(u, r)):
+                new += 1
+        return new
+
+    def _accept(self, ptt):
+        q = ptt << TREND_FRAC_BITS
+        if self.accepted >= self.warm_up and \
+                abs(q - self.trend) > (self.max_jump_ms << TREND_FRAC_BITS):
+            self.rejected += 1
+            self._misses += 1
+            if self._misses >= self.warm_up:
+                self.accepted = 0
+                self._misses = 0
+            return False
+        self._misses = 0
+        if self.accepted == 0:
+            self.trend = q
+        else:
+            self.trend += (q - self.trend) >> TREND_SHIFT
+        self.accepted += 1
+        self.last_ptt = ptt
+        self.interval.add(ptt)
+        self.session.add(ptt)
+        return True
+
+    def take_summary(self, min_pairs=5):
+        """
+        取出這段期間的摘要並重新開始累計
+
+        Returns:
+            (n, mean, sd, min, max)；配對數不足 min_pairs 時 None（累計保留）
+        """
+        if self.interval.n < min_pairs:
+            return None
+        summary = self.interval.summary()
+        self.interval.reset()
+        return summary
+
+
+# ==================== 測試代碼 ====================
+# Simulated R-peaks and finger upstrokes with a PTT that drifts from 240 to
+# 200 ms and back, plus missed beats on both sides, spurious PPG beats and
+# the PPG stream delivered in 640 ms bursts (as from the MAX30102 FIFO).
+if __name__ == '__main__':
+    import math
+    import random
+
+    random.seed(20)
+
+    def true_ptt(sec):
+        return 220 + 20 * math.cos(2 * math.pi * sec / 60)
+
+    r_peaks = []
+    upstrokes = []
+    t = 500.0
+    while t < 120000:
+        r_peaks.append(int(t))
+        u = t + true_ptt(t / 1000) + random.gauss(0, 4)
+        upstrokes.append(int(u))
+        t += 60000 / (70 + 8 * math.sin(t / 9000)) + random.gauss(0, 20)
+    ecg = [r for r in r_peaks if random.random() > 0.03]
+    ppg = [u for u in upstrokes if random.random() > 0.05]
+    # beats seen by both sensors: the pairs to find
+    both = len([1 for r, u in zip(r_peaks, upstrokes) if r in ecg and u in ppg])
+    # spurious PPG detections (dicrotic notch / motion)
+    ppg += [r + random.randint(500, 700) for r in random.sample(r_peaks, 10)]
+    ppg.sort()
+
+    engine = PTTEngine()
+    summaries = []
+    burst_end = 640
+    ei = pi = 0
+    while ei < len(ecg) or pi < len(ppg):
+        # ECG events arrive as they happen, PPG ones when their burst is read
+        if pi < len(ppg) and ppg[pi] < burst_end and (ei >= len(ecg) or ecg[ei] >= burst_end):
+            while pi < len(ppg) and ppg[pi] < burst_end:
+                engine.add_upstroke(ppg[pi])
+                pi += 1
+        elif ei < len(ecg) and (ecg[ei] < burst_end or pi >= len(ppg)):
+            engine.add_r_peak(ecg[ei])
+            ei += 1
+        else:
+            burst_end += 640
+        if engine.interval.n >= 30:
+            summaries.append(engine.take_summary())
+    engine.flush()
+
+    n, mean, sd, lo, hi = engine.session.summary()
+    print("pairs {} / {} upstrokes | unmatched {} | rejected {}".format(
+        n, len(ppg), engine.unmatched, engine.rejected))
+    print("session PTT {} ms (SD {}, {} - {}) | trend {} ms".format(mean, sd, lo, hi, engine.trend_ms()))
+    for s in summaries:
+        print("  summary:", s)
+    # every beat seen by both is paired; spurious upstrokes and beats whose
+    # R-peak was missed are not
+    assert n == both and engine.unmatched + engine.rejected == len(ppg) - both
+    assert 190 < lo and hi < 255 and 210 < mean < 230 and 10 < sd < 20
+    print("PTT matcher: OK")
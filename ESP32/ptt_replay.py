@@ -0,0 +1,185 @@
+# ptt_replay.py - PTT 引擎的 NumPy 重播版本（僅在電腦上執行，不需上傳 ESP32）
+#
+# Vectorized twin of ptt_engine.PTTEngine for recorded beat events. With
+# every event known up front the deferred matcher collapses to one
+# np.searchsorted (latest R-peak at least ptt_min_ms before each upstroke),
+# a window mask and a first-use mask per R-peak; only the sparse candidate
+# list is walked for the trend-jump rejection, which is recursive. The
+# accepted PTTs are identical to feeding the same events through PTTEngine
+# in time order.
+#
+# Usage:
+#   python ptt_replay.py events.csv [summary_ms]
+# where events.csv holds "t_ms,kind" rows, kind 0 = ECG R-peak (e.g.
+# ecg_replay.replay()['beat_ts']) and 1 = PPG upstroke.
+
+import numpy as np
+
+from ptt_engine import PTTEngine, PTTStats, TREND_FRAC_BITS, TREND_SHIFT
+
+
+def load_events(path):
+    """
+    讀取心跳事件紀錄
+
+    Returns:
+        (r_peaks, upstrokes) int64 arrays（已排序）
+    """
+    data = np.loadtxt(path, delimiter=',', ndmin=2, dtype=np.int64)
+    t, kind = data[:, 0], data[:, 1]
+    return np.sort(t[kind == 0]), np.sort(t[kind == 1])
+
+
+def match(r_peaks, upstrokes, ptt_min_ms=120, ptt_max_ms=450,
+          max_jump_ms=60, warm_up=3):
+    """
+    Pair each upstroke with the latest R-peak <= u - ptt_min_ms.
+
+    Returns:
+        dict: 't' (upstroke time) and 'ptt' of accepted pairs,
+        'unmatched' and 'rejected' counts
+    """
+    r = np.asarray(r_peaks, dtype=np.int64)
+    u = np.asarray(upstrokes, dtype=np.int64)
+
+    idx = np.searchsorted(r, u - ptt_min_ms, 'right') - 1
+    has_r = idx >= 0
+    ptt = np.where(has_r, u - r[np.maximum(idx, 0)], 0)
+    valid = has_r & (ptt <= ptt_max_ms)
+    # an R-peak pairs with its first upstroke only
+    vi = np.flatnonzero(valid)
+    first = np.ones(len(vi), dtype=bool)
+    first[1:] = idx[vi[1:]] != idx[vi[:-1]]
+    cand = vi[first]
+
+    # trend-jump rejection: same integer EWMA as PTTEngine._accept()
+    keep = []
+    trend = 0
+    accepted = 0
+    misses = 0
+    limit = max_jump_ms << TREND_FRAC_BITS
+    for i, p in zip(cand.tolist(), ptt[cand].tolist()):
+        q = p << TREND_FRAC_BITS
+        if accepted >= warm_up and abs(q - trend) > limit:
+            misses += 1
+            if misses >= warm_up:
+                accepted = 0
+                misses = 0
+            continue
+        misses = 0
+        trend = q if accepted == 0 else trend + ((q - trend) >> TREND_SHIFT)
+        accepted += 1
+        keep.append(i)
+
+    keep = np.array(keep, dtype=np.int64)
+    return {
+        't': u[keep],
+        'ptt': ptt[keep],
+        'unmatched': int(len(u) - len(cand)),
+        'rejected': int(len(cand) - len(keep))
+    }
+
+
+def summaries(t, ptt, summary_ms=30000):
+    """
+    每 summary_ms 一筆摘要（以上升段時間分段）
+
+    Returns:
+        rows of (start_ms, n, mean, sd, min, max) as a 2-D float array
+    """
+    t = np.asarray(t, dtype=np.int64)
+    ptt = np.asarray(ptt, dtype=np.float64)
+    if len(t) == 0:
+        return np.zeros((0, 6))
+    bins = (t - t[0]) // summary_ms
+    rows = []
+    for b in np.unique(bins).tolist():
+        p = ptt[bins == b]
+        sd = p.std(ddof=1) if len(p) > 1 else 0.0
+        rows.append((t[0] + b * summary_ms, len(p), p.mean(), sd, p.min(), p.max()))
+    return np.array(rows)
+
+
+def replay_engine(r_peaks, upstrokes, **params):
+    """Reference: push the events through PTTEngine in time order."""
+    engine = PTTEngine(**params)
+    events = sorted([(int(v), 0) for v in r_peaks] + [(int(v), 1) for v in upstrokes])
+    t_list = []
+    ptt_list = []
+    for t, kind in events:
+        if kind == 0:
+            new = engine.add_r_peak(t)
+        else:
+            new = engine.add_upstroke(t)
+        if new:
+            t_list.append(t)
+            ptt_list.append(engine.last_ptt)
+    if engine.flush():
+        t_list.append(events[-1][0])
+        ptt_list.append(engine.last_ptt)
+    return {
+        't': np.array(t_list, dtype=np.int64),
+        'ptt': np.array(ptt_list, dtype=np.int64),
+        'unmatched': engine.unmatched,
+        'rejected': engine.rejected,
+        'session': engine.session.summary()
+    }
+
+
+def synthetic_events(seconds=3600, seed=0):
+    """合成 R 波 / 上升段：PTT 隨血壓緩慢變化，加上漏拍、假上升段與一次 80 ms 的階躍"""
+    rng = np.random.default_rng(seed)
+    rr = 60000 / (70 + 8 * np.sin(np.arange(int(seconds * 1.5)) / 12.0))
+    r = 500 + np.cumsum(rr + rng.normal(0, 20, len(rr)))
+    r = r[r < seconds * 1000]
+    ptt = 220 + 20 * np.cos(2 * np.pi * r / 60000) + rng.normal(0, 4, len(r))
+    # occasional late upstrokes (motion) and a lasting 80 ms step
+    ptt[rng.random(len(r)) < 0.01] += 120
+    ptt[r > seconds * 500] -= 80
+    u = r + ptt
+    r_seen = r[rng.random(len(r)) > 0.03]
+    u_seen = u[rng.random(len(u)) > 0.05]
+    spurious = rng.choice(r, len(r) // 14) + rng.integers(500, 700, len(r) // 14)
+    u_seen = np.sort(np.concatenate((u_seen, spurious)))
+    return r_seen.astype(np.int64), u_seen.astype(np.int64)
+
+
+# ==================== 測試代碼 ====================
+if __name__ == '__main__':
+    import sys
+    import time
+
+    summary_ms = 30000
+    if len(sys.argv) > 1:
+        r_peaks, upstrokes = load_events(sys.argv[1])
+        if len(sys.argv) > 2:
+            summary_ms = int(sys.argv[2])
+    else:
+        r_peaks, upstrokes = synthetic_events()
+
+    print("=" * 50)
+    print("PTT replay: {} R-peaks, {} upstrokes".format(len(r_peaks), len(upstrokes)))
+    print("=" * 50)
+
+    t0 = time.perf_counter()
+    fast = match(r_peaks, upstrokes)
+    rows = summaries(fast['t'], fast['ptt'], summary_ms)
+    t1 = time.perf_counter()
+    ref = replay_engine(r_peaks, upstrokes)
+    t2 = time.perf_counter()
+
+    stats = PTTStats()
+    for p in fast['ptt'].tolist():
+        stats.add(p)
+    identical = (np.array_equal(fast['ptt'], ref['ptt']) and
+                 fast['unmatched'] == ref['unmatched'] and
+                 fast['rejected'] == ref['rejected'] and
+                 stats.summary() == ref['session'])
+    print("pairs:", len(fast['ptt']), "| unmatched:", fast['unmatched'],
+          "| rejected:", fast['rejected'])
+    print("session (n, mean, sd, min, max):", ref['session'])
+    print("summaries:", len(rows), "| first:", np.round(rows[0], 1).tolist() if len(rows) else None)
+    print("NumPy replay : {:.3f} s".format(t1 - t0))
+    print("PTTEngine    : {:.3f} s".format(t2 - t1))
+    print("identical:", identical)
+    sys.exit(0 if identical else 1)
@@ -1,17 +1,19 @@
 from max30102 import MAX30102
 from utime import ticks_ms, ticks_diff
+from dsp import OnePole
+from spo2_engine import SpO2Engine
 
+# DC remover works on raw << PPG_FRAC_BITS (finer steps for the beat
+# detector; SpO2 uses the raw samples)
+PPG_FRAC_BITS = 2
 
-class IIR_filter(object):
-    def __init__(self, alpha):
-        self.old_value = 0
-        self.alpha = alpha
-
-    def step(self, value):
-        value = (self.old_value*self.alpha
-                 + value*(1 - self.alpha))
-        self.old_value = value
-        return value
+# Beat and AC timing use the sensor's per-sample timestamps (ticks_ms of
+# the moment the sample was taken, see MAX30102.pop_sample()), not the time
+# the loop got around to processing it.
+#
+# SpO2 comes from spo2_engine.SpO2Engine (windowed ratio-of-ratios over the
+# raw samples, calibration table); the peak-to-peak AC extractors below are
+# only used for beat detection.
 
 
 class AC_extractor(object):
@@ -26,18 +28,18 @@ class AC_extractor(object):
 
         self.is_down_period = False
 
-    def update(self, value_nodc):
+    def update(self, value_nodc, t):
         if value_nodc > 0:
             if self.max_ac != 0 and self.min_ac != 0:
                 self.is_down_period = False
-                time_intval = ticks_diff(ticks_ms(), self.cycle_time_mark)
+                time_intval = ticks_diff(t, self.cycle_time_mark)
                 if 2000 > time_intval > 270:
                     self.ac = self.max_ac - self.min_ac
-                    self.get_time_mark = ticks_ms()
+                    self.get_time_mark = t
                 self.max_ac = 0
                 self.min_ac = 0
                 
-                self.cycle_time_mark = ticks_ms()
+                self.cycle_time_mark = t
             else:
                 if value_nodc > self.max_ac:
                     self.max_ac = value_nodc
@@ -63,9 +65,11 @@ class HR_calculator(object):
 
         self.is_beating = False
 
-    def update(self, is_beating):
-        if self.is_beating == False and is_beating == True:
-            rr_intval = ticks_diff(ticks_ms(), self.beat_time_mark)
+    def update(self, is_beating, t):
+        # Returns True at the start of a beat (the PPG upstroke)
+        onset = self.is_beating == False and is_beating == True
+        if onset:
+            rr_intval = ticks_diff(t, self.beat_time_mark)
             if 2000 > rr_intval > 270:
                 self.n_beats += 1
                 self.tot_intval += rr_intval
@@ -78,20 +82,29 @@ class HR_calculator(object):
                 self.tot_intval = 0
                 self.n_beats = 0
 
-            self.beat_time_mark = ticks_ms()
+            self.beat_time_mark = t
         self.is_beating = is_beating
+        return onset
 
     def get_heart_rate(self):
         return self.heart_rate
 
 
 class Pulse_oximeter(object):
-    def __init__(self, sensor):
+    def __init__(self, sensor, agc=None, spo2_engine=None, on_beat=None):
+        # agc: optional led_agc.LedAGC steering the LED currents
+        # spo2_engine: SpO2Engine (e.g. with a device-specific table)
+        # on_beat: called with the sample time of every PPG upstroke
+        #          (e.g. PTTEngine.add_upstroke)
         sensor.set_led_mode(2)
         self.sensor = sensor
+        self.agc = agc
+        self.spo2_engine = spo2_engine if spo2_engine is not None else SpO2Engine()
+        self.on_beat = on_beat
 
         self.raw_ir = 0
         self.raw_red = 0
+        self.sample_time = 0
 
         self.spo2 = 0
         self.heart_rate = 0
@@ -102,50 +115,76 @@ class Pulse_oximeter(object):
         self.ac_extractor_ir = AC_extractor()
         self.ac_extractor_red = AC_extractor()
 
-        self.dc_remover_ir = IIR_filter(0.99)
-        self.dc_remover_red = IIR_filter(0.99)
+        self.dc_remover_ir = OnePole(0.99)
+        self.dc_remover_red = OnePole(0.99)
+        self._dc_primed = False
 
         self.hr_calculator = HR_calculator()
 
     def update(self):
-        self.spo2 = 0
+        # Poll the sensor and process one sample
         self.sensor.check()
-        if (self.sensor.available()):
+        sample = self.sensor.pop_sample()
+        if sample is not None:
             self.is_available = True
-            self.raw_ir = self.sensor.pop_ir_from_storage()
-            self.raw_red = self.sensor.pop_red_from_storage()
-
-            ir_dc = self.dc_remover_ir.step(self.raw_ir)
-            red_dc = self.dc_remover_red.step(self.raw_red)
-
-            ir_nodc = self.raw_ir - ir_dc
-            red_nodc = self.raw_red - red_dc
-
-            self.ac_extractor_ir.update(ir_nodc)
-            self.ac_extractor_red.update(red_nodc)
-
-            ir_ac = self.ac_extractor_ir.ac
-            red_ac = self.ac_extractor_red.ac
-
-            time_mark_ir = self.ac_extractor_ir.get_time_mark
-            time_mark_red = self.ac_extractor_red.get_time_mark
-
-            self.is_beating = self.ac_extractor_red.is_down_period
-
-            self.hr_calculator.update(self.is_beating)
-            self.heart_rate = self.hr_calculator.get_heart_rate()
-
-            ir_red_intval = abs(ticks_diff(time_mark_ir, time_mark_red))
-            if ir_ac > 0 and red_ac > 0:
-                if ir_red_intval < 100:
-                    ratio = (red_ac/red_dc)/(ir_ac/ir_dc)
-                    self.spo2 = -45.060*ratio**2 + 30.354*ratio + 94.845
-                
-                self.ac_extractor_ir.reset_ac()
-                self.ac_extractor_red.reset_ac()
+            self._process(*sample)
         else:
             self.is_available = False
 
+    def drain(self):
+        # Process every sample already read from the FIFO (after
+        # sensor.check() or sensor.wait_and_drain()); returns the count
+        n = 0
+        while True:
+            sample = self.sensor.pop_sample()
+            if sample is None:
+                break
+            self._process(*sample)
+            n += 1
+        self.is_available = n > 0
+        return n
+
+    def _process(self, t, ir, red):
+        self.raw_ir = ir
+        self.raw_red = red
+        self.sample_time = t
+
+        if self.agc is not None and self.agc.update(t, self.raw_ir, self.raw_red):
+            # LED current changed: DC steps, start tracking afresh
+            self._dc_primed = False
+            self.ac_extractor_ir.reset_ac()
+            self.ac_extractor_red.reset_ac()
+            self.spo2_engine.restart()
+
+        # latest window estimate; 0 until the first one or while the
+        # engine rejects the signal
+        self.spo2_engine.update(t, self.raw_ir, self.raw_red)
+        self.spo2 = self.spo2_engine.spo2 or 0
+
+        ir_q = self.raw_ir << PPG_FRAC_BITS
+        red_q = self.raw_red << PPG_FRAC_BITS
+        if not self._dc_primed:
+            # start at the first reading instead of ramping up from 0
+            self.dc_remover_ir.reset(ir_q)
+            self.dc_remover_red.reset(red_q)
+            self._dc_primed = True
+
+        ir_nodc = ir_q - self.dc_remover_ir.step(ir_q)
+        red_nodc = red_q - self.dc_remover_red.step(red_q)
+
+        self.ac_extractor_ir.update(ir_nodc, t)
+        self.ac_extractor_red.update(red_nodc, t)
+
+        self.is_beating = self.ac_extractor_red.is_down_period
+
+        if self.hr_calculator.update(self.is_beating, t) and self.on_beat is not None:
+            self.on_beat(t)
+        self.heart_rate = self.hr_calculator.get_heart_rate()
+
+        if self.ac_extractor_ir.ac > 0 and self.ac_extractor_red.ac > 0:
+            self.ac_extractor_ir.reset_ac()
+            self.ac_extractor_red.reset_ac()
+
     def available(self):
         return self.is_available
 
@@ -158,5 +197,8 @@ class Pulse_oximeter(object):
     def get_raw_red(self):
         return self.raw_red
 
+    def get_sample_time(self):
+        return self.sample_time
+
     def get_heart_rate(self):
         return self.heart_rate
\ No newline at end of file
@@ -0,0 +1,145 @@
+# rr_stream.py - 逐拍 RR 間隔串流（上傳為 FHIR valueSampledData）
+#
+# Instead of sampling heart_rate every PRINT_EVERY_MS, every detected R-peak
+# is kept: its timestamp is delta-encoded against the previous beat, which
+# is exactly the RR interval, into a preallocated array('H'). A chunk is
+# handed off once it spans flush_ms (or the buffer is full) as
+# (rr, t0_ms), where t0_ms is the beat the first RR is measured from -
+# the last beat of the previous chunk - so consecutive chunks join up and
+# beat k of a chunk sits at t0_ms + rr[0] + ... + rr[k]. On the server the
+# chunk start is effectiveDateTime, which main.py writes to the millisecond
+# (wall_time_iso), so the join survives the upload.
+#
+# Beats are not filtered here (the dashboard decides what is an artefact);
+# an RR that does not fit 16 bits (a gap over 65 s) starts a new chunk with
+# that beat as its reference.
+
+from array import array
+
+try:
+    from utime import ticks_diff
+except ImportError:
+    def ticks_diff(a, b):
+        return a - b
+
+RR_MAX = 0xFFFF
+
+
+class RRStream(object):
+    def __init__(self, flush_ms=30000, max_beats=128):
+        self.flush_ms = flush_ms
+        self.max_beats = max_beats
+
+        self._buf = array('H', bytes(2 * max_beats))
+        self._n = 0
+        self._span = 0
+        self._last = None
+        self.t0_ms = 0
+
+        self.beats = 0
+        self.chunks = 0
+
+    def restart(self):
+        # Drop the pending chunk and the reference beat (e.g. leads off)
+        self._n = 0
+        self._span = 0
+        self._last = None
+
+    def add(self, t):
+        """
+        每個 R 波呼叫一次
+
+        Args:
+            t: R 波時間（ticks_ms，遞增）
+
+        Returns:
+            (rr, t0_ms)：這個心跳讓一段資料滿了時；否則 None
+        """
+        self.beats += 1
+        if self._last is None:
+            self._last = t
+            self.t0_ms = t
+            return None
+        rr = ticks_diff(t, self._last)
+        out = None
+        if rr > RR_MAX:
+            out = self.flush()
+            self._n = 0
+            self._span = 0
+            self._last = t
+            self.t0_ms = t
+            return out
+
+        self._buf[self._n] = rr
+        self._n += 1
+        self._span += rr
+        self._last = t
+        if self._n == self.max_beats or self._span >= self.flush_ms:
+            out = self._take()
+        return out
+
+    def flush(self, min_beats=1):
+        # Hand off a partial chunk (end of a session)
+        if self._n < min_beats:
+            return None
+        return self._take()
+
+    def _take(self):
+        if self._n == self.max_beats:
+            rr = self._buf
+            self._buf = array('H', bytes(2 * self.max_beats))
+        else:
+            rr = self._buf[:self._n]
+        t0 = self.t0_ms
+        # the next chunk counts from this chunk's last beat
+        self.t0_ms = self._last
+        self._n = 0
+        self._span = 0
+        self.chunks += 1
+        return rr, t0
+
+
+# ==================== 測試代碼 ====================
+# Beat times are rebuilt from the chunks (t0 + running sum of RR) and must
+# match the R-peaks that went in, across chunk boundaries and a long gap.
+if __name__ == '__main__':
+    import random
+
+    from fhir_client_enhanced import FHIRClient
+
+    random.seed(22)
+    beats = []
+    t = 1000
+    for k in range(400):
+        t += random.randint(600, 1000)
+        if k == 250:
+            t += 70000                       # leads off for 70 s
+        beats.append(t)
+
+    stream = RRStream(flush_ms=30000, max_beats=40)
+    chunks = []
+    for t in beats:
+        out = stream.add(t)
+        if out is not None:
+            chunks.append(out)
+    chunks.append(stream.flush())
+
+    rebuilt = []
+    client = FHIRClient()
+    for rr, t0 in chunks:
+        obs = client.build_rr_observation("p1", rr)
+        values = FHIRClient.decode_sampled_data(obs["valueSampledData"])
+        assert values == [float(v) for v in rr]
+        t = t0
+        if not rebuilt or rebuilt[-1] != t0:
+            rebuilt.append(t0)
+        for v in values:
+            t += int(v)
+            rebuilt.append(t)
+    assert rebuilt == beats, "beat times lost"
+
+    n = sum([len(rr) for rr, _ in chunks])
+    data = sum([len(client.build_rr_observation("p1", rr)["valueSampledData"]["data"]) for rr, _ in chunks])
+    print("beats {} -> {} chunks (max {} RR) | data bytes per beat: {:.2f}".format(
+        len(beats), len(chunks), max([len(rr) for rr, _ in chunks]), data / n))
+    print("rr_stream: OK")
@@ -0,0 +1,259 @@
+# spo2_engine.py - 視窗式 ratio-of-ratios SpO2 估算（查表校正）
+#
+# SpO2 from a few seconds of IR/RED samples instead of one AC peak pair per
+# beat:
+#
+#   R = (AC_red / DC_red) / (AC_ir / DC_ir)      SpO2 = table(R)
+#
+# DC is the mean of the raw samples over the window. AC is the RMS of the
+# high-passed signal: raw minus a OnePole DC tracker, then minus a second
+# OnePole of the result (second order, so respiration wander at 0.2-0.3 Hz
+# does not leak into AC; dc_alpha 0.93 puts the corner near 0.6 Hz at 50 Hz).
+# Both channels use the same filter so R is unaffected by its gain.
+# Samples are summed per hop (hop_ms, default 1 s) in small ints - O(1) and
+# allocation-free per sample on MicroPython; the sum of squares carries into
+# a second counter before it would leave the small-int range. At the end of
+# every hop the last window_hops hops (default 4 -> a 4 s window sliding by 1 s) are
+# combined in floats and mapped through the calibration table with linear
+# interpolation (clamped at the ends).
+#
+# The default table samples the quadratic Pulse_oximeter used before
+# (-45.060 R^2 + 30.354 R + 94.845); pass a device-specific table measured
+# with spo2_replay.py. Windows with too little or too much pulsatile signal
+# (perfusion index outside [pi_min, pi_max] %) give no estimate, and
+# restart() drops the current window, e.g. after an LED current change.
+
+from math import sqrt
+
+from dsp import OnePole
+
+try:
+    from utime import ticks_diff
+except ImportError:
+    def ticks_diff(a, b):
+        return a - b
+
+# (R, SpO2 %) sorted by R
+DEFAULT_TABLE = (
+    (0.2, 99.1), (0.3, 99.9), (0.4, 99.7), (0.5, 98.7), (0.6, 96.8),
+    (0.7, 93.9), (0.8, 90.3), (0.9, 85.7), (1.0, 80.1), (1.1, 73.7),
+    (1.2, 66.3),
+)
+
+# |high-passed sample| limit: keeps v*v < 2**28 (beyond is motion anyway)
+AC_CLAMP = (1 << 14) - 1
+# carry the sum of squares into the high word at 2**28 (20-bit low word)
+SQ_CARRY = 1 << 28
+SQ_LOW_BITS = 20
+
+
+def lookup(table, r):
+    """以線性內插查表（超出範圍時取端點值）"""
+    if r <= table[0][0]:
+        return table[0][1]
+    for i in range(1, len(table)):
+        r1, s1 = table[i]
+        if r <= r1:
+            r0, s0 = table[i - 1]
+            return s0 + (s1 - s0) * (r - r0) / (r1 - r0)
+    return table[-1][1]
+
+
+def window_ratio(hops):
+    """
+    合併多個 hop 的累加值
+
+    Args:
+        hops: [n, sx_ir, s1_ir, s2_ir, sx_red, s1_red, s2_red] 列表
+
+    Returns:
+        (R, 紅外光灌注指數 %)；無法計算時 (None, 0.0)
+    """
+    tot = [0] * 7
+    for h in hops:
+        for k in range(7):
+            tot[k] += h[k]
+    n = tot[0]
+    if n == 0:
+        return None, 0.0
+    dc_ir = tot[1] / n
+    dc_red = tot[4] / n
+    ac_ir = sqrt(max(tot[3] / n - (tot[2] / n) ** 2, 0.0))
+    ac_red = sqrt(max(tot[6] / n - (tot[5] / n) ** 2, 0.0))
+    if dc_ir <= 0 or dc_red <= 0 or ac_ir <= 0:
+        return None, 0.0
+    pi_ir = 100.0 * ac_ir / dc_ir
+    return (ac_red / dc_red) / (ac_ir / dc_ir), pi_ir
+
+
+class SpO2Engine(object):
+    def __init__(self, hop_ms=1000, window_hops=4, dc_alpha=0.93,
+                 table=DEFAULT_TABLE, pi_min=0.05, pi_max=20.0):
+        self.hop_ms = hop_ms
+        self.window_hops = window_hops
+        self.table = table
+        self.pi_min = pi_min
+        self.pi_max = pi_max
+
+        self._dc_ir = OnePole(dc_alpha)
+        self._dc_red = OnePole(dc_alpha)
+        self._hp_ir = OnePole(dc_alpha)
+        self._hp_red = OnePole(dc_alpha)
+        self._hops = []
+
+        self.spo2 = None
+        self.r = None
+        self.perfusion = 0.0
+        self.updated_at = None
+        self.windows = 0
+        self.rejected = 0
+        self.restart()
+
+    def restart(self):
+        # Drop the window (e.g. after an LED current change)
+        self._primed = False
+        self._hops = []
+        self._hop_start = None
+        self._clear_hop()
+
+    def _clear_hop(self):
+        self._n = 0
+        self._sx_ir = 0
+        self._s1_ir = 0
+        self._s2_ir = 0
+        self._s2h_ir = 0
+        self._sx_red = 0
+        self._s1_red = 0
+        self._s2_red = 0
+        self._s2h_red = 0
+
+    def update(self, t, ir, red):
+        """
+        每個樣本呼叫一次
+
+        Args:
+            t: 樣本時間（ticks_ms）
+
+        Returns:
+            bool: 這個樣本是否結束一個 hop 並產生新的 SpO2 估計
+        """
+        if not self._primed:
+            self._dc_ir.reset(ir)
+            self._dc_red.reset(red)
+            self._hp_ir.reset(0)
+            self._hp_red.reset(0)
+            self._primed = True
+            self._hop_start = t
+
+        new = False
+        if ticks_diff(t, self._hop_start) >= self.hop_ms:
+            new = self._close_hop(t)
+            self._hop_start = t
+
+        v = ir - self._dc_ir.step(ir)
+        v -= self._hp_ir.step(v)
+        if v > AC_CLAMP:
+            v = AC_CLAMP
+        elif v < -AC_CLAMP:
+            v = -AC_CLAMP
+        self._sx_ir += ir
+        self._s1_ir += v
+        self._s2_ir += v * v
+        if self._s2_ir >= SQ_CARRY:
+            self._s2h_ir += self._s2_ir >> SQ_LOW_BITS
+            self._s2_ir &= (1 << SQ_LOW_BITS) - 1
+
+        v = red - self._dc_red.step(red)
+        v -= self._hp_red.step(v)
+        if v > AC_CLAMP:
+            v = AC_CLAMP
+        elif v < -AC_CLAMP:
+            v = -AC_CLAMP
+        self._sx_red += red
+        self._s1_red += v
+        self._s2_red += v * v
+        if self._s2_red >= SQ_CARRY:
+            self._s2h_red += self._s2_red >> SQ_LOW_BITS
+            self._s2_red &= (1 << SQ_LOW_BITS) - 1
+
+        self._n += 1
+        return new
+
+    def _close_hop(self, t):
+        hop = [self._n,
+               self._sx_ir, self._s1_ir, (self._s2h_ir << SQ_LOW_BITS) + self._s2_ir,
+               self._sx_red, self._s1_red, (self._s2h_red << SQ_LOW_BITS) + self._s2_red]
+        self._clear_hop()
+        self._hops.append(hop)
+        if len(self._hops) > self.window_hops:
+            self._hops.pop(0)
+        if len(self._hops) < self.window_hops:
+            return False
+
+        self.windows += 1
+        r, pi = window_ratio(self._hops)
+        self.r = r
+        self.perfusion = pi
+        if r is None or not (self.pi_min <= pi <= self.pi_max):
+            self.rejected += 1
+            self.spo2 = None
+            return False
+        spo2 = lookup(self.table, r)
+        self.spo2 = 100.0 if spo2 > 100.0 else spo2
+        self.updated_at = t
+        return True
+
+
+# ==================== 測試代碼 ====================
+# Synthetic PPG with a known SpO2 course (the inverse of the table), 1%
+# perfusion, respiration wander and noise; runs on the host or the board.
+if __name__ == '__main__':
+    import math
+    import random
+
+    random.seed(18)
+
+    def inverse(table, spo2):
+        # R for a given SpO2 on the decreasing part of the table
+        best = None
+        for i in range(1, len(table)):
+            (r0, s0), (r1, s1) = table[i - 1], table[i]
+            if s1 < s0 and min(s0, s1) <= spo2 <= max(s0, s1):
+                best = r0 + (r1 - r0) * (spo2 - s0) / (s1 - s0)
+        return best
+
+    def truth(sec):
+        # 98 %, a desaturation to 85 % around 60 s, back to 97 %
+        if sec < 40:
+            return 98.0
+        if sec < 60:
+            return 98.0 - 13.0 * (sec - 40) / 20
+        if sec < 80:
+            return 85.0
+        return min(97.0, 85.0 + 12.0 * (sec - 80) / 20)
+
+    engine = SpO2Engine()
+    errors = []
+    for k in range(120 * 50):
+        t = k * 20
+        sec = t / 1000.0
+        r = inverse(DEFAULT_TABLE, truth(sec))
+        pulse = math.sin(2 * math.pi * 1.2 * sec) + 0.3 * math.sin(2 * math.pi * 2.4 * sec + 1)
+        resp = 1 + 0.01 * math.sin(2 * math.pi * 0.25 * sec)
+        ir = 120000 * resp * (1 + 0.01 * pulse) + random.gauss(0, 30)
+        red = 90000 * resp * (1 + 0.01 * r * pulse) + random.gauss(0, 30)
+        if engine.update(t, int(ir), int(red)):
+            # the window ends now and spans the last 4 s: compare with its middle
+            errors.append(engine.spo2 - truth(sec - 2.0))
+    worst = max(abs(e) for e in errors)
+    mean = sum(abs(e) for e in errors) / len(errors)
+    print("SpO2 windows: {} | mean |err| {:.2f} % | max |err| {:.2f} %".format(
+        len(errors), mean, worst))
+    assert len(errors) >= 110 and mean < 0.7 and worst < 1.5
+
+    # no pulse (perfusion below pi_min): no estimate
+    engine.restart()
+    for k in range(10 * 50):
+        engine.update(k * 20, 120000 + random.randint(-3, 3), 90000 + random.randint(-3, 3))
+    assert engine.spo2 is None and engine.rejected > 0
+    print("low perfusion rejected: OK")
@@ -0,0 +1,251 @@
+# spo2_replay.py - SpO2 引擎的 NumPy 重播與校正（僅在電腦上執行，不需上傳 ESP32）
+#
+# Vectorized twin of spo2_engine.SpO2Engine for recorded IR/RED traces. The
+# two high-pass stages reuse the fixed-point block kernel from dsp.py, the
+# per-hop sums are one np.add.reduceat per column, and only the hop list is
+# walked to form windows (with the engine's own window_ratio), so results
+# are identical to feeding the trace through SpO2Engine sample by sample.
+#
+# With a reference column (a clinical oximeter or a blood-gas SpO2 logged
+# next to the sensor), fit_table() measures the device's calibration table
+# for SpO2Engine(table=...) and arms() reports the accuracy root-mean-square
+# error used in oximeter specifications.
+#
+# Usage:
+#   python spo2_replay.py trace.csv
+# where trace.csv holds "t_ms,ir,red[,ref_spo2]" rows.
+
+from array import array
+
+import numpy as np
+
+from dsp import OnePole
+from spo2_engine import (SpO2Engine, DEFAULT_TABLE, AC_CLAMP,
+                         lookup, window_ratio)
+
+
+def _onepole(values, alpha, init):
+    # Runs the very same integer kernel as OnePole.step()
+    buf = array('i', values.tolist())
+    f = OnePole(alpha, init)
+    f.block(buf, len(buf))
+    return np.frombuffer(buf, dtype=np.int32).astype(np.int64)
+
+
+def _highpass(x, alpha):
+    # raw - DC tracker, minus a second OnePole of that (SpO2Engine.update)
+    v = x - _onepole(x, alpha, int(x[0]))
+    v = v - _onepole(v, alpha, 0)
+    return np.clip(v, -AC_CLAMP, AC_CLAMP)
+
+
+def load_trace(path):
+    """
+    讀取 PPG 紀錄檔
+
+    Returns:
+        (t_ms, ir, red, ref_spo2) arrays；沒有參考值欄位時 ref_spo2 為 None
+    """
+    data = np.loadtxt(path, delimiter=',', ndmin=2)
+    t_ms = data[:, 0].astype(np.int64)
+    ir = data[:, 1].astype(np.int64)
+    red = data[:, 2].astype(np.int64)
+    ref = data[:, 3] if data.shape[1] >= 4 else None
+    return t_ms, ir, red, ref
+
+
+def replay(t_ms, ir, red, hop_ms=1000, window_hops=4, dc_alpha=0.93,
+           table=DEFAULT_TABLE, pi_min=0.05, pi_max=20.0):
+    """
+    Replay a trace through the SpO2 pipeline.
+
+    Returns:
+        dict of arrays, one entry per window: 't' (time of the sample that
+        closed it), 'r', 'perfusion' and 'spo2' (NaN where rejected)
+    """
+    t_ms = np.asarray(t_ms, dtype=np.int64)
+    ir = np.asarray(ir, dtype=np.int64)
+    red = np.asarray(red, dtype=np.int64)
+
+    v_ir = _highpass(ir, dc_alpha)
+    v_red = _highpass(red, dc_alpha)
+
+    # hop boundaries: the first sample at least hop_ms after the hop start
+    starts = [0]
+    while True:
+        i = int(np.searchsorted(t_ms, t_ms[starts[-1]] + hop_ms, 'left'))
+        if i >= len(t_ms):
+            break
+        starts.append(i)
+    # the last hop is still open (as in the engine)
+    if len(starts) < 2:
+        return {k: np.array([]) for k in ('t', 'r', 'perfusion', 'spo2')}
+    idx = np.array(starts[:-1], dtype=np.int64)
+    end = starts[-1]
+
+    def sums(col):
+        return np.add.reduceat(col[:end], idx).tolist()
+
+    n = np.diff(np.array(starts, dtype=np.int64)).tolist()
+    hops = list(zip(n, sums(ir), sums(v_ir), sums(v_ir * v_ir),
+                    sums(red), sums(v_red), sums(v_red * v_red)))
+
+    out_t, out_r, out_pi, out_spo2 = [], [], [], []
+    for k in range(window_hops - 1, len(hops)):
+        r, pi = window_ratio(hops[k - window_hops + 1:k + 1])
+        out_t.append(int(t_ms[starts[k + 1]]))
+        out_r.append(np.nan if r is None else r)
+        out_pi.append(pi)
+        if r is None or not (pi_min <= pi <= pi_max):
+            out_spo2.append(np.nan)
+        else:
+            out_spo2.append(min(lookup(table, r), 100.0))
+
+    return {
+        't': np.array(out_t, dtype=np.int64),
+        'r': np.array(out_r, dtype=np.float64),
+        'perfusion': np.array(out_pi, dtype=np.float64),
+        'spo2': np.array(out_spo2, dtype=np.float64)
+    }
+
+
+def replay_engine(t_ms, ir, red, **params):
+    """Reference: push the trace through SpO2Engine one sample at a time."""
+    engine = SpO2Engine(**params)
+    out_t, out_r, out_pi, out_spo2 = [], [], [], []
+    windows = 0
+    for t, a, b in zip(np.asarray(t_ms).tolist(), np.asarray(ir).tolist(),
+                       np.asarray(red).tolist()):
+        engine.update(t, a, b)
+        if engine.windows != windows:
+            windows = engine.windows
+            out_t.append(t)
+            out_r.append(np.nan if engine.r is None else engine.r)
+            out_pi.append(engine.perfusion)
+            out_spo2.append(np.nan if engine.spo2 is None else engine.spo2)
+    return {
+        't': np.array(out_t, dtype=np.int64),
+        'r': np.array(out_r, dtype=np.float64),
+        'perfusion': np.array(out_pi, dtype=np.float64),
+        'spo2': np.array(out_spo2, dtype=np.float64)
+    }
+
+
+def window_reference(t_ms, ref, out_t, window_ms=4000):
+    """參考 SpO2 取每個視窗中點的值（對齊 replay() 的輸出）"""
+    return np.interp(np.asarray(out_t) - window_ms / 2.0, t_ms, ref)
+
+
+def fit_table(r, ref, knots):
+    """
+    以分段線性最小平方法擬合校正表
+
+    Args:
+        r: 每個視窗的 R
+        ref: 對應的參考 SpO2
+        knots: 表格的 R 節點（遞增；沒有資料落在其範圍內的節點會被略過）
+
+    Returns:
+        ((R, SpO2), ...) 可直接傳給 SpO2Engine(table=...)
+    """
+    r = np.asarray(r, dtype=np.float64)
+    ref = np.asarray(ref, dtype=np.float64)
+    ok = np.isfinite(r) & np.isfinite(ref)
+    r, ref = r[ok], ref[ok]
+    knots = np.asarray(knots, dtype=np.float64)
+
+    # hat basis: column j is the interpolation weight of knot j
+    basis = np.zeros((len(r), len(knots)))
+    for j in range(len(knots)):
+        unit = np.zeros(len(knots))
+        unit[j] = 1.0
+        basis[:, j] = np.interp(r, knots, unit)
+    # knots no window reached cannot be estimated: leave them out
+    used = basis.sum(axis=0) > 0
+    knots, basis = knots[used], basis[:, used]
+    values = np.linalg.lstsq(basis, ref, rcond=None)[0]
+    return tuple((round(float(k), 4), round(float(v), 2)) for k, v in zip(knots, values))
+
+
+def arms(estimate, ref):
+    """Accuracy root-mean-square（忽略被拒絕的視窗）"""
+    d = np.asarray(estimate, dtype=np.float64) - np.asarray(ref, dtype=np.float64)
+    d = d[np.isfinite(d)]
+    return float(np.sqrt(np.mean(d * d))) if len(d) else float('nan')
+
+
+def synthetic_trace(seconds=600, sample_ms=20, table=DEFAULT_TABLE, seed=0):
+    """
+    產生合成 PPG：SpO2 在 80-99 % 間緩慢變化，R 由 table 反推；
+    1 % 灌注、呼吸漂移與雜訊
+
+    Returns:
+        (t_ms, ir, red, ref_spo2)
+    """
+    rng = np.random.default_rng(seed)
+    t_ms = np.arange(0, seconds * 1000, sample_ms, dtype=np.int64)
+    t = t_ms / 1000.0
+    ref = 89.5 + 9.5 * np.sin(2 * np.pi * t / 240.0)
+
+    tr = np.array([p[0] for p in table])
+    ts = np.array([p[1] for p in table])
+    # invert the decreasing part of the table
+    top = int(np.argmax(ts))
+    r = np.interp(ref, ts[top:][::-1], tr[top:][::-1])
+
+    bpm = 72 + 8 * np.sin(2 * np.pi * t / 90.0)
+    phase = 2 * np.pi * np.cumsum(bpm / 60.0) * sample_ms / 1000.0
+    pulse = np.sin(phase) + 0.3 * np.sin(2 * phase + 1)
+    resp = 1 + 0.01 * np.sin(2 * np.pi * 0.25 * t)
+    ir = 120000 * resp * (1 + 0.01 * pulse) + rng.normal(0, 30, len(t))
+    red = 90000 * resp * (1 + 0.01 * r * pulse) + rng.normal(0, 30, len(t))
+    return t_ms, ir.astype(np.int64), red.astype(np.int64), ref
+
+
+# ==================== 測試代碼 ====================
+if __name__ == '__main__':
+    import sys
+    import time
+
+    if len(sys.argv) > 1:
+        t_ms, ir, red, ref = load_trace(sys.argv[1])
+        device_table = None
+    else:
+        # a device whose true curve sits 0.06 R to the right of the default
+        device_table = tuple((r + 0.06, s) for r, s in DEFAULT_TABLE)
+        t_ms, ir, red, ref = synthetic_trace(table=device_table)
+
+    duration_s = (t_ms[-1] - t_ms[0]) / 1000.0
+    print("=" * 50)
+    print("SpO2 replay: {} samples ({:.0f} s)".format(len(t_ms), duration_s))
+    print("=" * 50)
+
+    t0 = time.perf_counter()
+    fast = replay(t_ms, ir, red)
+    t1 = time.perf_counter()
+    slow = replay_engine(t_ms, ir, red)
+    t2 = time.perf_counter()
+
+    identical = all(np.array_equal(fast[k], slow[k], equal_nan=True)
+                    for k in ('t', 'r', 'perfusion', 'spo2'))
+    print("windows:", len(fast['t']), "| rejected:", int(np.isnan(fast['spo2']).sum()))
+    print("NumPy replay : {:.3f} s ({:.0f}x real time)".format(t1 - t0, duration_s / (t1 - t0)))
+    print("SpO2Engine   : {:.3f} s ({:.0f}x real time)".format(t2 - t1, duration_s / (t2 - t1)))
+    print("identical:", identical)
+    ok = identical
+
+    if ref is not None:
+        ref_w = window_reference(t_ms, ref, fast['t'])
+        knots = [p[0] for p in DEFAULT_TABLE]
+        if device_table is not None:
+            knots = [p[0] for p in device_table]
+        table = fit_table(fast['r'], ref_w, knots)
+        fitted = replay(t_ms, ir, red, table=table)
+        before = arms(fast['spo2'], ref_w)
+        after = arms(fitted['spo2'], ref_w)
+        print("ARMS default table: {:.2f} % | fitted table: {:.2f} %".format(before, after))
+        print("table =", table)
+        if device_table is not None:
+            ok = ok and after < 1.0 < before
+
+    sys.exit(0 if ok else 1)
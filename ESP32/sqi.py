@@ -0,0 +1,315 @@
+# sqi.py - 串流式 ECG 訊號品質指標（SQI）
+#
+# Tells a usable ECG window from noise, electrode lift or a railed ADC, so
+# HR from garbage is not uploaded. Per window of window_ms:
+#
+#   saturation  % of samples at the ADC rails (AD8232 leads off, clipping)
+#   wander      % of the signal variance in the < ~0.5 Hz baseline
+#               (motion, breathing, a lifting electrode)
+#   kurtosis    of the baseline-removed signal: clean ECG is peaky (> 5),
+#               noise and mains are close to Gaussian (3) or flatter
+#   agreement   (optional) F1 match of the main detector's beats against a
+#               second detector run on the same samples (bSQI); beats are matched
+#               within match_ms once they are hold_ms old, so a detector
+#               that decides late (Pan-Tompkins search-back) is not missed
+#
+# Every sample is stored in two preallocated window buffers (raw and
+# baseline-removed) and adds to a few first-order sums that stay small ints
+# for any window the buffers hold. Squares and fourth powers would not (a
+# 12-bit raw**2 summed over 500 samples, or d**4 for |d| > ~180, is past
+# 2**30 and every further += allocates a bigint), so the variances and the
+# kurtosis are computed once per window from the buffers, about the window
+# means. Beat matching walks the few beats of one window. Per sample: O(1),
+# no allocation; per window: one pass over window_n samples.
+
+from array import array
+
+from dsp import OnePole
+
+try:
+    from utime import ticks_diff
+except ImportError:
+    def ticks_diff(a, b):
+        return a - b
+
+# baseline filter runs on sample << FRAC_BITS
+FRAC_BITS = 8
+BEAT_RING = 32
+
+
+class SignalQuality(object):
+    def __init__(self, second=None, sample_ms=10, window_ms=5000,
+                 hold_ms=2000, match_ms=100, rail_lo=2, rail_hi=1021,
+                 baseline_alpha=0.97, max_saturation=5, max_wander=60,
+                 min_kurtosis=5.0, min_agreement=80):
+        """
+        Args:
+            second: 第二個心跳檢測器（reset/update/beat_ts 介面）；None = 不計算一致性
+            window_ms: 每個評估視窗長度
+            rail_lo, rail_hi: ADC 飽和判定（10-bit：0 / 1023 附近）
+            max_saturation, max_wander: 上限 (%)
+            min_kurtosis, min_agreement: 下限（agreement 為 %）
+        """
+        self.second = second
+        self.window_n = window_ms // sample_ms
+        self.hold_ms = hold_ms
+        self.match_ms = match_ms
+        self.rail_lo = rail_lo
+        self.rail_hi = rail_hi
+        self.max_saturation = max_saturation
+        self.max_wander = max_wander
+        self.min_kurtosis = min_kurtosis
+        self.min_agreement = min_agreement
+
+        self._base = OnePole(baseline_alpha)
+        self._raw = array('H', bytes(2 * self.window_n))
+        self._d = array('h', bytes(2 * self.window_n))
+        self._a = array('i', bytes(4 * BEAT_RING))
+        self._b = array('i', bytes(4 * BEAT_RING))
+        self.reset(0)
+
+    def reset(self, first_sample):
+        self._base.reset(int(first_sample) << FRAC_BITS)
+        if self.second is not None:
+            self.second.reset(first_sample)
+        self._na = 0
+        self._nb = 0
+        self._clear()
+
+        # last completed window
+        self.windows = 0
+        self.saturation = 0
+        self.wander = 0
+        self.kurtosis = 0.0
+        self.agreement = 100
+        self.ok = True
+        self.flags = ''
+        self.bad_windows = 0
+
+    def _clear(self):
+        self._n = 0
+        self._rail = 0
+        self._sx = 0
+        self._d1 = 0
+
+    # ---------- beats ----------
+
+    def add_beat(self, t):
+        """主檢測器的心跳時間（ticks_ms）"""
+        if self.second is not None:
+            self._na = self._push(self._a, self._na, t)
+
+    def _push(self, ring, n, t):
+        if n == BEAT_RING:
+            # nothing evaluated for a whole ring: drop the oldest
+            for i in range(1, n):
+                ring[i - 1] = ring[i]
+            n -= 1
+        ring[n] = t
+        return n + 1
+
+    def _take(self, ring, n, cutoff):
+        # beats older than cutoff -> how many (they sit at the front)
+        k = 0
+        while k < n and ticks_diff(ring[k], cutoff) < 0:
+            k += 1
+        return k
+
+    def _drop(self, ring, n, k):
+        for i in range(k, n):
+            ring[i - k] = ring[i]
+        return n - k
+
+    def _agreement(self, now):
+        cutoff = now - self.hold_ms
+        ka = self._take(self._a, self._na, cutoff)
+        kb = self._take(self._b, self._nb, cutoff)
+        matched = 0
+        i = j = 0
+        while i < ka and j < kb:
+            d = ticks_diff(self._a[i], self._b[j])
+            if -self.match_ms <= d <= self.match_ms:
+                matched += 1
+                i += 1
+                j += 1
+            elif d < 0:
+                i += 1
+            else:
+                j += 1
+        self._na = self._drop(self._a, self._na, ka)
+        self._nb = self._drop(self._b, self._nb, kb)
+        if ka + kb == 0:
+            return 0
+        return 200 * matched // (ka + kb)
+
+    # ---------- samples ----------
+
+    def update(self, raw, now):
+        """
+        每個樣本呼叫一次
+
+        Returns:
+            bool: 這個樣本是否結束一個評估視窗（結果在 saturation / wander /
+            kurtosis / agreement / ok / flags）
+        """
+        if self.second is not None and self.second.update(raw, now):
+            self._nb = self._push(self._b, self._nb, self.second.beat_ts)
+
+        x = raw << FRAC_BITS
+        b = self._base.step(x) >> FRAC_BITS
+        d = raw - b
+        if raw <= self.rail_lo or raw >= self.rail_hi:
+            self._rail += 1
+        i = self._n
+        self._raw[i] = raw
+        self._d[i] = d
+        self._sx += raw
+        self._d1 += d
+        self._n = i + 1
+        if self._n < self.window_n:
+            return False
+        self._evaluate(now)
+        self._clear()
+        return True
+
+    def _evaluate(self, now):
+        n = self._n
+        self.saturation = 100 * self._rail // n
+
+        # power sums about the (integer) window means keep the terms small;
+        # the exact central moments follow from them below
+        cx = self._sx // n
+        cd = self._d1 // n
+        cb = cx - cd
+        raws = self._raw
+        ds = self._d
+        ex1 = ex2 = eb1 = eb2 = e1 = e2 = e3 = e4 = 0
+        for i in range(n):
+            r = raws[i]
+            d = ds[i]
+            e = r - cx
+            ex1 += e
+            ex2 += e * e
+            e = r - d - cb
+            eb1 += e
+            eb2 += e * e
+            e = d - cd
+            e1 += e
+            ee = e * e
+            e2 += ee
+            e3 += ee * e
+            e4 += ee * ee
+
+        var_x = ex2 - ex1 * ex1 / n
+        var_b = eb2 - eb1 * eb1 / n
+        self.wander = int(100 * var_b / var_x) if var_x > 0 else 100
+        if self.wander > 100:
+            self.wander = 100
+
+        m = e1 / n
+        m2 = e2 / n - m * m
+        m4 = (e4 / n - 4 * m * e3 / n + 6 * m * m * e2 / n
+              - 3 * m * m * m * m)
+        self.kurtosis = round(m4 / (m2 * m2), 1) if m2 > 0 else 0.0
+
+        if self.second is not None:
+            self.agreement = self._agreement(now)
+
+        flags = []
+        if self.saturation > self.max_saturation:
+            flags.append('saturation')
+        if self.wander > self.max_wander:
+            flags.append('wander')
+        if self.kurtosis < self.min_kurtosis:
+            flags.append('kurtosis')
+        # the second detector is still learning during the first window
+        if self.second is not None and self.windows > 0 and self.agreement < self.min_agreement:
+            flags.append('agreement')
+        self.flags = ','.join(flags)
+        self.ok = not flags
+        self.windows += 1
+        if not self.ok:
+            self.bad_windows += 1
+
+    def note(self):
+        """最近一個視窗的品質摘要（放在 Observation 備註）"""
+        text = "SQI {}: sat {}% wander {}% kurt {}".format(
+            'ok' if self.ok else 'low (' + self.flags + ')',
+            self.saturation, self.wander, self.kurtosis)
+        if self.second is not None:
+            text += " agree {}%".format(self.agreement)
+        return text
+
+
+# ==================== 測試代碼 ====================
+# Synthetic 10-bit ECG (ecg_replay.synthetic_trace) clean and with the
+# failure modes the SQI has to catch; the local-peak detector is the main
+# one (offset / lockout raised for this trace), Pan-Tompkins the second.
+# With its default settings the local-peak detector also fires on noise
+# between beats here, which the agreement check reports.
+if __name__ == '__main__':
+    import numpy as np
+
+    from ecg_engine import LocalPeakDetector
+    from pan_tompkins import PanTompkinsDetector
+    from ecg_replay import synthetic_trace
+
+    def run(raw, t_ms, main=None, agreement=True):
+        if main is None:
+            main = LocalPeakDetector(nodc_offset=20, refractory_ms=350)
+        sqi = SignalQuality(second=PanTompkinsDetector() if agreement else None)
+        main.reset(int(raw[0]))
+        sqi.reset(int(raw[0]))
+        results = []
+        for x, t in zip(raw.tolist()[1:], t_ms.tolist()[1:]):
+            if main.update(x, t):
+                sqi.add_beat(main.beat_ts)
+            if sqi.update(x, t):
+                results.append((sqi.ok, sqi.note()))
+        return results
+
+    raw, t_ms = synthetic_trace(seconds=60, seed=3)
+    rng = np.random.default_rng(24)
+    t = t_ms / 1000.0
+    cases = {
+        'clean': raw,
+        'railed (leads off)': np.where(t % 20 < 12, 1023, raw),
+        'motion wander': np.clip(raw + 250 * np.sin(2 * np.pi * 0.3 * t), 0, 1023),
+        'noise (electrode lift)': np.clip(512 + rng.normal(0, 60, len(raw)), 0, 1023).astype(np.int64),
+        'mains 50 Hz': np.clip(raw + 120 * np.sin(2 * np.pi * 50 * t + 0.3), 0, 1023).astype(np.int64)
+    }
+    good = {}
+    for name, trace in cases.items():
+        res = run(np.asarray(trace, dtype=np.int64), t_ms)
+        good[name] = sum([1 for ok, _ in res if ok]) / len(res)
+        print("{:24s} ok {:3.0f}% | last: {}".format(name, 100 * good[name], res[-1][1]))
+    res = run(raw, t_ms, LocalPeakDetector())
+    over = sum([1 for ok, _ in res if ok]) / len(res)
+    print("{:24s} ok {:3.0f}% | last: {}".format('clean, default detector', 100 * over, res[-1][1]))
+    assert good['clean'] >= 0.9 and over < 0.6
+    assert all(good[k] <= 0.5 for k in cases if k != 'clean')
+
+    # main.py defaults (default detector, SQI_AGREEMENT = False): every
+    # clean window is ok, and the failure modes are still caught
+    for seed in (3, 7, 11):
+        clean, _ = synthetic_trace(seconds=60, seed=seed)
+        res = run(clean, t_ms, LocalPeakDetector(), agreement=False)
+        assert all(ok for ok, _ in res), (seed, [n for ok, n in res if not ok])
+    for name, trace in cases.items():
+        if name != 'clean':
+            res = run(np.asarray(trace, dtype=np.int64), t_ms, LocalPeakDetector(), agreement=False)
+            assert sum([1 for ok, _ in res if ok]) / len(res) <= 0.5, name
+    print("main.py defaults (no agreement): clean windows all ok | last:", res[-1][1])
+
+    # full-scale 12-bit square wave: the per-sample accumulators stay small
+    # ints (no bigint allocation on the sample path) for the whole window
+    full = SignalQuality(rail_lo=-1, rail_hi=4096)
+    full.reset(0)
+    peak = 0
+    for k in range(3 * full.window_n):
+        full.update(4095 if (k // 7) % 2 else 0, 10 * k)
+        for v in (full._n, full._rail, full._sx, full._d1):
+            peak = max(peak, abs(v))
+    print("full-scale window: largest accumulator {} (< 2**30) | kurtosis {}".format(peak, full.kurtosis))
+    assert peak < 1 << 30 and full.windows == 3
+    print("sqi: OK")
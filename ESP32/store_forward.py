@@ -0,0 +1,416 @@
+# store_forward.py - 離線暫存（快閃記憶體 append-only log）與補傳
+#
+# Observations that cannot be uploaded are appended to a segmented log on
+# the device filesystem, one compact JSON line per record:
+#
+#   [key, kind, kwargs]      e.g. ["a1b2-3-17", "hr", {"patient_id": ...}]
+#
+# kind selects the FHIRClient builder ('hr' -> build_heart_rate_observation
+# ...), kwargs are its arguments, so a record is the measurement, not the
+# full Observation JSON. key ("<device>-<segment>-<line>") is the
+# idempotency key: replayed resources carry it as Observation.identifier and
+# are posted in a transaction Bundle with ifNoneExist, so resending a batch
+# whose response was lost never creates duplicates.
+#
+# Flash wear: records are buffered in RAM and appended flush_every at a
+# time; segments are only ever appended to and deleted whole, never
+# rewritten. The small state file (next segment number + replay cursor) is
+# written once per rotation and once per acknowledged batch. Total size is
+# bounded by segment_bytes * max_segments; when full the oldest segment is
+# dropped.
+
+try:
+    import uos as os
+except ImportError:
+    import os
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from array import array
+
+ID_SYSTEM = "urn:esp32-ecg:observation"
+
+BUILDERS = {
+    'hr': 'build_heart_rate_observation',
+    'vs': 'build_vital_sign_observation',
+    'wf': 'build_waveform_observation',
+    'ptt': 'build_ptt_observation',
+    'hrv': 'build_hrv_observation',
+    'rr': 'build_rr_observation',
+}
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+class StoreForward(object):
+    def __init__(self, root='sf', device_id='esp32', segment_bytes=8192,
+                 max_segments=16, flush_every=8):
+        self.root = root
+        self.device_id = device_id
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.flush_every = flush_every
+
+        self._pending = []
+
+        self.stored = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.torn = 0
+
+        # _rotate() below may already drop segments and count them off
+        self.backlog = 0
+        self._torn_tail = False
+
+        if not _exists(root):
+            os.mkdir(root)
+        self._load_state()
+
+        # open (or continue) the newest segment
+        segs = self._segments()
+        if segs and segs[-1] == self._next - 1:
+            self._seg = segs[-1]
+            self._seg_bytes, self._seg_lines = self._measure(self._seg)
+            self._torn_tail = not self._terminated(self._seg)
+        else:
+            self._rotate()
+
+        self.backlog = self._count_backlog()
+
+    # ---------- state ----------
+
+    def _path(self, seg):
+        return "{}/{:06d}.log".format(self.root, seg)
+
+    def _load_state(self):
+        self._next = 0
+        self._cur_seg = 0
+        self._cur_line = 0
+        try:
+            with open(self.root + '/state', 'r') as f:
+                self._next, self._cur_seg, self._cur_line = json.loads(f.read())
+        except (OSError, ValueError):
+            segs = self._segments()
+            if segs:
+                self._next = segs[-1] + 1
+                self._cur_seg = segs[0]
+
+    def _save_state(self):
+        with open(self.root + '/state', 'w') as f:
+            f.write(json.dumps([self._next, self._cur_seg, self._cur_line]))
+
+    def _segments(self):
+        segs = []
+        for name in os.listdir(self.root):
+            if name.endswith('.log'):
+                segs.append(int(name[:-4]))
+        segs.sort()
+        return segs
+
+    def _measure(self, seg):
+        size = 0
+        lines = 0
+        with open(self._path(seg), 'r') as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                size += len(line)
+                lines += 1
+        return size, lines
+
+    def _terminated(self, seg):
+        # False when the last line was cut off (power loss mid-append)
+        last = ''
+        with open(self._path(seg), 'r') as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                last = line
+        return not last or last.endswith('\n')
+
+    def _count_backlog(self):
+        n = 0
+        for seg in self._segments():
+            if seg < self._cur_seg:
+                continue
+            lines = self._measure(seg)[1]
+            if seg == self._cur_seg:
+                lines -= self._cur_line
+            n += max(lines, 0)
+        return n + len(self._pending)
+
+    def _rotate(self):
+        self._seg = self._next
+        self._next += 1
+        self._seg_bytes = 0
+        self._seg_lines = 0
+        with open(self._path(self._seg), 'w'):
+            pass
+
+        # bounded size: drop the oldest segments
+        segs = self._segments()
+        while len(segs) > self.max_segments:
+            old = segs.pop(0)
+            lost = self._measure(old)[1]
+            if old == self._cur_seg:
+                lost -= self._cur_line
+            if old >= self._cur_seg:
+                self.dropped += lost
+                self.backlog -= lost
+                self._cur_seg = segs[0]
+                self._cur_line = 0
+            os.remove(self._path(old))
+        self._save_state()
+
+    # ---------- write side ----------
+
+    def append(self, kind, kwargs):
+        """
+        暫存一筆 observation
+
+        Args:
+            kind: 'hr' / 'vs' / 'wf' / 'ptt' / 'hrv' / 'rr'（見 BUILDERS）
+            kwargs: 對應 build_*_observation() 的參數
+
+        Returns:
+            str: 冪等鍵
+        """
+        if self._seg_bytes >= self.segment_bytes:
+            self.flush()
+            self._rotate()
+
+        key = "{}-{}-{}".format(self.device_id, self._seg, self._seg_lines)
+        for k in kwargs:
+            if isinstance(kwargs[k], array):
+                kwargs[k] = list(kwargs[k])
+        line = json.dumps([key, kind, kwargs]) + '\n'
+        self._pending.append(line)
+        self._seg_bytes += len(line)
+        self._seg_lines += 1
+
+        self.stored += 1
+        self.backlog += 1
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+        return key
+
+    def flush(self):
+        # One append per batch of records
+        if not self._pending:
+            return
+        with open(self._path(self._seg), 'a') as f:
+            if self._torn_tail:
+                # end the torn line first, or the next record would be
+                # glued onto it and skipped with it
+                f.write('\n')
+                self._seg_bytes += 1
+                self._torn_tail = False
+            for line in self._pending:
+                f.write(line)
+        self._pending = []
+
+    # ---------- replay side ----------
+
+    def next_batch(self, max_records=10, max_bytes=6000):
+        """
+        從 cursor 讀出下一批紀錄（不移動 cursor）
+
+        Returns:
+            (records, end) ; records 為 [key, kind, kwargs] 列表，
+            end 傳給 ack() 表示這批已被伺服器接受（含略過的損壞行數）
+        """
+        self.flush()
+        records = []
+        size = 0
+        torn = 0
+        seg = self._cur_seg
+        line_no = self._cur_line
+        for s in self._segments():
+            if s < seg:
+                continue
+            if s > seg:
+                seg = s
+                line_no = 0
+            with open(self._path(s), 'r') as f:
+                for _ in range(line_no):
+                    f.readline()
+                while len(records) < max_records:
+                    line = f.readline()
+                    if not line:
+                        break
+                    if records and size + len(line) > max_bytes:
+                        return records, (seg, line_no, torn)
+                    line_no += 1
+                    size += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # torn write at power loss: skip the line (it is
+                        # still counted in backlog, so ack() removes it)
+                        torn += 1
+            if len(records) >= max_records:
+                break
+        return records, (seg, line_no, torn)
+
+    def ack(self, end, n):
+        seg, line_no, torn = end
+        for s in self._segments():
+            if s < seg and s != self._seg:
+                os.remove(self._path(s))
+        self._cur_seg = seg
+        self._cur_line = line_no
+        self._save_state()
+        self.replayed += n
+        self.torn += torn
+        self.backlog = max(self.backlog - n - torn, 0)
+
+    def replay_once(self, client, max_records=10, max_bytes=6000):
+        """
+        以一個 transaction Bundle 補傳一批暫存紀錄
+
+        Returns:
+            (success, 補傳筆數 or error_message)
+        """
+        records, end = self.next_batch(max_records, max_bytes)
+        if not records:
+            if end[:2] != (self._cur_seg, self._cur_line):
+                self.ack(end, 0)
+            return True, 0
+
+        resources = []
+        for key, kind, kwargs in records:
+            build = getattr(client, BUILDERS[kind])
+            resources.append(client.with_identifier(build(**kwargs), ID_SYSTEM, key))
+
+        success, res = client.post_transaction(resources)
+        if not success:
+            return False, res
+        self.ack(end, len(records))
+        return True, len(records)
+
+
+# ==================== 測試代碼 ====================
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    from fhir_client_enhanced import FHIRClient
+
+    class FakeServer(FHIRClient):
+        # conditional create by identifier, like the real server
+        def __init__(self):
+            FHIRClient.__init__(self, "http://test/fhir")
+            self.created = {}
+            self.fail_next = 0
+
+        def post_transaction(self, resources):
+            if self.fail_next:
+                self.fail_next -= 1
+                return False, "offline"
+            for r in resources:
+                ident = r["identifier"][0]["value"]
+                self.created.setdefault(ident, r)
+            return True, []
+
+    root = tempfile.mkdtemp()
+    try:
+        store = StoreForward(root + '/sf', device_id='dev', segment_bytes=600,
+                             max_segments=3, flush_every=3)
+        for i in range(20):
+            store.append('hr', {'patient_id': 'p1', 'heart_rate': 60 + i,
+                                'measurement_time': '2026-01-01T00:00:%02d' % i})
+        store.flush()
+        print("segments:", len(store._segments()), "| backlog:", store.backlog,
+              "| dropped:", store.dropped)
+        assert store.backlog + store.dropped == 20
+        kept = store.backlog
+
+        server = FakeServer()
+        server.fail_next = 1
+        assert not store.replay_once(server, max_records=4)[0]
+        # a lost response: the batch reaches the server but is not acked
+        records, end = store.next_batch(4)
+        server.post_transaction([server.with_identifier(
+            server.build_heart_rate_observation(**kw), ID_SYSTEM, key) for key, kind, kw in records])
+
+        # reopen from flash, as after a reboot
+        store = StoreForward(root + '/sf', device_id='dev', segment_bytes=600,
+                             max_segments=3, flush_every=3)
+        assert store.backlog == kept
+        while store.backlog:
+            ok, n = store.replay_once(server, max_records=4, max_bytes=400)
+            assert ok
+        hrs = sorted(r["valueQuantity"]["value"] for r in server.created.values())
+        print("replayed:", store.replayed, "| unique on server:", len(server.created))
+        assert len(server.created) == kept
+        assert hrs == list(range(80 - kept, 80))
+
+        # new records after a full replay keep unique keys
+        store.append('hr', {'patient_id': 'p1', 'heart_rate': 99})
+        store.replay_once(server)
+        assert len(server.created) == kept + 1
+
+        # torn lines (power loss mid-write) are skipped and leave the
+        # backlog, so the drain loop still ends
+        for i in range(3):
+            store.append('hr', {'patient_id': 'p1', 'heart_rate': 100 + i})
+        store.flush()
+        with open(store._path(store._seg), 'a') as f:
+            f.write('["dev-x-1", "hr", {"patient_\n')
+            f.write('["dev-x-2", "hr\n')
+        store.append('hr', {'patient_id': 'p1', 'heart_rate': 103})
+        store.flush()
+        store = StoreForward(root + '/sf', device_id='dev', segment_bytes=600,
+                             max_segments=3, flush_every=3)
+        assert store.backlog == 6
+        rounds = 0
+        while store.backlog:
+            assert store.replay_once(server, max_records=2)[0]
+            rounds += 1
+            assert rounds < 10, "backlog never drains"
+        assert store.torn == 2 and len(server.created) == kept + 5
+
+        # unterminated torn tail: the next records still go on lines of
+        # their own and none of them is lost
+        with open(store._path(store._seg), 'a') as f:
+            f.write('["dev-x-3", "hr", {"heart_ra')
+        store = StoreForward(root + '/sf', device_id='dev', segment_bytes=600,
+                             max_segments=3, flush_every=3)
+        for i in range(3):
+            store.append('hr', {'patient_id': 'p1', 'heart_rate': 110 + i})
+        store.flush()
+        store = StoreForward(root + '/sf', device_id='dev', segment_bytes=600,
+                             max_segments=3, flush_every=3)
+        while store.backlog:
+            assert store.replay_once(server, max_records=2)[0]
+        hrs = [r["valueQuantity"]["value"] for r in server.created.values()]
+        assert store.torn == 1 and all(v in hrs for v in (110, 111, 112))
+        print("torn tail skipped:", store.torn, "| records after it kept")
+
+        # crash between creating a segment and saving the state, with the
+        # log already full: it must still open
+        for i in range(40):
+            store.append('hr', {'patient_id': 'p1', 'heart_rate': 60})
+        store.flush()
+        assert len(store._segments()) == 3
+        # _rotate() got as far as creating the next segment file
+        open(store._path(store._next), 'w').close()
+        with open(root + '/sf/state', 'w') as f:
+            f.write(json.dumps([store._next, store._cur_seg, store._cur_line]))
+        store = StoreForward(root + '/sf', device_id='dev', segment_bytes=600,
+                             max_segments=3, flush_every=3)
+        assert len(store._segments()) <= 3 and store.backlog > 0
+        print("store_forward: OK")
+    finally:
+        shutil.rmtree(root)
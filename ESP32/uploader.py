@@ -0,0 +1,224 @@
+# uploader.py - FHIR 上傳佇列（uasyncio producer/consumer）
+#
+# The DSP task only ever calls UploadQueue.put(), which never blocks: when
+# the queue is full the oldest pending upload is dropped, and a new item
+# whose key is already pending replaces that item's payload (coalesce), so
+# e.g. only the latest heart rate waits for the network.
+#
+# Uploader.run() is the consumer task. urequests is blocking, so while a
+# POST is in flight the event loop is stalled - sampling is unaffected
+# because it runs from the hardware timer (adc_sampler.py) and the DSP task
+# catches up from the ring buffer afterwards.
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+class UploadQueue(object):
+    def __init__(self, maxlen=8):
+        self.maxlen = maxlen
+        self._items = []
+        self._event = asyncio.Event()
+
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, key, func, *args):
+        # Same key still waiting -> keep its place, take the newer payload
+        if key is not None:
+            for i in range(len(self._items)):
+                if self._items[i][0] == key:
+                    self._items[i] = (key, func, args)
+                    self.coalesced += 1
+                    return
+
+        if len(self._items) >= self.maxlen:
+            self._items.pop(0)
+            self.dropped += 1
+
+        self._items.append((key, func, args))
+        self._event.set()
+
+    def pending(self, key):
+        # args of the upload still waiting under key, or None
+        for k, _func, args in self._items:
+            if key is not None and k == key:
+                return args
+        return None
+
+    async def get(self):
+        while not self._items:
+            self._event.clear()
+            await self._event.wait()
+        return self._items.pop(0)
+
+
+class Uploader(object):
+    def __init__(self, queue):
+        self.queue = queue
+        self.busy = False
+
+        self.sent = 0
+        self.failed = 0
+
+    def idle(self):
+        return not self.busy and len(self.queue) == 0
+
+    async def run(self):
+        while True:
+            key, func, args = await self.queue.get()
+            self.busy = True
+            try:
+                success, res = func(*args)
+            except Exception as e:
+                success, res = False, str(e)
+            self.busy = False
+
+            if success:
+                self.sent += 1
+            else:
+                self.failed += 1
+                print("[FHIR] ✗", key, "upload failed:", res)
+
+            # Give the DSP task a turn before the next request
+            await asyncio.sleep(0)
+
+
+# ==================== 測試代碼 ====================
+# Host-side harness: a thread plays the hardware timer, a fake FHIR client
+# blocks for LATENCY_S per request like urequests does. Every timer tick
+# must still reach the engine with its original timestamp.
+if __name__ == '__main__':
+    import threading
+    import time
+    from array import array
+
+    from adc_sampler import ADCSampler
+    from ecg_engine import ECGEngine
+    from ecg_replay import synthetic_trace, replay
+
+    LATENCY_S = 0.8
+    SECONDS = 10
+    SAMPLE_MS = 10
+
+    trace, t_trace = synthetic_trace(seconds=SECONDS, sample_ms=SAMPLE_MS)
+    trace = trace.tolist()
+
+    class ThreadTimer(object):
+        def init(self, period, mode, callback):
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._loop, args=(period, callback))
+            self._thread.start()
+
+        def _loop(self, period, callback):
+            next_t = time.monotonic()
+            for _ in range(len(trace) - 1):
+                next_t += period / 1000.0
+                time.sleep(max(0.0, next_t - time.monotonic()))
+                if self._stop.is_set():
+                    return
+                callback(self)
+
+        def deinit(self):
+            self._stop.set()
+            self._thread.join()
+
+    class SlowFHIRClient(object):
+        def __init__(self):
+            self.uploaded = []
+
+        def create_heart_rate_observation(self, patient_id, heart_rate):
+            time.sleep(LATENCY_S)  # blocking, like urequests
+            self.uploaded.append(heart_rate)
+            return True, str(len(self.uploaded))
+
+    idx = [0]
+
+    def read_trace():
+        idx[0] += 1
+        return trace[idx[0]]
+
+    client = SlowFHIRClient()
+    queue = UploadQueue(maxlen=4)
+    uploader = Uploader(queue)
+    engine = ECGEngine()
+    sampler = ADCSampler(read_trace, capacity=512, period_ms=SAMPLE_MS, timer=ThreadTimer())
+    buf = array('H', bytes(2 * 64))
+    beats = []
+
+    async def dsp_task():
+        engine.start(0, trace[0])
+        sampler.start(0)
+        next_report = 0
+        while sampler.seq < len(trace) - 1:
+            n = sampler.drain(buf)
+            for i in range(n):
+                t = sampler.seq_to_ms(sampler.batch_seq + i)
+                if engine.update(buf[i], t):
+                    beats.append(engine.detector.beat_ts)
+            if sampler.seq * SAMPLE_MS >= next_report:
+                next_report += 500  # report faster than uploads can finish
+                if engine.heart_rate > 0:
+                    queue.put('hr', client.create_heart_rate_observation, 'p1', engine.heart_rate)
+            await asyncio.sleep(0.02)
+        sampler.stop()
+
+    async def main():
+        task = asyncio.create_task(uploader.run())
+        await dsp_task()
+        while not uploader.idle():
+            await asyncio.sleep(0.05)
+        task.cancel()
+
+    # Queue policy on its own (in the harness below the producer cannot run
+    # while an upload blocks, so nothing ever coalesces or is dropped there)
+    q = UploadQueue(maxlen=3)
+    sent = []
+
+    def send(kind, value):
+        sent.append((kind, value))
+        return True, None
+
+    async def drain_queue():
+        while len(q):
+            _key, func, args = await q.get()
+            func(*args)
+
+    # same key: one entry, latest payload, original place in the queue
+    q.put('hr', send, 'hr', 70)
+    q.put('vs', send, 'vs', 98)
+    q.put('hr', send, 'hr', 71)
+    q.put('hr', send, 'hr', 72)
+    assert len(q) == 2 and q.coalesced == 2 and q.dropped == 0
+    asyncio.run(drain_queue())
+    assert sent == [('hr', 72), ('vs', 98)], sent
+
+    # more distinct entries than maxlen: the oldest go, key None never merges
+    del sent[:]
+    for i in range(3):
+        q.put(None, send, 'wf', i)
+    q.put('hr', send, 'hr', 80)
+    q.put(None, send, 'wf', 3)
+    assert len(q) == 3 and q.dropped == 2 and q.coalesced == 2
+    q.put('hr', send, 'hr', 81)
+    assert q.coalesced == 3 and q.dropped == 2
+    asyncio.run(drain_queue())
+    assert sent == [('wf', 2), ('hr', 81), ('wf', 3)], sent
+    print("UploadQueue: coalesce {} | drop-oldest {} | sent {}".format(q.coalesced, q.dropped, sent))
+
+    print("=" * 50)
+    print("Uploader harness: {} s trace, {} s per upload".format(SECONDS, LATENCY_S))
+    print("=" * 50)
+    asyncio.run(main())
+
+    expected = replay(trace, t_trace)['beat_ts'].tolist()
+    print("timer overruns:", sampler.overruns, "| max backlog:", sampler.max_backlog)
+    print("uploads sent:", uploader.sent, "| coalesced:", queue.coalesced, "| dropped:", queue.dropped)
+    print("beats match offline replay:", beats == expected)
+    assert sampler.overruns == 0
+    assert beats == expected
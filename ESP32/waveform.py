@@ -0,0 +1,113 @@
+# waveform.py - ECG 波形切塊（上傳為 FHIR valueSampledData）
+#
+# WaveformChunker collects the sample stream into fixed-length chunks for
+# FHIRClient.create_waveform_observation(). add() writes into a
+# preallocated array('h'); only when a chunk is complete is it handed off
+# and a fresh buffer allocated, so the upload queue can hold on to it while
+# sampling continues.
+#
+# filtered=True stores a DC-removed, 25 Hz low-passed trace (dsp.py,
+# fixed-point) instead of the raw ADC values.
+
+from array import array
+
+from dsp import OnePole, lowpass_biquad
+
+# filters run on sample << FILTER_FRAC_BITS
+FILTER_FRAC_BITS = 3
+
+
+class WaveformChunker(object):
+    def __init__(self, chunk_len=500, sample_ms=10, filtered=False,
+                 dc_alpha=0.995, lowpass_hz=25):
+        self.chunk_len = chunk_len
+        self.sample_ms = sample_ms
+        self.filtered = filtered
+
+        self._buf = array('h', bytes(2 * chunk_len))
+        self._n = 0
+        self.t0_ms = 0
+
+        if filtered:
+            self._dc = OnePole(dc_alpha)
+            self._lp = lowpass_biquad(lowpass_hz, 1000 / sample_ms)
+
+        self.chunks = 0
+
+    def reset(self, first_sample):
+        self._n = 0
+        if self.filtered:
+            self._dc.reset(first_sample << FILTER_FRAC_BITS)
+            self._lp.reset(0)
+
+    def add(self, raw, t_ms):
+        # Returns (samples, t0_ms) when this sample completes a chunk
+        if self.filtered:
+            x = raw << FILTER_FRAC_BITS
+            x = self._lp.step(x - self._dc.step(x))
+            raw = x >> FILTER_FRAC_BITS
+
+        if self._n == 0:
+            self.t0_ms = t_ms
+        self._buf[self._n] = raw
+        self._n += 1
+        if self._n < self.chunk_len:
+            return None
+        return self._take()
+
+    def flush(self, min_len=1):
+        # Hand off a partial chunk at the end of a session
+        if self._n < min_len:
+            return None
+        return self._take()
+
+    def _take(self):
+        if self._n == self.chunk_len:
+            samples = self._buf
+            self._buf = array('h', bytes(2 * self.chunk_len))
+        else:
+            samples = self._buf[:self._n]
+        self._n = 0
+        self.chunks += 1
+        return samples, self.t0_ms
+
+    def origin(self, samples):
+        # Baseline subtracted before encoding: keeps the data string short
+        if self.filtered:
+            return 0
+        return samples[0]
+
+
+# ==================== 測試代碼 ====================
+if __name__ == '__main__':
+    from fhir_client_enhanced import FHIRClient
+
+    chunker = WaveformChunker(chunk_len=250)
+    chunker.reset(512)
+    out = []
+    for i in range(1100):
+        res = chunker.add(512 + (i % 50), i * 10)
+        if res:
+            out.append(res)
+    tail = chunker.flush()
+    assert [len(s) for s, _ in out] == [250] * 4 and len(tail[0]) == 100
+    assert [t for _, t in out] == [0, 2500, 5000, 7500]
+
+    # encode -> decode round trip through valueSampledData
+    samples, t0 = out[1]
+    origin = chunker.origin(samples)
+    factor = 0.5
+    sd = {
+        "origin": {"value": origin * factor},
+        "factor": factor,
+        "data": FHIRClient.encode_sampled_data(samples, origin)
+    }
+    assert FHIRClient.decode_sampled_data(sd) == [v * factor for v in samples]
+    print("data bytes per sample: {:.2f}".format(len(sd["data"]) / len(samples)))
+
+    f = WaveformChunker(chunk_len=500, filtered=True)
+    f.reset(512)
+    for i in range(500):
+        res = f.add(512, i * 10)
+    assert max(abs(v) for v in res[0]) == 0
+    print("waveform: OK")
@@ -0,0 +1,139 @@
+# wifi_link.py - 背景 WiFi 連線（快取 BSSID / channel / 靜態 IP）
+#
+# WiFiLink.connect() is a coroutine, so measurement starts right away and
+# association happens next to it instead of blocking boot.
+#
+# Fast path: the BSSID, channel and IP config from the last successful
+# connection are kept in a small JSON file. With those, the station skips
+# the all-channel scan and the DHCP exchange and usually associates in a
+# few hundred ms. If that fails within fast_timeout_ms (AP moved, lease
+# taken, router replaced) it falls back to a scan for the strongest AP with
+# our SSID plus DHCP, and refreshes the cache on success.
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+
+try:
+    from utime import ticks_ms, ticks_diff
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+class WiFiLink(object):
+    def __init__(self, sta, ssid, password, cache_path='wifi_cache.json',
+                 static_ip=True, fast_timeout_ms=3000, timeout_ms=30000):
+        self.sta = sta
+        self.ssid = ssid
+        self.password = password
+        self.cache_path = cache_path
+        self.static_ip = static_ip
+        self.fast_timeout_ms = fast_timeout_ms
+        self.timeout_ms = timeout_ms
+
+        self.fast = False
+        self.connect_ms = -1
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.loads(f.read())
+            if cache.get('ssid') == self.ssid:
+                return cache
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _save_cache(self, bssid, channel):
+        cache = {
+            'ssid': self.ssid,
+            'bssid': binascii.hexlify(bssid).decode(),
+            'channel': channel,
+            'ifconfig': list(self.sta.ifconfig())
+        }
+        try:
+            with open(self.cache_path, 'w') as f:
+                f.write(json.dumps(cache))
+        except OSError as e:
+            print("[WiFi] cache not saved:", e)
+
+    def _scan(self):
+        # (ssid, bssid, channel, RSSI, security, hidden); strongest wins
+        best = None
+        try:
+            for ap in self.sta.scan():
+                if ap[0].decode() == self.ssid and (best is None or ap[3] > best[3]):
+                    best = ap
+        except OSError:
+            pass
+        return best
+
+    async def _wait(self, start, timeout_ms):
+        while not self.sta.isconnected():
+            if ticks_diff(ticks_ms(), start) >= timeout_ms:
+                return False
+            await asyncio.sleep_ms(50)
+        self.connect_ms = ticks_diff(ticks_ms(), start)
+        return True
+
+    async def connect(self):
+        """
+        連線 WiFi（快取優先，失敗再掃描 + DHCP）
+
+        Returns:
+            bool: 是否連上
+        """
+        start = ticks_ms()
+        if self.sta.isconnected():
+            self.connect_ms = 0
+            return True
+
+        cache = self._load_cache()
+        if cache:
+            if self.static_ip and cache.get('ifconfig'):
+                self.sta.ifconfig(tuple(cache['ifconfig']))
+            try:
+                self.sta.config(channel=cache['channel'])
+            except (OSError, ValueError, TypeError):
+                pass
+            self.sta.connect(self.ssid, self.password,
+                             bssid=binascii.unhexlify(cache['bssid']))
+            if await self._wait(start, self.fast_timeout_ms):
+                self.fast = True
+                return True
+
+            print("[WiFi] cached AP failed, scanning")
+            self.sta.disconnect()
+            try:
+                self.sta.ifconfig('dhcp')
+            except (OSError, ValueError, TypeError):
+                pass
+
+        ap = self._scan()
+        if ap is not None:
+            self.sta.connect(self.ssid, self.password, bssid=ap[1])
+        else:
+            self.sta.connect(self.ssid, self.password)
+
+        if not await self._wait(start, self.timeout_ms):
+            return False
+        if ap is not None:
+            self._save_cache(ap[1], ap[2])
+        return True
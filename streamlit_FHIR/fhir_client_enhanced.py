@@ -16,18 +16,26 @@ except ImportError:
 class FHIRClient:
     """完整的 FHIR API 客戶端，支援創建、讀取、搜索功能"""
 
-    def __init__(self, fhir_base_url="http://localhost:8080/fhir"):
+    def __init__(self, fhir_base_url="http://localhost:8080/fhir", keep_alive=False,
+                 templates=False):
         """
         初始化 FHIR 客戶端
         
         Args:
             fhir_base_url: FHIR 服務器的基礎 URL
+            keep_alive: 使用 http_keepalive 保持連線（ESP32 建議開啟）
+            templates: 心率 / 生理數據使用預先序列化的 JSON 範本（obs_template）
         """
         self.base_url = fhir_base_url.rstrip('/')
         self.headers = {
             'Content-Type': 'application/fhir+json',
             'Accept': 'application/fhir+json'
         }
+        self._http = None
+        if keep_alive:
+            from http_keepalive import KeepAliveHTTP
+            self._http = KeepAliveHTTP(self.base_url)
+        self._templates = {} if templates else None
     
     # ==================== 工具函數 ====================
     
@@ -41,6 +49,32 @@ class FHIRClient:
         else:
             return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
     
+    def _encode(self, data):
+        """請求體編碼：已序列化的 str / bytes（例如範本輸出）直接送出"""
+        if not data:
+            return None
+        if isinstance(data, (str, bytes)):
+            return data
+        return json.dumps(data)
+    
+    def _render_template(self, key, build, variables, values, **fixed):
+        """
+        以快取的 ObservationTemplate 產生 JSON bytes
+        
+        Args:
+            key: 範本快取鍵（資源種類 + 固定參數）
+            build: build_*_observation 方法
+            variables: 變動參數名稱
+            values: 變動參數的值
+            fixed: 固定參數
+        """
+        template = self._templates.get(key)
+        if template is None:
+            from obs_template import ObservationTemplate
+            template = ObservationTemplate(build, variables, **fixed)
+            self._templates[key] = template
+        return template.render(*values)
+    
     def _make_request(self, method, url, data=None, params=None):
         """
         統一的 HTTP 請求處理
@@ -60,13 +94,16 @@ class FHIRClient:
                 param_str = '&'.join([f"{k}={v}" for k, v in params.items()])
                 url = f"{url}?{param_str}"
             
+            if self._http is not None:
+                return self._keepalive_request(method.upper(), url, data)
+            
             if method.upper() == 'GET':
                 response = requests.get(url, headers=self.headers)
             elif method.upper() == 'POST':
-                json_data = json.dumps(data) if data else None
+                json_data = self._encode(data)
                 response = requests.post(url, data=json_data, headers=self.headers)
             elif method.upper() == 'PUT':
-                json_data = json.dumps(data) if data else None
+                json_data = self._encode(data)
                 response = requests.put(url, data=json_data, headers=self.headers)
             elif method.upper() == 'DELETE':
                 response = requests.delete(url, headers=self.headers)
@@ -118,6 +155,53 @@ class FHIRClient:
             
             return False, str(e)
     
+    @staticmethod
+    def _location_id(location):
+        """從 Location 標頭取出資源 ID（.../Observation/<id>/_history/<v>）"""
+        if not location:
+            return None
+        parts = [p for p in location.split('/') if p]
+        if '_history' in parts:
+            i = parts.index('_history')
+            return parts[i - 1] if i > 0 else None
+        return parts[-1] if parts else None
+    
+    def _keepalive_request(self, method, url, data):
+        """
+        經由 keep-alive 連線發送請求（回應讀入預先配置的緩衝區）
+        
+        Returns:
+            (success, response_data or error_message)
+        """
+        status, content = self._http.request(method, url, self._encode(data), self.headers)
+        
+        if IS_MICROPYTHON:
+            print(f"  DEBUG: Response status={status}")
+        
+        if 200 <= status < 300:
+            if len(content) and not self._http.truncated:
+                try:
+                    return True, json.loads(bytes(content))
+                except Exception as e:
+                    if IS_MICROPYTHON:
+                        print(f"  DEBUG: JSON parse failed: {e}")
+            if len(content) or self._http.truncated:
+                self._http.close()
+            if method in ('POST', 'PUT'):
+                # 伺服器已建立 / 更新（回應為空、被截斷或不是 JSON）：仍回報成功，
+                # 避免被存到快閃記憶體重送；ID 取自 Location 標頭
+                return True, {"id": self._location_id(self._http.location)}
+            if method == 'DELETE':
+                return True, None
+            # GET / 搜尋：沒有可用的結果就是失敗
+            reason = "truncated" if self._http.truncated else "empty or not JSON"
+            return False, f"HTTP {status}: response body {reason}"
+        
+        error_msg = f"HTTP {status}: " + bytes(content[:400]).decode('utf-8', 'ignore')
+        if IS_MICROPYTHON:
+            print(f"  DEBUG: Request failed: {error_msg}")
+        return False, error_msg
+    
     # ==================== Patient 資源管理 ====================
     
     def create_patient(self, identifier, full_name, gender=None, birth_date=None):
@@ -242,10 +326,10 @@ class FHIRClient:
     
     # ==================== Observation 資源管理 ====================
     
-    def create_heart_rate_observation(self, patient_id, heart_rate, 
-                                      measurement_time=None, notes=None):
+    def build_heart_rate_observation(self, patient_id, heart_rate, 
+                                     measurement_time=None, notes=None):
         """
-        創建心率 Observation
+        建立心率 Observation 資源（不發送）
         
         Args:
             patient_id: Patient 的 FHIR ID
@@ -254,7 +338,7 @@ class FHIRClient:
             notes: 備註
         
         Returns:
-            (success, observation_id or error_message)
+            dict: Observation 資源（尚未上傳）
         """
         observation = {
             "resourceType": "Observation",
@@ -289,6 +373,34 @@ class FHIRClient:
         if notes:
             observation["note"] = [{"text": notes}]
         
+        return observation
+    
+    def create_heart_rate_observation(self, patient_id, heart_rate, 
+                                      measurement_time=None, notes=None):
+        """
+        創建心率 Observation
+        
+        Args:
+            patient_id: Patient 的 FHIR ID
+            heart_rate: 心率值 (bpm)
+            measurement_time: 測量時間（ISO格式），默認為當前時間
+            notes: 備註
+        
+        Returns:
+            (success, observation_id or error_message)
+        """
+        if self._templates is not None and not notes:
+            observation = self._render_template(
+                ('hr', patient_id), self.build_heart_rate_observation,
+                ('heart_rate', 'measurement_time'),
+                (heart_rate, measurement_time or self._get_timestamp()),
+                patient_id=patient_id
+            )
+        else:
+            observation = self.build_heart_rate_observation(
+                patient_id, heart_rate, measurement_time, notes
+            )
+        
         url = f"{self.base_url}/Observation"
         success, result = self._make_request('POST', url, observation)
         
@@ -358,10 +470,381 @@ class FHIRClient:
             print(f"✗ ECG observation failed: {result}")
             return False, result
     
-    def create_vital_sign_observation(self, patient_id, measurement_type, 
-                                      value, unit, measurement_time=None, notes=None):
+    def build_waveform_observation(self, patient_id, samples, period_ms,
+                                   origin=0, factor=1.0, unit="mV",
+                                   measurement_time=None, notes=None):
         """
-        創建通用的生理數據 Observation
+        建立 ECG 波形 Observation 資源（不發送）
+
+        FHIR 還原方式：value = origin + factor * data[i]
+        samples 為整數 ADC 值，編碼前會先減去 origin（ADC 單位），
+        讓 data 字串只剩下小整數。
+
+        Args:
+            patient_id: Patient 的 FHIR ID
+            samples: 整數樣本序列（list / array）
+            period_ms: 取樣間隔 (ms)
+            origin: 基準值（ADC 單位）
+            factor: 每個 ADC 單位對應的 unit 數值
+            unit: 還原後的單位
+            measurement_time: 第一個樣本的時間（ISO格式），默認為當前時間
+            notes: 備註
+
+        Returns:
+            dict: Observation 資源（尚未上傳）
+        """
+        observation = {
+            "resourceType": "Observation",
+            "status": "final",
+            "category": [{
+                "coding": [{
+                    "system": "http://terminology.hl7.org/CodeSystem/observation-category",
+                    "code": "procedure",
+                    "display": "Procedure"
+                }]
+            }],
+            "code": {
+                "coding": [{
+                    "system": "urn:oid:2.16.840.1.113883.6.24",
+                    "code": "131328",
+                    "display": "MDC_ECG_ELEC_POTL"
+                }],
+                "text": "ECG Waveform"
+            },
+            "subject": {
+                "reference": f"Patient/{patient_id}"
+            },
+            "effectiveDateTime": measurement_time or self._get_timestamp(),
+            "valueSampledData": {
+                "origin": {
+                    "value": origin * factor,
+                    "unit": unit,
+                    "system": "http://unitsofmeasure.org",
+                    "code": unit
+                },
+                "period": period_ms,
+                "factor": factor,
+                "dimensions": 1,
+                "data": self.encode_sampled_data(samples, origin)
+            }
+        }
+
+        if notes:
+            observation["note"] = [{"text": notes}]
+        
+        return observation
+    
+    def create_waveform_observation(self, patient_id, samples, period_ms,
+                                    origin=0, factor=1.0, unit="mV",
+                                    measurement_time=None, notes=None):
+        """
+        上傳一段 ECG 波形（Observation.valueSampledData）
+        
+        參數同 build_waveform_observation()
+        
+        Returns:
+            (success, observation_id or error_message)
+        """
+        observation = self.build_waveform_observation(
+            patient_id, samples, period_ms, origin, factor, unit, measurement_time, notes
+        )
+        
+        url = f"{self.base_url}/Observation"
+        success, result = self._make_request('POST', url, observation)
+
+        if success and result:
+            obs_id = result.get('id')
+            print(f"✓ Waveform observation created: {obs_id} ({len(samples)} samples)")
+            return True, obs_id
+        else:
+            print(f"✗ Waveform observation failed: {result}")
+            return False, result
+    
+    def build_ptt_observation(self, patient_id, mean_ms, sd_ms, count,
+                              min_ms, max_ms, measurement_time=None, notes=None):
+        """
+        建立脈波傳導時間（PTT，ECG R 波到 PPG 上升段）摘要 Observation（不發送）
+
+        valueQuantity 為平均值，標準差 / 最小 / 最大 / 配對數放在 component。
+
+        Args:
+            patient_id: Patient 的 FHIR ID
+            mean_ms, sd_ms, min_ms, max_ms: 這段期間的 PTT 統計 (ms)
+            count: 配對成功的心跳數
+            measurement_time: 這段期間結束的時間（ISO格式），默認為當前時間
+            notes: 備註
+
+        Returns:
+            dict: Observation 資源（尚未上傳）
+        """
+        def ms(value):
+            return {
+                "value": value,
+                "unit": "ms",
+                "system": "http://unitsofmeasure.org",
+                "code": "ms"
+            }
+
+        def component(code, display, value):
+            return {
+                "code": {
+                    "coding": [{"system": "urn:esp32-ecg:code", "code": code, "display": display}],
+                    "text": display
+                },
+                "valueQuantity": value
+            }
+
+        observation = {
+            "resourceType": "Observation",
+            "status": "final",
+            "category": [{
+                "coding": [{
+                    "system": "http://terminology.hl7.org/CodeSystem/observation-category",
+                    "code": "exam",
+                    "display": "Exam"
+                }]
+            }],
+            "code": {
+                "coding": [{
+                    "system": "urn:esp32-ecg:code",
+                    "code": "ptt",
+                    "display": "Pulse transit time (ECG R-peak to PPG upstroke)"
+                }],
+                "text": "Pulse Transit Time"
+            },
+            "subject": {
+                "reference": f"Patient/{patient_id}"
+            },
+            "effectiveDateTime": measurement_time or self._get_timestamp(),
+            "valueQuantity": ms(mean_ms),
+            "component": [
+                component("ptt-sd", "PTT standard deviation", ms(sd_ms)),
+                component("ptt-min", "PTT minimum", ms(min_ms)),
+                component("ptt-max", "PTT maximum", ms(max_ms)),
+                component("ptt-count", "Matched beats", {
+                    "value": count,
+                    "unit": "beats",
+                    "system": "http://unitsofmeasure.org",
+                    "code": "{beats}"
+                })
+            ]
+        }
+
+        if notes:
+            observation["note"] = [{"text": notes}]
+
+        return observation
+
+    def create_ptt_observation(self, patient_id, mean_ms, sd_ms, count,
+                               min_ms, max_ms, measurement_time=None, notes=None):
+        """
+        上傳一筆 PTT 摘要
+
+        參數同 build_ptt_observation()
+
+        Returns:
+            (success, observation_id or error_message)
+        """
+        observation = self.build_ptt_observation(
+            patient_id, mean_ms, sd_ms, count, min_ms, max_ms, measurement_time, notes
+        )
+
+        url = f"{self.base_url}/Observation"
+        success, result = self._make_request('POST', url, observation)
+
+        if success and result:
+            obs_id = result.get('id')
+            print(f"✓ PTT observation created: {obs_id} ({count} beats)")
+            return True, obs_id
+        else:
+            print(f"✗ PTT observation failed: {result}")
+            return False, result
+    
+    def build_hrv_observation(self, patient_id, sdnn, rmssd, pnn50, sd1, sd2,
+                              mean_nn, n_nn, measurement_time=None, notes=None):
+        """
+        建立心率變異度（HRV）摘要 Observation（不發送）
+
+        valueQuantity 為 SDNN（LOINC 80404-7），RMSSD / pNN50 / Poincaré SD1、SD2 /
+        平均 NN / NN 數放在 component。參數名稱與 HRVEngine.metrics() 的鍵相同，
+        可直接 build_hrv_observation(pid, **metrics)。
+
+        Args:
+            patient_id: Patient 的 FHIR ID
+            sdnn, rmssd, sd1, sd2, mean_nn: HRV 指標 (ms)
+            pnn50: 相鄰 NN 差超過 50 ms 的比例 (%)
+            n_nn: 計算用的 NN 間隔數
+            measurement_time: 這段期間結束的時間（ISO格式），默認為當前時間
+            notes: 備註
+
+        Returns:
+            dict: Observation 資源（尚未上傳）
+        """
+        def quantity(value, unit, code):
+            return {
+                "value": value,
+                "unit": unit,
+                "system": "http://unitsofmeasure.org",
+                "code": code
+            }
+
+        def component(code, display, value):
+            return {
+                "code": {
+                    "coding": [{"system": "urn:esp32-ecg:code", "code": code, "display": display}],
+                    "text": display
+                },
+                "valueQuantity": value
+            }
+
+        observation = {
+            "resourceType": "Observation",
+            "status": "final",
+            "category": [{
+                "coding": [{
+                    "system": "http://terminology.hl7.org/CodeSystem/observation-category",
+                    "code": "exam",
+                    "display": "Exam"
+                }]
+            }],
+            "code": {
+                "coding": [{
+                    "system": "http://loinc.org",
+                    "code": "80404-7",
+                    "display": "R-R interval.standard deviation (Heart rate variability)"
+                }],
+                "text": "Heart Rate Variability"
+            },
+            "subject": {
+                "reference": f"Patient/{patient_id}"
+            },
+            "effectiveDateTime": measurement_time or self._get_timestamp(),
+            "valueQuantity": quantity(sdnn, "ms", "ms"),
+            "component": [
+                component("hrv-rmssd", "RMSSD", quantity(rmssd, "ms", "ms")),
+                component("hrv-pnn50", "pNN50", quantity(pnn50, "%", "%")),
+                component("hrv-sd1", "Poincare SD1", quantity(sd1, "ms", "ms")),
+                component("hrv-sd2", "Poincare SD2", quantity(sd2, "ms", "ms")),
+                component("hrv-mean-nn", "Mean NN interval", quantity(mean_nn, "ms", "ms")),
+                component("hrv-nn-count", "NN intervals", quantity(n_nn, "beats", "{beats}"))
+            ]
+        }
+
+        if notes:
+            observation["note"] = [{"text": notes}]
+
+        return observation
+
+    def create_hrv_observation(self, patient_id, sdnn, rmssd, pnn50, sd1, sd2,
+                               mean_nn, n_nn, measurement_time=None, notes=None):
+        """
+        上傳一筆 HRV 摘要
+
+        參數同 build_hrv_observation()
+
+        Returns:
+            (success, observation_id or error_message)
+        """
+        observation = self.build_hrv_observation(
+            patient_id, sdnn, rmssd, pnn50, sd1, sd2, mean_nn, n_nn, measurement_time, notes
+        )
+
+        url = f"{self.base_url}/Observation"
+        success, result = self._make_request('POST', url, observation)
+
+        if success and result:
+            obs_id = result.get('id')
+            print(f"✓ HRV observation created: {obs_id} (SDNN {sdnn} ms)")
+            return True, obs_id
+        else:
+            print(f"✗ HRV observation failed: {result}")
+            return False, result
+    
+    def build_rr_observation(self, patient_id, rr_ms, measurement_time=None, notes=None):
+        """
+        建立逐拍 RR 間隔 Observation 資源（不發送）
+
+        valueSampledData 的每個資料點是一個 RR 間隔 (ms)，不是等間隔取樣：
+        第 k 個心跳的時間 = effectiveDateTime + rr[0] + ... + rr[k]。
+        period 填平均 RR；origin 為四捨五入的平均 RR，data 只存與它的差。
+
+        Args:
+            patient_id: Patient 的 FHIR ID
+            rr_ms: RR 間隔序列（整數 ms，list / array）
+            measurement_time: 第一個 RR 起算的那個心跳的時間（ISO格式），默認為當前時間
+            notes: 備註
+
+        Returns:
+            dict: Observation 資源（尚未上傳）
+        """
+        mean_rr = sum(rr_ms) // len(rr_ms) if len(rr_ms) else 0
+        observation = {
+            "resourceType": "Observation",
+            "status": "final",
+            "category": [{
+                "coding": [{
+                    "system": "http://terminology.hl7.org/CodeSystem/observation-category",
+                    "code": "procedure",
+                    "display": "Procedure"
+                }]
+            }],
+            "code": {
+                "coding": [{
+                    "system": "urn:oid:2.16.840.1.113883.6.24",
+                    "code": "147240",
+                    "display": "MDC_ECG_TIME_PD_RR_GL"
+                }],
+                "text": "RR Intervals"
+            },
+            "subject": {
+                "reference": f"Patient/{patient_id}"
+            },
+            "effectiveDateTime": measurement_time or self._get_timestamp(),
+            "valueSampledData": {
+                "origin": {
+                    "value": mean_rr,
+                    "unit": "ms",
+                    "system": "http://unitsofmeasure.org",
+                    "code": "ms"
+                },
+                "period": mean_rr,
+                "factor": 1,
+                "dimensions": 1,
+                "data": self.encode_sampled_data(rr_ms, mean_rr)
+            }
+        }
+
+        if notes:
+            observation["note"] = [{"text": notes}]
+
+        return observation
+
+    def create_rr_observation(self, patient_id, rr_ms, measurement_time=None, notes=None):
+        """
+        上傳一段逐拍 RR 間隔
+
+        參數同 build_rr_observation()
+
+        Returns:
+            (success, observation_id or error_message)
+        """
+        observation = self.build_rr_observation(patient_id, rr_ms, measurement_time, notes)
+
+        url = f"{self.base_url}/Observation"
+        success, result = self._make_request('POST', url, observation)
+
+        if success and result:
+            obs_id = result.get('id')
+            print(f"✓ RR observation created: {obs_id} ({len(rr_ms)} beats)")
+            return True, obs_id
+        else:
+            print(f"✗ RR observation failed: {result}")
+            return False, result
+    
+    def build_vital_sign_observation(self, patient_id, measurement_type, 
+                                     value, unit, measurement_time=None, notes=None):
+        """
+        建立通用生理數據 Observation 資源（不發送）
         
         Args:
             patient_id: Patient 的 FHIR ID
@@ -372,7 +855,7 @@ class FHIRClient:
             notes: 備註
         
         Returns:
-            (success, observation_id or error_message)
+            dict: Observation 資源（尚未上傳）
         """
         # LOINC 代碼映射
         loinc_codes = {
@@ -420,6 +903,36 @@ class FHIRClient:
         if notes:
             observation["note"] = [{"text": notes}]
         
+        return observation
+    
+    def create_vital_sign_observation(self, patient_id, measurement_type, 
+                                      value, unit, measurement_time=None, notes=None):
+        """
+        創建通用的生理數據 Observation
+        
+        Args:
+            patient_id: Patient 的 FHIR ID
+            measurement_type: 測量類型（如：血壓、血糖等）
+            value: 數值
+            unit: 單位
+            measurement_time: 測量時間（ISO格式），默認為當前時間
+            notes: 備註
+        
+        Returns:
+            (success, observation_id or error_message)
+        """
+        if self._templates is not None and not notes:
+            observation = self._render_template(
+                ('vs', patient_id, measurement_type, unit), self.build_vital_sign_observation,
+                ('value', 'measurement_time'),
+                (value, measurement_time or self._get_timestamp()),
+                patient_id=patient_id, measurement_type=measurement_type, unit=unit
+            )
+        else:
+            observation = self.build_vital_sign_observation(
+                patient_id, measurement_type, value, unit, measurement_time, notes
+            )
+        
         url = f"{self.base_url}/Observation"
         success, result = self._make_request('POST', url, observation)
         
@@ -479,6 +992,16 @@ class FHIRClient:
         """取得病患的心率記錄"""
         return self.get_patient_observations(patient_id, code="8867-4", limit=limit)
     
+    def get_patient_waveforms(self, patient_id, limit=20):
+        """取得病患的 ECG 波形片段（valueSampledData）"""
+        return self.get_patient_observations(
+            patient_id, code="urn:oid:2.16.840.1.113883.6.24|131328", limit=limit)
+    
+    def get_patient_rr_series(self, patient_id, limit=20):
+        """取得病患的逐拍 RR 間隔片段（MDC 147240）"""
+        return self.get_patient_observations(
+            patient_id, code="urn:oid:2.16.840.1.113883.6.24|147240", limit=limit)
+    
     def get_patient_vital_signs(self, patient_id, measurement_type=None, limit=20):
         """
         取得病患的生理數據
@@ -501,6 +1024,63 @@ class FHIRClient:
         code = loinc_codes.get(measurement_type) if measurement_type else None
         return self.get_patient_observations(patient_id, code=code, limit=limit)
     
+    # ==================== Transaction Bundle ====================
+    
+    def with_identifier(self, resource, system, value):
+        """
+        為資源加上 identifier（冪等鍵）
+        
+        Args:
+            resource: FHIR 資源 dict
+            system: identifier system（例如 urn:esp32-ecg:observation）
+            value: 唯一值
+        
+        Returns:
+            dict: 同一個資源（已加上 identifier）
+        """
+        resource["identifier"] = [{"system": system, "value": value}]
+        return resource
+    
+    def post_transaction(self, resources):
+        """
+        以 transaction Bundle 一次上傳多筆資源
+        
+        帶有 identifier 的資源會加上 ifNoneExist（conditional create），
+        重送同一批資料時伺服器不會重複建立。
+        
+        Args:
+            resources: FHIR 資源 dict 列表
+        
+        Returns:
+            (success, list of response entries or error_message)
+        """
+        entries = []
+        for resource in resources:
+            request = {
+                "method": "POST",
+                "url": resource["resourceType"]
+            }
+            if resource.get("identifier"):
+                ident = resource["identifier"][0]
+                request["ifNoneExist"] = f"identifier={ident['system']}|{ident['value']}"
+            entries.append({"resource": resource, "request": request})
+        
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": entries
+        }
+        
+        success, result = self._make_request('POST', self.base_url, bundle)
+        
+        if success:
+            responses = result.get('entry', []) if result else []
+            print(f"✓ Transaction bundle posted: {len(entries)} entries")
+            return True, responses
+        else:
+            print(f"✗ Transaction bundle failed: {result}")
+            return False, result
+    
     # ==================== ESP32 兼容方法 ====================
     
     def send_heart_rate(self, heart_rate, patient_id="patient-001"):
@@ -534,6 +1114,35 @@ class FHIRClient:
         success, result = self.create_ecg_observation(patient_id, ecg_value)
         return success
     
+    def ping(self, timeout=2):
+        """
+        輕量健康檢查：只看 /metadata?_summary=true 的狀態碼
+        
+        回應內容不會被讀取（test_connection() 會把整份
+        CapabilityStatement 下載到記憶體，ESP32 上太大）
+        
+        Args:
+            timeout: 逾時秒數
+        
+        Returns:
+            bool: 伺服器可用返回 True
+        """
+        try:
+            url = f"{self.base_url}/metadata?_summary=true"
+            if self._http is not None:
+                # 回應讀進 keep-alive 緩衝區，並順便把連線建立好
+                status, _ = self._http.request('GET', url, None,
+                                               {'Accept': 'application/fhir+json'}, timeout)
+                return status == 200
+            response = requests.get(url, headers={'Accept': 'application/fhir+json'},
+                                    timeout=timeout)
+            success = response.status_code == 200
+            response.close()
+            return success
+        except Exception as e:
+            print(f"✗ FHIR ping 失敗: {e}")
+            return False
+    
     def test_connection(self):
         """測試與 FHIR 服務器的連接"""
         try:
@@ -554,6 +1163,29 @@ class FHIRClient:
     
     # ==================== 數據解析工具 ====================
     
+    @staticmethod
+    def encode_sampled_data(samples, origin=0):
+        """SampledData.data 編碼：減去 origin 後以空白分隔的整數"""
+        return ' '.join([str(int(v) - origin) for v in samples])
+
+    @staticmethod
+    def decode_sampled_data(sampled_data):
+        """
+        還原 valueSampledData 為數值列表
+
+        Returns:
+            list of float（E/U/L 等非數值點為 None）
+        """
+        origin = sampled_data.get('origin', {}).get('value', 0)
+        factor = sampled_data.get('factor', 1)
+        values = []
+        for token in sampled_data.get('data', '').split():
+            try:
+                values.append(origin + factor * float(token))
+            except ValueError:
+                values.append(None)
+        return values
+    
     def parse_observation(self, observation):
         """
         解析 Observation 資源，提取關鍵信息
@@ -571,13 +1203,30 @@ class FHIRClient:
             'unit': None,
             'time': observation.get('effectiveDateTime'),
             'notes': None,
-            'patient_id': None
+            'patient_id': None,
+            'waveform': None,
+            'components': None
         }
         
         # 提取數值
         if 'valueQuantity' in observation:
             result['value'] = observation['valueQuantity'].get('value')
             result['unit'] = observation['valueQuantity'].get('unit')
+        elif 'valueSampledData' in observation:
+            sampled = observation['valueSampledData']
+            result['unit'] = sampled.get('origin', {}).get('unit')
+            result['waveform'] = {
+                'period_ms': sampled.get('period'),
+                'values': self.decode_sampled_data(sampled)
+            }
+        
+        # 提取 component（例如 PTT 摘要的標準差 / 最小 / 最大）
+        if observation.get('component'):
+            result['components'] = [{
+                'type': c.get('code', {}).get('text', 'Unknown'),
+                'value': c.get('valueQuantity', {}).get('value'),
+                'unit': c.get('valueQuantity', {}).get('unit')
+            } for c in observation['component']]
         
         # 提取備註
         if 'note' in observation and observation['note']:
@@ -315,6 +315,85 @@ class FHIRManager:
         
         return measurements
     
+    def get_user_ecg_waveforms(self, user_id, limit=10):
+        """
+        取得使用者的 ECG 波形片段（從 FHIR Server）
+        
+        Returns:
+            list of waveform dicts（values 已還原為實際單位）
+        """
+        user = self.get_user_by_id(user_id)
+        if not user or not user.get('fhir_patient_id'):
+            return []
+        
+        patient_id = user['fhir_patient_id']
+        
+        success, observations = self.fhir_client.get_patient_waveforms(
+            patient_id, limit=limit
+        )
+        
+        if not success:
+            return []
+        
+        waveforms = []
+        for obs in observations:
+            parsed = self.fhir_client.parse_observation(obs)
+            if not parsed['waveform']:
+                continue
+            waveforms.append({
+                'id': parsed['id'],
+                'measurement_time': parsed['time'],
+                'period_ms': parsed['waveform']['period_ms'],
+                'values': parsed['waveform']['values'],
+                'unit': parsed['unit']
+            })
+        
+        return waveforms
+    
+    def get_user_rr_series(self, user_id, limit=20):
+        """
+        取得使用者的逐拍 RR 間隔片段（從 FHIR Server）
+
+        每段的心跳時間 = measurement_time + RR 累加，瞬時心率 = 60000 / RR。
+
+        Returns:
+            list of dicts: measurement_time, beat_s（相對 measurement_time 的秒數）,
+            rr_ms, hr_bpm
+        """
+        user = self.get_user_by_id(user_id)
+        if not user or not user.get('fhir_patient_id'):
+            return []
+        
+        patient_id = user['fhir_patient_id']
+        
+        success, observations = self.fhir_client.get_patient_rr_series(
+            patient_id, limit=limit
+        )
+        
+        if not success:
+            return []
+        
+        series = []
+        for obs in observations:
+            parsed = self.fhir_client.parse_observation(obs)
+            if not parsed['waveform']:
+                continue
+            rr = [int(v) for v in parsed['waveform']['values'] if v]
+            beat_s = []
+            t = 0
+            for v in rr:
+                t += v
+                beat_s.append(t / 1000)
+            series.append({
+                'id': parsed['id'],
+                'measurement_time': parsed['time'],
+                'beat_s': beat_s,
+                'rr_ms': rr,
+                'hr_bpm': [round(60000 / v, 1) for v in rr]
+            })
+        
+        return series
+    
     def get_user_vital_signs(self, user_id, measurement_type=None, limit=20):
         """
         取得使用者的生理數據記錄（從 FHIR Server）
@@ -343,8 +422,8 @@ class FHIRManager:
         for obs in observations:
             parsed = self.fhir_client.parse_observation(obs)
             
-            # 跳過心率記錄（已在 ECG 中處理）
-            if 'Heart rate' in parsed['type']:
+            # 跳過心率記錄與波形片段（已在 ECG 中處理）
+            if 'Heart rate' in parsed['type'] or parsed['waveform']:
                 continue
             
             vital_signs.append({
@@ -0,0 +1,160 @@
+# hrv_metrics.py - HRV 指標的 NumPy 版本（Streamlit 端）
+#
+# Same metrics and the same ectopic-beat rule as ESP32/hrv_engine.py, for
+# stored RR histories: SDNN, RMSSD, pNN50 and the Poincare SD1 / SD2, all
+# with n - 1 variances and rounded to 0.1 like the device.
+#
+# filter_nn() walks the RR list once (the "previous NN" rule is recursive);
+# everything after it is vectorized. rolling_hrv() gives the metrics of the
+# window ending at every beat from cumulative sums, e.g. for a trend plot.
+
+import numpy as np
+
+
+def filter_nn(rr, rr_min_ms=270, rr_max_ms=2000, ectopic_pct=20, reseed=3):
+    """
+    異位 / 雜訊心跳剔除（與 HRVEngine.update() 相同規則）
+
+    Args:
+        rr: RR 間隔序列 (ms)
+
+    Returns:
+        (nn, adjacent)：保留的 NN 間隔，以及每個 NN 與前一個 NN 是否相鄰
+        （中間沒有被剔除的心跳，可計算差值）
+    """
+    nn = []
+    adjacent = []
+    prev = 0
+    adj = False
+    misses = 0
+    for x in np.asarray(rr, dtype=np.int64).tolist():
+        ok = rr_min_ms < x < rr_max_ms
+        if ok and prev and misses < reseed:
+            ok = abs(x - prev) * 100 <= ectopic_pct * prev
+        if not ok:
+            misses += 1
+            adj = False
+            continue
+        if misses >= reseed:
+            adj = False
+        adjacent.append(adj)
+        nn.append(x)
+        misses = 0
+        prev = x
+        adj = True
+    return np.array(nn, dtype=np.int64), np.array(adjacent, dtype=bool)
+
+
+def _metrics(n, mean, var, dn, dmean, dvar, d2mean, nn50):
+    # one dict from window statistics (var / dvar with n - 1)
+    sd1_2 = dvar / 2
+    sd2_2 = 2 * var - sd1_2
+    return {
+        'n_nn': int(n),
+        'mean_nn': round(float(mean), 1),
+        'sdnn': round(float(np.sqrt(var)), 1),
+        'rmssd': round(float(np.sqrt(d2mean)), 1),
+        'pnn50': round(float(100.0 * nn50 / dn), 1),
+        'sd1': round(float(np.sqrt(sd1_2)), 1),
+        'sd2': round(float(np.sqrt(sd2_2)), 1) if sd2_2 > 0 else 0.0
+    }
+
+
+def hrv_metrics(nn, adjacent, window=None):
+    """
+    HRV 指標（最後 window 個 NN；None = 全部）
+
+    Returns:
+        dict: n_nn, mean_nn, sdnn, rmssd, pnn50, sd1, sd2；資料不足時 None
+    """
+    nn = np.asarray(nn, dtype=np.float64)
+    adjacent = np.asarray(adjacent, dtype=bool)
+    if window is not None and len(nn) > window:
+        # the first NN of the window keeps its difference to the one before
+        d_all = np.diff(nn, prepend=0.0)
+        nn = nn[-window:]
+        d = d_all[-window:][adjacent[-window:]]
+    else:
+        d = np.diff(nn)[adjacent[1:]] if len(nn) > 1 else np.zeros(0)
+    if len(nn) < 3 or len(d) < 2:
+        return None
+    return _metrics(len(nn), nn.mean(), nn.var(ddof=1), len(d), d.mean(),
+                    d.var(ddof=1), np.mean(d * d), np.count_nonzero(np.abs(d) > 50))
+
+
+def rolling_hrv(nn, adjacent, window=300):
+    """
+    每個心跳結束的視窗指標（累加和，向量化）
+
+    Returns:
+        dict of arrays (one entry per NN from index window - 1 on):
+        'sdnn', 'rmssd', 'pnn50', 'sd1', 'sd2'
+    """
+    nn = np.asarray(nn, dtype=np.float64)
+    adjacent = np.asarray(adjacent, dtype=bool)
+    d = np.where(adjacent, np.diff(nn, prepend=0.0), 0.0)
+    has = adjacent.astype(np.float64)
+
+    def win(x):
+        c = np.concatenate(([0.0], np.cumsum(x)))
+        return c[window:] - c[:-window]
+
+    n = float(window)
+    s1 = win(nn)
+    s2 = win(nn * nn)
+    dn = win(has)
+    ds1 = win(d)
+    ds2 = win(d * d)
+    nn50 = win((np.abs(d) > 50) & adjacent)
+
+    var = (s2 - s1 * s1 / n) / (n - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dvar = (ds2 - ds1 * ds1 / dn) / (dn - 1)
+        sd1_2 = dvar / 2
+        return {
+            'sdnn': np.sqrt(np.maximum(var, 0.0)),
+            'rmssd': np.sqrt(ds2 / dn),
+            'pnn50': 100.0 * nn50 / dn,
+            'sd1': np.sqrt(np.maximum(sd1_2, 0.0)),
+            'sd2': np.sqrt(np.maximum(2 * var - sd1_2, 0.0))
+        }
+
+
+# ==================== 測試代碼 ====================
+# Against the device engine (ESP32/hrv_engine.py) on a synthetic RR series
+# with sinus arrhythmia, ectopic beats and a rhythm change.
+if __name__ == '__main__':
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ESP32'))
+    from hrv_engine import HRVEngine
+
+    rng = np.random.default_rng(21)
+    k = np.arange(5000)
+    base = np.where(k < 2500, 850, 650)
+    rr = (base + 45 * np.sin(2 * np.pi * k / 5) + rng.normal(0, 18, len(k))).astype(np.int64)
+    ectopic = np.flatnonzero(rng.random(len(k)) < 0.02)
+    rr[ectopic] = (rr[ectopic] * 0.65).astype(np.int64)
+    rr[np.minimum(ectopic + 1, len(k) - 1)] = (rr[ectopic] * 2).astype(np.int64)
+
+    nn, adjacent = filter_nn(rr)
+    engine = HRVEngine(window=300)
+    checked = 0
+    for i, x in enumerate(rr.tolist()):
+        engine.update(x)
+        if i % 250 == 249:
+            m = engine.metrics()
+            ref = hrv_metrics(*filter_nn(rr[:i + 1]), window=300)
+            assert all(abs(m[key] - ref[key]) <= 0.11 for key in ref), (i, m, ref)
+            checked += 1
+    assert engine.accepted == len(nn)
+
+    roll = rolling_hrv(nn, adjacent, 300)
+    last = hrv_metrics(nn, adjacent, 300)
+    assert abs(roll['rmssd'][-1] - last['rmssd']) < 0.06 and abs(roll['sd2'][-1] - last['sd2']) < 0.06
+
+    print("NN {} / {} RR | windows checked against HRVEngine: {}".format(len(nn), len(rr), checked))
+    print("whole record:", hrv_metrics(nn, adjacent))
+    print("last 300    :", last)
+    print("hrv_metrics == HRVEngine: OK")
@@ -2,11 +2,13 @@ import streamlit as st
 import sys
 import os
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 
 # 加入父目錄到路徑
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from fhir_manager import FHIRManager
+from hrv_metrics import filter_nn, hrv_metrics
 
 # 檢查登入狀態
 if 'logged_in' not in st.session_state or not st.session_state.logged_in:
@@ -154,6 +156,33 @@ with tab1:
         
         st.markdown("---")
         
+        # ECG 波形片段
+        st.subheader("🫀 ECG 波形")
+        
+        waveforms = st.session_state.fhir_manager.get_user_ecg_waveforms(user_id, limit=10)
+        if waveforms:
+            strip_labels = [
+                f"{w['measurement_time'][:19] if w['measurement_time'] else ''} "
+                f"({len(w['values']) * w['period_ms'] / 1000:.1f} s)"
+                for w in waveforms
+            ]
+            strip_idx = st.selectbox(
+                "選擇波形片段",
+                range(len(waveforms)),
+                format_func=lambda i: strip_labels[i],
+                key="ecg_strip"
+            )
+            strip = waveforms[strip_idx]
+            strip_data = pd.DataFrame({
+                '時間 (s)': [i * strip['period_ms'] / 1000 for i in range(len(strip['values']))],
+                f"ECG ({strip['unit']})": strip['values']
+            })
+            st.line_chart(strip_data.set_index('時間 (s)'))
+        else:
+            st.info("📌 暫無波形資料（ESP32 設定 WAVEFORM_UPLOAD = True 後上傳）")
+        
+        st.markdown("---")
+        
         # 詳細記錄表格
         st.subheader("📋 詳細記錄")
         
@@ -192,6 +221,78 @@ with tab1:
         
         所有測量後的資料會自動同步並顯示在這裡。
         """)
+    
+    # 逐拍心率（RR_STREAM 模式上傳的 RR 間隔）
+    st.markdown("---")
+    st.subheader("⏱️ 逐拍心率")
+    
+    rr_series = st.session_state.fhir_manager.get_user_rr_series(user_id, limit=10)
+    if rr_series:
+        rr_labels = [
+            f"{r['measurement_time'][:19] if r['measurement_time'] else ''} "
+            f"({len(r['rr_ms'])} beats)"
+            for r in rr_series
+        ]
+        rr_idx = st.selectbox(
+            "選擇 RR 片段",
+            range(len(rr_series)),
+            format_func=lambda i: rr_labels[i],
+            key="rr_series"
+        )
+        rr = rr_series[rr_idx]
+        rr_data = pd.DataFrame({
+            '時間 (s)': rr['beat_s'],
+            '瞬時心率 (bpm)': rr['hr_bpm']
+        })
+        st.line_chart(rr_data.set_index('時間 (s)'))
+        
+        # HRV（hrv_metrics.py，與 ESP32 hrv_engine.py 相同的異位心跳剔除）
+        hrv_scope = st.radio(
+            "HRV 計算範圍",
+            ["此片段", f"全部 {len(rr_series)} 個片段"],
+            horizontal=True,
+            key="hrv_scope"
+        )
+        if hrv_scope == "此片段":
+            nn, adjacent = filter_nn(rr['rr_ms'])
+            n_rr = len(rr['rr_ms'])
+        else:
+            # 接續的片段（起點 = 上一段最後一拍，毫秒時間戳）合併後一起剔除；
+            # 不連續處（不同次測量、導線脫落）第一個 NN 不與前一段相減
+            runs = []
+            prev_end = None
+            for r in reversed(rr_series):
+                start = pd.Timestamp(r['measurement_time']) if r['measurement_time'] else None
+                if runs and start is not None and prev_end is not None \
+                        and abs((start - prev_end).total_seconds()) < 0.002:
+                    runs[-1] = runs[-1] + r['rr_ms']
+                else:
+                    runs.append(list(r['rr_ms']))
+                prev_end = start + pd.Timedelta(milliseconds=sum(r['rr_ms'])) if start is not None else None
+            parts = [filter_nn(run) for run in runs]
+            nn = np.concatenate([part_nn for part_nn, _ in parts])
+            adjacent = np.concatenate([part_adjacent for _, part_adjacent in parts])
+            n_rr = sum(len(r['rr_ms']) for r in rr_series)
+        
+        metrics = hrv_metrics(nn, adjacent)
+        if metrics:
+            col1, col2, col3, col4, col5 = st.columns(5)
+            with col1:
+                st.metric("SDNN", f"{metrics['sdnn']} ms")
+            with col2:
+                st.metric("RMSSD", f"{metrics['rmssd']} ms")
+            with col3:
+                st.metric("pNN50", f"{metrics['pnn50']} %")
+            with col4:
+                st.metric("SD1", f"{metrics['sd1']} ms")
+            with col5:
+                st.metric("SD2", f"{metrics['sd2']} ms")
+            st.caption(f"NN 間隔 {metrics['n_nn']} / {n_rr} 個 RR（已剔除異位 / 雜訊心跳）"
+                       f" | 平均 NN {metrics['mean_nn']} ms")
+        else:
+            st.caption("NN 間隔不足，無法計算 HRV")
+    else:
+        st.info("📌 暫無逐拍資料（ESP32 設定 RR_STREAM = True 後上傳）")
 
 # ==================== Tab 2: 生理數據 ====================
 with tab2: